@@ -75,7 +75,7 @@ async def on_ready():
     print(message)
     channel = discord.utils.get(guild.channels, name="grubberbot-logs")
     await channel.send(message)
-    fdd.update_google_sheet()
+    await fdd.update_google_sheet()
     # await fdd.announce_pairing(bot, guild)
 
 
@@ -88,7 +88,7 @@ async def on_command_error(ctx, error):
 
 @bot.event
 async def on_command_completion(ctx):
-    fdd.update_google_sheet()
+    await fdd.update_google_sheet()
 
 
 @commands.command(name="commands")
@@ -157,6 +157,9 @@ def main():
     bot.add_command(fdd.mod_request_substitute_current)
     bot.add_command(fdd.mod_claim_substitute)
 
+    # Season setup
+    bot.add_command(fdd.mod_assign_teams)
+
     bot.run(DISCORD_TOKEN)
 
 
@@ -0,0 +1,648 @@
+import http.server
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+import zlib
+
+import funcs_chesscom as fcc
+import funcs_sqlite as fsq
+import pandas as pd
+
+# Simulated cost of opening a new connection (TCP + TLS handshake)
+HANDSHAKE_DELAY = 0.02
+
+
+def gen_player(chesscom):
+    return {"username": chesscom, "url": f"https://www.chess.com/member/{chesscom}"}
+
+
+def gen_stats(rapid=1500, blitz=1400, bullet=1300):
+    def category(rating):
+        return {
+            "last": {"rating": rating, "date": 1633046400, "rd": 50},
+            "record": {"win": 40, "loss": 30, "draw": 10},
+        }
+
+    return {
+        "chess_rapid": category(rapid),
+        "chess_blitz": category(blitz),
+        "chess_bullet": category(bullet),
+    }
+
+
+def gen_game(cc_game_id, white, black, end_time, white_result="win", pgn=""):
+    black_result = {"win": "resigned", "agreed": "agreed"}.get(white_result, "win")
+    return {
+        "url": f"https://www.chess.com/game/live/{cc_game_id}",
+        "end_time": end_time,
+        "time_control": "900+10",
+        "rated": True,
+        "rules": "chess",
+        "pgn": pgn,
+        "white": {"username": white, "rating": 1500, "result": white_result},
+        "black": {"username": black, "rating": 1500, "result": black_result},
+    }
+
+
+def unthrottled():
+    """Rate limiter that never waits, the local server has no rate limit"""
+    return fcc.TokenBucket(rate=1e9, capacity=1e9)
+
+
+class LocalChesscomServer:
+    """Offline stand-in for api.chess.com, used by tests and benchmarks
+
+    `players` maps a username to its `/stats` payload, `archives` maps
+    `(username, "YYYY/MM")` to a list of games, or to the already encoded
+    archive so serving it costs no memory.  Responses carry an ETag and
+    `If-None-Match` is answered with 304.  `failures` maps a request path to
+    a list of error statuses to answer with before serving it.  Every new
+    connection sleeps `handshake_delay` seconds to mimic the cost of a TCP +
+    TLS handshake, and every response is delayed by `response_delay` seconds.
+    """
+
+    def __init__(
+        self,
+        players=None,
+        archives=None,
+        handshake_delay=HANDSHAKE_DELAY,
+        response_delay=0,
+    ):
+        self.players = players if players is not None else {}
+        self.archives = archives if archives is not None else {}
+        self.handshake_delay = handshake_delay
+        self.response_delay = response_delay
+        self.connections = 0
+        self.requests = 0
+        self.not_modified = 0
+        self.failures = {}
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+                time.sleep(server.handshake_delay)
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                time.sleep(server.response_delay)
+                with server.lock:
+                    failures = server.failures.get(self.path, [])
+                    failure = failures.pop(0) if failures else None
+                if failure is not None:
+                    status, payload = failure, {"code": 0, "message": "Error"}
+                else:
+                    status, payload = server.route(self.path)
+                body = payload if isinstance(payload, bytes) else json.dumps(payload)
+                body = body.encode() if isinstance(body, str) else body
+                etag = f'"{zlib.crc32(body):08x}"'
+                if status == 200 and self.headers.get("If-None-Match") == etag:
+                    with server.lock:
+                        server.not_modified += 1
+                    status, body = 304, b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(http.server.ThreadingHTTPServer):
+            def handle_error(self, request, client_address):
+                # Clients hang up mid-body when they stop streaming early
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        self.httpd = Server(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/pub"
+
+    def route(self, path):
+        not_found = (404, {"code": 0, "message": "Not Found"})
+        match = re.fullmatch(r"/pub/player/([^/]+)(/.*)?", path)
+        if match is None:
+            return not_found
+        chesscom, rest = match.group(1).lower(), match.group(2) or ""
+        if chesscom not in self.players:
+            return not_found
+        if rest == "":
+            return 200, gen_player(chesscom)
+        if rest == "/stats":
+            return 200, self.players[chesscom]
+        match = re.fullmatch(r"/games/(\d{4}/\d{2})", rest)
+        if match is not None:
+            archive = self.archives.get((chesscom, match.group(1)), [])
+            return 200, archive if isinstance(archive, bytes) else {"games": archive}
+        return not_found
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def bench_http_pool(num_requests=100):
+    """Compare one connection per request against the pooled client"""
+    players = {f"player{i}": gen_stats(1000 + i) for i in range(num_requests)}
+    with LocalChesscomServer(players) as server:
+        start = time.time()
+        for chesscom in players:
+            url = f"{server.base_url}/player/{chesscom}/stats"
+            with urllib.request.urlopen(url) as response:
+                json.loads(response.read())
+        urlopen_time = time.time() - start
+        urlopen_connections = server.connections
+
+        server.connections = 0
+        client = fcc.ChesscomClient(
+            base_url=server.base_url, rate_limiter=unthrottled()
+        )
+        start = time.time()
+        for chesscom in players:
+            client.get_json(f"/player/{chesscom}/stats")
+        pooled_time = time.time() - start
+        pooled_connections = server.connections
+        client.close()
+
+    print(f"{num_requests} sequential /stats requests")
+    print(f"urlopen: {urlopen_time:.3f}s, {urlopen_connections} connections")
+    print(f"pooled:  {pooled_time:.3f}s, {pooled_connections} connections")
+
+
+def bench_archive_scan(num_games=5000):
+    """Compare loading a whole archive against streaming it to one game"""
+    month = fcc.archive_months()[0].strftime("%Y/%m")
+    pgn = "1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 " * 40
+    games = [
+        gen_game(i, "pawngrubber", f"opponent{i}", 1633046400 + i, pgn=pgn)
+        for i in range(num_games)
+    ]
+    archive = json.dumps({"games": games}).encode()
+    del games
+    archives = {("pawngrubber", month): archive}
+    players = {"pawngrubber": gen_stats()}
+
+    def full(cc_game_id):
+        games = fcc.get_game_history_api("pawngrubber", client=client)
+        games = {fcc.game_id_from_url(game["url"]): game for game in games}
+        return games.get(cc_game_id)
+
+    def streamed(cc_game_id):
+        return fcc.find_game_api("pawngrubber", cc_game_id, client=client)
+
+    print(f"{num_games} game archive, {len(archive) / 2 ** 20:.1f} MiB")
+    with LocalChesscomServer(players, archives, handshake_delay=0) as server:
+        client = fcc.ChesscomClient(
+            base_url=server.base_url, rate_limiter=unthrottled()
+        )
+        for where, cc_game_id in [
+            ("first", 0),
+            ("middle", num_games // 2),
+            ("last", num_games - 1),
+        ]:
+            for name, func in [("full", full), ("streamed", streamed)]:
+                # Time and trace separately, tracemalloc slows allocations
+                start = time.time()
+                game = func(cc_game_id)
+                elapsed = time.time() - start
+                tracemalloc.start()
+                func(cc_game_id)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                assert fcc.game_id_from_url(game["url"]) == cc_game_id
+                print(
+                    f"{where} game, {name:>8}: {elapsed:.3f}s, "
+                    f"peak {peak / 2 ** 20:.2f} MiB"
+                )
+        client.close()
+
+
+def gen_league(ldb, num_seasons=36, num_users=2000, members=160, teams=8):
+    """Fill a LeagueDatabase with synthetic seasons of members, seeds and games"""
+    rng = random.Random(0)
+    cur = ldb.conn.cursor()
+    users = [(1000 + i, f"user{i}#0001", f"player{i}") for i in range(num_users)]
+    cur.executemany(
+        "INSERT INTO user(discord_id, discord_name, chesscom) VALUES(?, ?, ?);",
+        users,
+    )
+    for season in range(num_seasons):
+        name = f"bench-{season}"
+        season_id = cur.execute(
+            "INSERT INTO season(name) VALUES(?);", (name,)
+        ).lastrowid
+        team_ids = [
+            cur.execute(
+                "INSERT INTO team(season_id, name) VALUES(?, ?);",
+                (season_id, f"team{t}"),
+            ).lastrowid
+            for t in range(teams)
+        ]
+        member_ids = [
+            cur.execute(
+                "INSERT INTO member(user_id, team_id, is_player) VALUES(?, ?, 1);",
+                (user_id, team_ids[i % teams]),
+            ).lastrowid
+            for i, user_id in enumerate(rng.sample(range(1, num_users + 1), members))
+        ]
+        for num in range(1, 5):
+            week_id = cur.execute(
+                "INSERT INTO week(season_id, num) VALUES(?, ?);", (season_id, num)
+            ).lastrowid
+            seed_ids = [
+                cur.execute(
+                    "INSERT INTO seed(week_id, member_id, sub_member_id, request) "
+                    "VALUES(?, ?, ?, ?);",
+                    (week_id, m, m, int(rng.random() < 0.1)),
+                ).lastrowid
+                for m in member_ids
+            ]
+            rng.shuffle(seed_ids)
+            cur.executemany(
+                "INSERT INTO game(white_seed_id, black_seed_id) VALUES(?, ?);",
+                zip(seed_ids[::2], seed_ids[1::2]),
+            )
+    ldb.conn.commit()
+
+
+def trace(ldb, callback):
+    """Trace statements on the writer and every pooled reader of `ldb`"""
+    with ldb.pool.reader():
+        pass
+    for conn in [ldb.conn] + list(ldb.pool.idle.queue):
+        conn.set_trace_callback(callback)
+
+
+def bench_league_indexes(num_seasons=36, repeat=50):
+    """Time league queries and show their plans without and with the indexes"""
+    # Imported here, funcs_league downloads the league database on import
+    import funcs_league as fle
+
+    with tempfile.TemporaryDirectory() as tmp:
+        chess_db = fcc.ChesscomDatabase(path=":memory:")
+        ldb = fle.LeagueDatabase(
+            os.path.join(tmp, "league.sqlite3"), chess_db, cache_reads=False
+        )
+        gen_league(ldb, num_seasons=num_seasons)
+        rng = random.Random(1)
+        season_names = [f"bench-{rng.randrange(num_seasons)}" for _ in range(repeat)]
+        discord_ids = [1000 + rng.randrange(2000) for _ in range(repeat)]
+        queries = {
+            "is_member": lambda s, d: ldb.is_member(s, d),
+            "get_all_games": lambda s, d: ldb.get_all_games(s, d),
+            "get_request_info": lambda s, d: ldb.get_request_info(s),
+            "get_season_games": lambda s, d: ldb.get_season_games(s),
+        }
+
+        # Roll back to the version before the indexes, then migrate forward
+        ldb.conn.executescript("""
+            DROP INDEX member_team_idx;
+            DROP INDEX seed_sub_member_idx;
+            DROP INDEX seed_member_idx;
+            DROP INDEX game_black_seed_idx;
+            PRAGMA user_version = 1;
+            """)
+        counts = ldb.conn.execute(
+            "SELECT (SELECT COUNT(*) FROM member), (SELECT COUNT(*) FROM seed),"
+            " (SELECT COUNT(*) FROM game);"
+        ).fetchone()
+        print(
+            f"{num_seasons} seasons, {counts[0]} members, {counts[1]} seeds, "
+            f"{counts[2]} games"
+        )
+
+        for label in ["before", "after"]:
+            if label == "after":
+                print(f"migrated to versions {ldb.init_tables()}")
+            for name, query in queries.items():
+                statements = []
+                trace(ldb, statements.append)
+                query(season_names[0], discord_ids[0])
+                trace(ldb, None)
+                selects = [q for q in statements if q.lstrip()[:4] in ["WITH", "SELE"]]
+                plan = fsq.explain(ldb.conn, selects[-1])
+                start = time.time()
+                for season_name, discord_id in zip(season_names, discord_ids):
+                    query(season_name, discord_id)
+                elapsed = (time.time() - start) / repeat
+                print(f"{label} {name}: {1000 * elapsed:.2f}ms")
+                for step in plan:
+                    print(f"    {step}")
+        ldb.quit()
+        chess_db.quit()
+
+
+def bench_game_read_model(season_counts=(6, 24, 96), repeat=200):
+    """Time game lookups on the joined view and on the game_info read model"""
+    import funcs_league as fle
+
+    lookups = {
+        "by game": ("game_id = ?", lambda g, s, w: (g,)),
+        "by seed": ("white_seed_id = ? OR black_seed_id = ?", lambda g, s, w: (g, g)),
+        "by week": ("season_id = ? AND week_num = ?", lambda g, s, w: (s, w)),
+        "by season": ("season_id = ?", lambda g, s, w: (s,)),
+    }
+    for num_seasons in season_counts:
+        chess_db = fcc.ChesscomDatabase(path=":memory:")
+        ldb = fle.LeagueDatabase(":memory:", chess_db, cache_reads=False)
+        gen_league(ldb, num_seasons=num_seasons)
+        num_games = ldb.conn.execute("SELECT COUNT(*) FROM game;").fetchone()[0]
+        print(f"{num_seasons} seasons, {num_games} games")
+
+        season_ids = [
+            ldb.ids.season(f"bench-{season}") for season in range(num_seasons)
+        ]
+        rng = random.Random(1)
+        keys = [
+            (
+                rng.randrange(1, num_games + 1),
+                rng.choice(season_ids),
+                rng.randrange(1, 5),
+            )
+            for _ in range(repeat)
+        ]
+        for name, (where, get_params) in lookups.items():
+            timings = []
+            for table in ["game_info_view", "game_info"]:
+                sql = f"SELECT * FROM {table} WHERE {where};"
+                start = time.time()
+                for key in keys:
+                    ldb.conn.execute(sql, get_params(*key)).fetchall()
+                timings.append(1000 * (time.time() - start) / repeat)
+            print(f"    {name}: join {timings[0]:.3f}ms, table {timings[1]:.3f}ms")
+        ldb.quit()
+        chess_db.quit()
+
+
+def bench_point_lookups(num_seasons=12, repeat=500):
+    """Per-command cost of point lookups, through pandas and through rows
+
+    A command like `claim_sub` makes a handful of single row lookups.  The
+    fast path runs them as they ship, the pandas path reads the very same
+    statements, traced from the fast path, with `pd.read_sql_query`.
+    """
+    import funcs_league as fle
+
+    chess_db = fcc.ChesscomDatabase(path=":memory:")
+    ldb = fle.LeagueDatabase(":memory:", chess_db, cache_reads=False)
+    gen_league(ldb, num_seasons=num_seasons, num_users=500)
+    for i in range(500):
+        chess_db._store_exists(f"player{i}", True)
+        chess_db._store_stats(f"player{i}", gen_stats(rapid=1000 + i))
+    chess_db.conn.commit()
+
+    sql = """
+    SELECT s.id, ss.name FROM seed AS s
+    JOIN week AS w ON s.week_id = w.id
+    JOIN season AS ss ON CAST(w.season_id AS integer) = ss.id
+    WHERE s.request = 1
+    ;"""
+    rng = random.Random(0)
+    seeds = ldb.conn.execute(sql).fetchall()
+    commands = [
+        (*rng.choice(seeds), 1000 + rng.randrange(500), f"player{rng.randrange(500)}")
+        for _ in range(repeat)
+    ]
+
+    def command(seed_id, season_name, discord_id, chesscom):
+        claim = ldb.get_claim_sub_from(seed_id)
+        chess_db.get_rating(claim.chesscom)
+        ldb.get_user_data(discord_id)
+        ldb.is_member(season_name, discord_id)
+        chess_db.get_exists(chesscom)
+        chess_db.get_rating(chesscom)
+
+    statements = []
+    for conn in [ldb.conn, chess_db.conn]:
+        conn.set_trace_callback(statements.append)
+    for args in commands:
+        command(*args)
+        statements.append(None)
+    for conn in [ldb.conn, chess_db.conn]:
+        conn.set_trace_callback(None)
+    first = statements.index(None)
+    per_command = statements.index(None, first + 1) - first - 1
+    statements = [q for q in statements if q is not None]
+    print(f"{per_command} statements per command")
+
+    start = time.time()
+    for q in statements:
+        pd.read_sql_query(q, ldb.conn if "chess AS c" not in q else chess_db.conn)
+    before = 1000 * (time.time() - start) / repeat
+    start = time.time()
+    for args in commands:
+        command(*args)
+    after = 1000 * (time.time() - start) / repeat
+    print(f"pandas: {before:.3f}ms per command")
+    print(f"rows:   {after:.3f}ms per command, {before / after:.1f}x faster")
+    ldb.quit()
+    chess_db.quit()
+
+
+def bench_pairing(team_sizes=(50, 200, 400), repeat=5, rematch_rate=0.1):
+    """Time to pair two teams exactly, a tenth of all games being rematches
+
+    `seed_games` used to hill climb 16 times for 4 seconds each.
+    """
+    import funcs_pairing as fpa
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    for size in team_sizes:
+        ratings_a = rng.integers(800, 2400, size)
+        ratings_b = rng.integers(800, 2400, size)
+        history = np.argwhere(rng.random((size, size)) < rematch_rate)
+        costs = fpa.pairing_costs(ratings_a, ratings_b, history)
+
+        start = time.time()
+        for _ in range(repeat):
+            _, _, score = fpa.best_pairing(costs)
+        elapsed = 1000 * (time.time() - start) / repeat
+        print(f"    {size} a side: {elapsed:.1f}ms, score {score:.0f}")
+
+
+def bench_season_plan(team_sizes=(50, 200, 400), weeks=4, rematch_rate=0.05):
+    """Time to plan a whole season, against pairing its weeks one by one
+
+    Week by week each pairing is exact, but only avoids the games of the
+    weeks before it, so later weeks can pay for the earlier ones.
+    """
+    import funcs_pairing as fpa
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    for size in team_sizes:
+        ratings_a = rng.integers(800, 2400, size)
+        ratings_b = rng.integers(800, 2400, size)
+        history = np.argwhere(rng.random((size, size)) < rematch_rate)
+        costs = fpa.pairing_costs(ratings_a, ratings_b, history)
+
+        start = time.time()
+        weekly_costs = costs.copy()
+        weekly_max = 0
+        for _ in range(weeks):
+            rows, cols, _ = fpa.best_pairing(weekly_costs)
+            weekly_max = max(weekly_max, weekly_costs[rows, cols].max())
+            weekly_costs[rows, cols] = np.inf
+        weekly = 1000 * (time.time() - start)
+
+        start = time.time()
+        max_gap, _ = fpa.season_pairings(costs, weeks)
+        planned = 1000 * (time.time() - start)
+        print(
+            f"    {size} a side: weekly {weekly:.0f}ms, largest gap {weekly_max:.0f};"
+            f" planned {planned:.0f}ms, largest gap {max_gap:.0f}"
+        )
+
+
+def bench_pairing_search(team_sizes=(20, 100, 400), seconds=1.0):
+    """Swaps scored per second by the rematch fallback search
+
+    Before: the old `seed_games` scoring, which rebuilt every board with
+    `iloc` and `itertuples` and looped over them for rematches.
+    After: `PairingSearch.swap`, updating the score in place.
+    """
+    import funcs_pairing as fpa
+    import numpy as np
+
+    rng = random.Random(0)
+    for size in team_sizes:
+        rant_df = pd.DataFrame(
+            {"rating": [rng.randint(800, 2400) for _ in range(size)]}
+        )
+        nort_df = pd.DataFrame(
+            {"rating": [rng.randint(800, 2400) for _ in range(size)]}
+        )
+        history = {(rng.randrange(size), rng.randrange(size)) for _ in range(size)}
+
+        def score_inds(rant_inds, nort_inds):
+            for r, n in zip(rant_inds, nort_inds):
+                if (int(r), int(n)) in history:
+                    return np.inf
+            rdf = rant_df.iloc[rant_inds]
+            ndf = nort_df.iloc[nort_inds]
+            scores = []
+            for rr, nr in zip(rdf.itertuples(), ndf.itertuples()):
+                scores.append((rr.rating - nr.rating) ** 2)
+            return 0.01 * int(np.mean(scores)) + max(scores)
+
+        inds = list(range(size))
+        count = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            x, y = rng.randrange(size), rng.randrange(size)
+            inds[x], inds[y] = inds[y], inds[x]
+            score_inds(list(range(size)), inds)
+            count += 1
+        before = count / (time.time() - start)
+
+        search = fpa.PairingSearch(rant_df["rating"], nort_df["rating"], history)
+        count = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            for _ in range(1000):
+                search.swap(rng.randrange(size), rng.randrange(size))
+            count += 1000
+        after = count / (time.time() - start)
+        print(
+            f"    {size} a side: {before:,.0f}/s before, {after:,.0f}/s after,"
+            f" {after / before:.0f}x"
+        )
+
+
+def bench_team_split(pool_sizes=(40, 200, 1000), num_teams=4, seconds=1.0):
+    """Candidate team splits scored per second by `even_split`
+
+    Before: `gen_split_score` slicing every team out of the DataFrame.
+    After: `TeamSplit.swap` updating two teams' running sums.
+    """
+    import funcs_league as fle
+
+    rng = random.Random(0)
+    for size in pool_sizes:
+        df = pd.DataFrame({"rating": [rng.randint(800, 2400) for _ in range(size)]})
+        splits = [list(range(size))[t::num_teams] for t in range(num_teams)]
+
+        def swaps():
+            a, b = rng.sample(range(num_teams), 2)
+            return a, rng.randrange(len(splits[a])), b, rng.randrange(len(splits[b]))
+
+        count = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            a, a_ind, b, b_ind = swaps()
+            splits[a][a_ind], splits[b][b_ind] = splits[b][b_ind], splits[a][a_ind]
+            fle.gen_split_score(df, splits)
+            count += 1
+        before = count / (time.time() - start)
+
+        split = fle.TeamSplit(df["rating"], splits)
+        count = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            for _ in range(1000):
+                split.swap(*swaps())
+            count += 1000
+        after = count / (time.time() - start)
+        print(
+            f"    {size} players: {before:,.0f}/s before, {after:,.0f}/s after,"
+            f" {after / before:.0f}x"
+        )
+
+
+BENCHMARKS = {
+    "http_pool": bench_http_pool,
+    "archive_scan": bench_archive_scan,
+    "league_indexes": bench_league_indexes,
+    "game_read_model": bench_game_read_model,
+    "point_lookups": bench_point_lookups,
+    "pairing": bench_pairing,
+    "season_plan": bench_season_plan,
+    "pairing_search": bench_pairing_search,
+    "team_split": bench_team_split,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}")
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,439 @@
+import codecs
 import datetime
 import json
+import logging
+import random
 import re
 import sqlite3
+import threading
 import time
 import urllib
 import urllib.error
 import urllib.request
+import zlib
 from asyncio import gather
+from concurrent.futures import Future, ThreadPoolExecutor
 from pprint import pformat, pprint
 
 import chessdotcom as cdc
 import chessdotcom.aio as cdc_aio
 import funcs_general as fgg
+import funcs_sqlite as fsq
+import numpy as np
 import pandas as pd
+import urllib3
 from chessdotcom.aio import Client as cdc_aio_client
 
 CHESSCOM_DB = "data/chesscom.sqlite3"
+CHESSCOM_API = "https://api.chess.com/pub"
+USER_AGENT = "grubberbot (https://github.com/vietd88/grubberbot)"
 
+LOGGER = logging.getLogger(__name__)
 
-def get_game_history_api(chesscom):
-    date = fgg.get_month(0, to_str=False)
-    url = (
-        f"https://api.chess.com/pub/player/{chesscom}/games/"
+# Connection pool settings shared by every chess.com request
+HTTP_POOL_SIZE = 8
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 20
+
+# Token bucket shared by every request, chess.com answers bursts with 429
+RATE_LIMIT = 5
+RATE_LIMIT_BURST = 10
+
+# 429, 5xx and connection errors are retried with jittered exponential
+# backoff starting at RETRY_BACKOFF seconds and capped at RETRY_BACKOFF_MAX
+RETRY_ATTEMPTS = 4
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 30
+
+# Monthly archives are parsed from the response in chunks of this many bytes
+# and written to the games mirror in batches of this many games
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+ARCHIVE_BATCH_SIZE = 500
+
+# One /stats request refreshes both the "count" and "rating" data
+REFRESH_KINDS = ["exists", "stats"]
+
+# (soft, hard) time to live in seconds for each kind of cached chess.com data.
+# Past the soft TTL a row is refreshed, past the hard TTL it is never served.
+CACHE_TTLS = {
+    "exists": (30 * 60, 7 * 24 * 60 * 60),
+    "count": (30 * 60, 24 * 60 * 60),
+    "rating": (30 * 60, 6 * 60 * 60),
+}
+
+# Usernames confirmed missing are answered from memory for this long, without
+# touching SQLite or chess.com, so repeated typos cost nothing
+NEGATIVE_TTL = 6 * 60 * 60
+
+RATING_COLUMNS = [
+    "rapid",
+    "blitz",
+    "bullet",
+    "rapid_last",
+    "blitz_last",
+    "bullet_last",
+    "rating_time",
+]
+COUNT_COLUMNS = [
+    "rapid_count",
+    "blitz_count",
+    "bullet_count",
+    "total_count",
+    "count_time",
+]
+
+# Column prefix for each time control in the /stats payload
+STATS_CATEGORIES = {
+    "rapid": "chess_rapid",
+    "blitz": "chess_blitz",
+    "bullet": "chess_bullet",
+    "daily": "chess_daily",
+    "daily960": "chess960_daily",
+}
+WDL_LIST = ["win", "draw", "loss"]
+
+# Columns added to the chess table after it was first created
+STATS_SCHEMA = {"daily": "integer", "daily_last": "integer"}
+STATS_SCHEMA.update({"daily960": "integer", "daily960_last": "integer"})
+STATS_SCHEMA.update({f"{c}_{r}": "integer" for c in STATS_CATEGORIES for r in WDL_LIST})
+STATS_SCHEMA.update({"stats_time": "integer", "stats_raw": "blob"})
+
+
+class ChesscomHTTPError(Exception):
+    def __init__(self, status, url):
+        super().__init__(f"chess.com returned HTTP {status} for {url}")
+        self.status = status
+        self.url = url
+
+
+class ChesscomNotFound(ChesscomHTTPError):
+    """The user or archive genuinely does not exist (404 or 410)"""
+
+
+class ChesscomUnavailable(ChesscomHTTPError):
+    """Rate limited, server or connection errors that outlasted every retry
+
+    `status` is None when no response was received.
+    """
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilling `rate` tokens a second to `capacity`
+
+    Callers reserve a token and sleep until it is theirs, so concurrent
+    callers are spaced out in arrival order.  `pause` holds every caller back,
+    e.g. for a 429 Retry-After.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated = clock()
+        self.paused_until = self.updated
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, returns the seconds to wait before using it"""
+        with self.lock:
+            now = self.clock()
+            elapsed = now - self.updated
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate, self.paused_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers with the same key
+
+    `stats["shared"]` counts the calls that piggybacked on another caller's
+    request instead of making their own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {"calls": 0, "shared": 0}
+
+    def do(self, key, func):
+        with self.lock:
+            self.stats["calls"] += 1
+            future = self.calls.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.calls[key] = future
+            else:
+                self.stats["shared"] += 1
+        if not owner:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return result
+
+
+def flight_key(path):
+    """Single-flight key `(endpoint, username)` for a chess.com API path"""
+    match = re.fullmatch(r"/player/([^/]+)(/.*)?", path)
+    if match is None:
+        return (path, None)
+    return (match.group(2) or "/", match.group(1).lower())
+
+
+def parse_retry_after(headers):
+    """Seconds from a Retry-After header, None if missing or an HTTP date"""
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class ChesscomClient:
+    """Keep-alive connection pool for the chess.com public API
+
+    At most `pool_size` connections are opened, callers beyond that wait for
+    a connection to be returned instead of opening a new one.  Every request
+    takes a token from `rate_limiter` and transient failures are retried up
+    to `retries` times.  `metrics` counts requests, retries and the seconds
+    spent throttled by the limiter or backing off.
+    """
+
+    def __init__(
+        self,
+        base_url=CHESSCOM_API,
+        pool_size=HTTP_POOL_SIZE,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        rate_limiter=None,
+        retries=RETRY_ATTEMPTS,
+        backoff=RETRY_BACKOFF,
+        backoff_max=RETRY_BACKOFF_MAX,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.prefix = urllib3.util.parse_url(self.base_url).path or ""
+        self.pool = urllib3.connection_from_url(
+            self.base_url,
+            maxsize=pool_size,
+            block=True,
+            timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout),
+            retries=False,
+            headers={"User-Agent": USER_AGENT},
+        )
+        self.flights = SingleFlight()
+        self.limiter = rate_limiter or TokenBucket(RATE_LIMIT, RATE_LIMIT_BURST)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.metrics_lock = threading.Lock()
+        self.metrics = {
+            "requests": 0,
+            "retries": 0,
+            "throttled_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+
+    def close(self):
+        self.pool.close()
+
+    def count(self, metric, value=1):
+        with self.metrics_lock:
+            self.metrics[metric] += value
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """Full jitter exponential backoff, at least `retry_after` seconds"""
+        cap = min(self.backoff_max, self.backoff * 2**attempt)
+        delay = random.uniform(0, cap)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def request(self, path, headers=None, preload_content=True):
+        url = self.prefix + path
+        headers = {**self.pool.headers, **(headers or {})}
+        for attempt in range(self.retries + 1):
+            self.count("throttled_seconds", self.limiter.acquire())
+            self.count("requests")
+            retry_after = None
+            try:
+                response = self.pool.request(
+                    "GET", url, headers=headers, preload_content=preload_content
+                )
+            except urllib3.exceptions.HTTPError as e:
+                error = ChesscomUnavailable(None, self.base_url + path)
+                error.__cause__ = e
+            else:
+                if response.status < 400:
+                    return response
+                response.drain_conn()
+                response.release_conn()
+                if response.status in [404, 410]:
+                    raise ChesscomNotFound(response.status, self.base_url + path)
+                if response.status != 429 and response.status < 500:
+                    raise ChesscomHTTPError(response.status, self.base_url + path)
+                error = ChesscomUnavailable(response.status, self.base_url + path)
+                if response.status == 429:
+                    retry_after = parse_retry_after(response.headers)
+                    if retry_after is not None:
+                        self.limiter.pause(retry_after)
+
+            if attempt == self.retries:
+                raise error
+            delay = self.backoff_delay(attempt, retry_after)
+            self.count("retries")
+            self.count("backoff_seconds", delay)
+            time.sleep(delay)
+
+    def get(self, path):
+        return self.request(path).data
+
+    def get_json(self, path):
+        """Concurrent requests for the same endpoint and user share one fetch"""
+        return self.flights.do(flight_key(path), lambda: json.loads(self.get(path)))
+
+    def open_archive(self, path, etag=None):
+        """Start streaming a monthly archive, returns `(response, etag)`
+
+        `response` is None if the archive still matches `etag`.  Streamed
+        responses can't be shared so they skip the single flight.
+        """
+        headers = {"If-None-Match": etag} if etag else {}
+        response = self.request(path, headers=headers, preload_content=False)
+        if response.status == 304:
+            response.drain_conn()
+            response.release_conn()
+            return None, etag
+        return response, response.headers.get("ETag")
+
+
+CLIENT = ChesscomClient()
+
+
+def archive_path(chesscom, date):
+    return (
+        f"/player/{chesscom}/games/"
         f"{str(date.year).zfill(4)}/{str(date.month).zfill(2)}"
     )
-    with urllib.request.urlopen(url) as response:
-        info = response.read()
-    info = json.loads(info)
-    games = info["games"]
-
-    if int(date.day) in [1, 2]:
-        date = fgg.get_month(-1, to_str=False)
-        url = (
-            f"https://api.chess.com/pub/player/{chesscom}/games/"
-            f"{str(date.year).zfill(4)}/{str(date.month).zfill(2)}"
-        )
-        with urllib.request.urlopen(url) as response:
-            info = response.read()
-        info = json.loads(info)
+
+
+def archive_months():
+    """Monthly archives that may hold a game played for the current week"""
+    months = [fgg.get_month(0, to_str=False)]
+    if int(datetime.datetime.now().day) in [1, 2]:
+        months.append(fgg.get_month(-1, to_str=False))
+    return months
+
+
+def iter_json_array(chunks, key):
+    """Yield the items of the top level array `key` from chunks of JSON bytes
+
+    Only the item being parsed and one chunk are held in memory.
+    """
+    chunks = iter(chunks)
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    decoder = json.JSONDecoder()
+    buffer, pos = "", 0
+
+    def more():
+        nonlocal buffer, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buffer, pos = buffer[pos:] + utf8.decode(chunk), 0
+        return True
+
+    array_start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    match = array_start.search(buffer)
+    while match is None:
+        if not more():
+            return
+        match = array_start.search(buffer)
+    pos = match.end()
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buffer):
+            if not more():
+                raise ValueError(f"Truncated JSON array {key}")
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if not more():
+                raise
+            continue
+        yield item
+
+
+def iter_archive_games(response, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """Yield games from a streamed archive response, then free the connection
+
+    If the caller stops early the rest of the body is not downloaded, the
+    connection is closed instead.
+    """
+    complete = False
+    try:
+        yield from iter_json_array(response.stream(chunk_size), "games")
+        complete = True
+    finally:
+        if complete:
+            response.drain_conn()
+        else:
+            response.close()
+        response.release_conn()
+
+
+def iter_game_history_api(chesscom, client=None):
+    client = client or CLIENT
+    for date in archive_months():
+        response, _ = client.open_archive(archive_path(chesscom, date))
+        yield from iter_archive_games(response)
+
+
+def find_game_api(chesscom, cc_game_id, client=None):
+    """Scan recent archives of `chesscom`, stopping at game `cc_game_id`"""
+    games = iter_game_history_api(chesscom, client=client)
+    needle = str(cc_game_id)
+    try:
+        for game in games:
+            if needle not in game["url"]:
+                continue
+            if game_id_from_url(game["url"]) == cc_game_id:
+                return game
+    finally:
+        games.close()
+    return None
+
+
+def get_game_history_api(chesscom, client=None):
+    client = client or CLIENT
+    games = []
+    for date in archive_months():
+        info = client.get_json(archive_path(chesscom, date))
         games = games + info["games"]
     return games
 
@@ -75,6 +471,92 @@ async def get_game_history_async(chesscom):
     return games
 
 
+def parse_counts(info, fetch_time=None):
+    categories = [
+        "chess_rapid",
+        # 'lessons',
+        # 'tactics',
+        "chess960_daily",
+        "chess_blitz",
+        # 'puzzle_rush',
+        "chess_bullet",
+        "chess_daily",
+        # 'fide',
+    ]
+    wdl_list = ["win", "draw", "loss"]
+
+    output = {}
+    for category in categories:
+        try:
+            wdl = info[category]["record"]
+        except KeyError:
+            wdl = {"win": 0, "draw": 0, "loss": 0}
+        val = sum([v for k, v in wdl.items() if k in wdl_list])
+        output[category] = val
+
+    new_output = {}
+    new_output["rapid_count"] = output["chess_rapid"]
+    new_output["blitz_count"] = output["chess_blitz"]
+    new_output["bullet_count"] = output["chess_bullet"]
+    new_output["total_count"] = sum([v for k, v in output.items()])
+    new_output["count_time"] = fetch_time or time.time()
+    output = new_output
+    return output
+
+
+def parse_ratings(info, fetch_time=None):
+    names = {
+        "rapid": ["chess_rapid", "last", "rating"],
+        "blitz": ["chess_blitz", "last", "rating"],
+        "bullet": ["chess_bullet", "last", "rating"],
+        "rapid_last": ["chess_rapid", "last", "date"],
+        "blitz_last": ["chess_blitz", "last", "date"],
+        "bullet_last": ["chess_bullet", "last", "date"],
+    }
+    output = {}
+    for k, v in names.items():
+        try:
+            val = info[v[0]][v[1]][v[2]]  # if not KeyError else None
+        except KeyError:
+            val = None
+        output[k] = val
+    output["rating_time"] = fetch_time or time.time()
+    return output
+
+
+def parse_stats(info, fetch_time=None):
+    """Every derived column of the chess table from one /stats payload"""
+    fetch_time = fetch_time or time.time()
+    output = {}
+    for name, category in STATS_CATEGORIES.items():
+        last = info.get(category, {}).get("last", {})
+        record = info.get(category, {}).get("record", {})
+        output[name] = last.get("rating")
+        output[f"{name}_last"] = last.get("date")
+        for result in WDL_LIST:
+            output[f"{name}_{result}"] = record.get(result, 0)
+    output.update(parse_ratings(info, fetch_time))
+    output.update(parse_counts(info, fetch_time))
+    output["stats_time"] = fetch_time
+    return output
+
+
+def compress_game(game):
+    return zlib.compress(json.dumps(game).encode())
+
+
+def decompress_game(raw):
+    return json.loads(zlib.decompress(raw))
+
+
+def compress_stats(info):
+    return zlib.compress(json.dumps(info).encode())
+
+
+def decompress_stats(raw):
+    return json.loads(zlib.decompress(raw))
+
+
 def game_id_from_url(url):
     integers = [int(i[0]) for i in re.finditer(r"[\d]+", url)]
     if len(integers) == 0:
@@ -83,26 +565,142 @@ def game_id_from_url(url):
     return cc_game_id
 
 
+class NegativeCache:
+    """Usernames known not to exist on chess.com, each with an expiry time
+
+    Names are matched case-insensitively like chess.com usernames.  An exact
+    dict rather than a bloom filter, a false positive would reject a real
+    user.
+    """
+
+    def __init__(self, ttl=NEGATIVE_TTL, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.expiry = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+        # Checked and updated from the executor threads at once
+        self.lock = threading.Lock()
+
+    def add(self, chesscom, added_time=None):
+        added_time = self.clock() if added_time is None else added_time
+        with self.lock:
+            self.expiry[chesscom.lower()] = added_time + self.ttl
+
+    def discard(self, chesscom):
+        with self.lock:
+            self.expiry.pop(chesscom.lower(), None)
+
+    def __contains__(self, chesscom):
+        key = chesscom.lower()
+        now = self.clock()
+        with self.lock:
+            expiry = self.expiry.get(key)
+            if expiry is not None and expiry <= now:
+                self.expiry.pop(key, None)
+                expiry = None
+            self.stats["misses" if expiry is None else "hits"] += 1
+        return expiry is not None
+
+    def __len__(self):
+        return len(self.expiry)
+
+
 class ChesscomDatabase:
-    def __init__(self, path=CHESSCOM_DB, wait_time=(30 * 60)):
+    def __init__(
+        self,
+        path=CHESSCOM_DB,
+        wait_time=None,
+        client=None,
+        ttls=None,
+        stale_while_revalidate=False,
+        negative_ttl=NEGATIVE_TTL,
+    ):
         self.path = path
-        self.conn = sqlite3.connect(self.path)
+        self.client = client or CLIENT
+        self.pool = fsq.ConnectionPool(self.path)
+        self.conn = self.pool.writer
         self.cur = self.conn.cursor()
         self.conn.execute("PRAGMA foreign_keys = 1")
         self.conn.commit()
         self.init_tables()
-        self.wait_time = wait_time
+
+        # Held around SQLite access only, never while waiting on chess.com
+        self.lock = threading.RLock()
+
+        # wait_time overrides the soft TTL of every kind of data
+        self.ttls = dict(CACHE_TTLS)
+        self.ttls.update(ttls or {})
+        if wait_time is not None:
+            self.ttls = {
+                k: (wait_time, max(wait_time, v[1])) for k, v in self.ttls.items()
+            }
+
+        # Stale rows are refreshed in the background, results are written to
+        # the database by the owning thread in drain_refreshes
+        self.stale_while_revalidate = stale_while_revalidate
+        self.executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE)
+        self.pending = {}
+
+        # Warm the negative cache from lookups made before a restart
+        self.missing = NegativeCache(negative_ttl)
+        sql = """
+        SELECT c.chesscom, c.exists_time FROM chess AS c
+        WHERE c.exists_user = 0 AND c.exists_time > ?
+        ;"""
+        for chesscom, exists_time in self.cur.execute(
+            sql, (time.time() - negative_ttl,)
+        ):
+            self.missing.add(chesscom, exists_time)
 
     def quit(self):
-        self.conn.close()
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+    def cache_state(self, kind, kind_time):
+        """Classify data fetched at `kind_time` as fresh, stale or expired"""
+        soft, hard = self.ttls[kind]
+        if kind_time is None or pd.isna(kind_time):
+            return "expired"
+        age = time.time() - kind_time
+        if age <= soft:
+            return "fresh"
+        if self.stale_while_revalidate and age <= hard:
+            return "stale"
+        return "expired"
+
+    def revalidate(self, chesscom, kind):
+        key = (chesscom, kind)
+        with self.lock:
+            if key not in self.pending:
+                self.pending[key] = self.executor.submit(
+                    self._fetch_refresh, chesscom, kind
+                )
+
+    def drain_refreshes(self):
+        with self.lock:
+            done = [k for k, f in self.pending.items() if f.done()]
+            if len(done) == 0:
+                return
+            plan, results = [], []
+            for key in done:
+                future = self.pending.pop(key)
+                if future.exception() is not None:
+                    LOGGER.warning(
+                        "refresh %s failed", key, exc_info=future.exception()
+                    )
+                    continue
+                plan.append(key)
+                results.append(future.result())
+            self.store_refresh(plan, results)
 
     def get_all_tables(self):
         sql = "SELECT name FROM sqlite_master WHERE type='table';"
-        output = self.conn.execute(sql)
         df_dict = {}
-        for table in output.fetchall():
-            df = pd.read_sql_query(f"SELECT * FROM {table[0]}", self.conn)
-            df_dict[table[0]] = df
+        with self.pool.reader() as conn:
+            for table in conn.execute(sql).fetchall():
+                df = pd.read_sql_query(f"SELECT * FROM {table[0]}", conn)
+                df_dict[table[0]] = df
         return df_dict
 
     def init_tables(self):
@@ -132,21 +730,63 @@ def init_tables(self):
         );"""
         # TODO: Force users in a game to also be in the season
 
+        # Local mirror of chess.com monthly game archives, id is the chess.com
+        # game id and raw is the compressed game json
+        games_tbl_sql = """
+        CREATE TABLE IF NOT EXISTS games(
+            id integer PRIMARY KEY,
+            url text NOT NULL,
+            white text NOT NULL,
+            black text NOT NULL,
+            white_result text,
+            black_result text,
+            time_control text,
+            rated integer,
+            end_time integer,
+            raw blob NOT NULL
+        );"""
+        games_white_idx_sql = """
+        CREATE INDEX IF NOT EXISTS games_white_idx ON games(white, end_time)
+        ;"""
+        games_black_idx_sql = """
+        CREATE INDEX IF NOT EXISTS games_black_idx ON games(black, end_time)
+        ;"""
+
+        # Sync state per player and month, chesscom is lowercase
+        archive_sync_tbl_sql = """
+        CREATE TABLE IF NOT EXISTS archive_sync(
+            chesscom text NOT NULL,
+            month text NOT NULL,
+            last_end_time integer,
+            etag text,
+            sync_time integer,
+            PRIMARY KEY(chesscom, month)
+        );"""
+
         queries = [
             chess_tbl_sql,
+            games_tbl_sql,
+            games_white_idx_sql,
+            games_black_idx_sql,
+            archive_sync_tbl_sql,
         ]
         for query in queries:
             self.cur.execute(query)
+
+        # Add stats columns to databases created before they existed
+        columns = [row[1] for row in self.cur.execute("PRAGMA table_info(chess)")]
+        for column, column_type in STATS_SCHEMA.items():
+            if column not in columns:
+                self.cur.execute(f"ALTER TABLE chess ADD COLUMN {column} {column_type}")
         self.conn.commit()
 
     def _set_exists(self, chesscom, return_message=False):
-        url = f"https://api.chess.com/pub/player/{chesscom}"
+        # Only a genuine 404 means the user doesn't exist, transient failures
+        # propagate so they are never recorded as a missing user
         try:
-            with urllib.request.urlopen(url) as response:
-                info = response.read()
-        except urllib.error.HTTPError:
+            info = self.client.get_json(f"/player/{chesscom}")
+        except ChesscomNotFound:
             return False
-        info = json.loads(info)
 
         if return_message:
             return info
@@ -159,6 +799,12 @@ def _set_exists(self, chesscom, return_message=False):
 
     def set_exists(self, chesscom):
         exists_user = self._set_exists(chesscom)
+        with self.lock:
+            self._store_exists(chesscom, exists_user)
+            self.conn.commit()
+        return exists_user
+
+    def _store_exists(self, chesscom, exists_user):
         exists_time = time.time()
         sql = """
         INSERT INTO chess(chesscom, exists_user, exists_time) VALUES(?, ?, ?)
@@ -174,8 +820,10 @@ def set_exists(self, chesscom):
             chesscom,
         )
         self.cur.execute(sql, params)
-        self.conn.commit()
-        return exists_user
+        if exists_user:
+            self.missing.discard(chesscom)
+        else:
+            self.missing.add(chesscom, exists_time)
 
     def get_exists(self, chesscom):
         sql = """
@@ -183,81 +831,77 @@ def get_exists(self, chesscom):
         WHERE c.chesscom = ?
         ;"""
         params = (chesscom,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
+        self.drain_refreshes()
+        if chesscom in self.missing:
+            return False
+        with self.lock:
+            row = fsq.fetch_one(self.conn, sql, params)
 
-        if len(df) == 0 or (time.time() - df["exists_time"][0] > self.wait_time):
+        state = self.cache_state("exists", row[1] if row else None)
+        if state == "expired":
             return self.set_exists(chesscom)
-        else:
-            return df["exists_user"][0]
+        if state == "stale":
+            self.revalidate(chesscom, "exists")
+        return row[0]
 
-    def _set_count(self, chesscom):
+    def _set_stats(self, chesscom):
         exists = self.get_exists(chesscom)
         if exists is None or not exists:
             return None
 
-        url = f"https://api.chess.com/pub/player/{chesscom}/stats"
-        with urllib.request.urlopen(url) as response:
-            info = response.read()
-        info = json.loads(info)
-
-        categories = [
-            "chess_rapid",
-            # 'lessons',
-            # 'tactics',
-            "chess960_daily",
-            "chess_blitz",
-            # 'puzzle_rush',
-            "chess_bullet",
-            "chess_daily",
-            # 'fide',
-        ]
-        wdl_list = ["win", "draw", "loss"]
+        info = self.client.get_json(f"/player/{chesscom}/stats")
+        return info
 
-        output = {}
-        for category in categories:
-            try:
-                wdl = info[category]["record"]
-            except KeyError:
-                wdl = {"win": 0, "draw": 0, "loss": 0}
-            val = sum([v for k, v in wdl.items() if k in wdl_list])
-            output[category] = val
-
-        new_output = {}
-        new_output["rapid_count"] = output["chess_rapid"]
-        new_output["blitz_count"] = output["chess_blitz"]
-        new_output["bullet_count"] = output["chess_bullet"]
-        new_output["total_count"] = sum([v for k, v in output.items()])
-        new_output["count_time"] = time.time()
-        output = new_output
-        return output
+    def _fetch_stats(self, chesscom, check_exists):
+        """Network half of set_exists and set_stats, safe to run in a thread"""
+        exists_user = self._set_exists(chesscom) if check_exists else True
+        if not exists_user:
+            return exists_user, None
+        info = self.client.get_json(f"/player/{chesscom}/stats")
+        return exists_user, info
 
-    def set_count(self, chesscom):
-        exists = self.get_exists(chesscom)
-        if exists is None or not exists:
+    def set_stats(self, chesscom):
+        info = self._set_stats(chesscom)
+        if info is None:
             return None
+        with self.lock:
+            stats = self._store_stats(chesscom, info)
+            self.conn.commit()
+        return stats
 
-        sql = """
+    def _store_stats(self, chesscom, info, fetch_time=None):
+        """Write every derived column and the compressed payload at once"""
+        stats = parse_stats(info, fetch_time)
+        columns = list(stats)
+        assignments = ",\n".join(f"{c} = ?" for c in columns + ["stats_raw"])
+        sql = f"""
         UPDATE chess SET
-            rapid_count = ?,
-            blitz_count = ?,
-            bullet_count = ?,
-            total_count = ?,
-            count_time = ?
+            {assignments}
         WHERE chess.chesscom = ?
         ;"""
-
-        info = self._set_count(chesscom)
-        params = (
-            info["rapid_count"],
-            info["blitz_count"],
-            info["bullet_count"],
-            info["total_count"],
-            info["count_time"],
-            chesscom,
-        )
+        params = [stats[c] for c in columns] + [compress_stats(info), chesscom]
         self.cur.execute(sql, params)
-        self.conn.commit()
-        return info
+        self.missing.discard(chesscom)
+        return stats
+
+    def backfill_stats(self):
+        """Recompute derived columns from the stored payloads, without fetching"""
+        sql = """
+        SELECT c.chesscom, c.stats_time, c.stats_raw FROM chess AS c
+        WHERE c.stats_raw IS NOT NULL
+        ;"""
+        with self.lock:
+            rows = self.cur.execute(sql).fetchall()
+            for chesscom, stats_time, stats_raw in rows:
+                self._store_stats(chesscom, decompress_stats(stats_raw), stats_time)
+            self.conn.commit()
+        return len(rows)
+
+    def set_count(self, chesscom):
+        stats = self.set_stats(chesscom)
+        if stats is None:
+            return None
+        return {c: stats[c] for c in COUNT_COLUMNS}
 
     def get_count(self, chesscom):
         exists = self.get_exists(chesscom)
@@ -275,71 +919,22 @@ def get_count(self, chesscom):
         WHERE c.chesscom = ? AND c.count_time IS NOT NULL
         ;"""
         params = (chesscom,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
+        with self.lock:
+            row = fsq.fetch_one(self.conn, sql, params)
 
-        if len(df) == 0 or (time.time() - df["count_time"][0] > self.wait_time):
+        state = self.cache_state("count", row[-1] if row else None)
+        if state == "expired":
             return self.set_count(chesscom)
-        else:
-            info = {str(c): df[c][0] for c in df.columns}
-            return info
-
-    def _set_rating(self, chesscom):
-        exists = self.get_exists(chesscom)
-        if exists is None or not exists:
-            return None
-
-        url = f"https://api.chess.com/pub/player/{chesscom}/stats"
-        with urllib.request.urlopen(url) as response:
-            info = response.read()
-        info = json.loads(info)
-        names = {
-            "rapid": ["chess_rapid", "last", "rating"],
-            "blitz": ["chess_blitz", "last", "rating"],
-            "bullet": ["chess_bullet", "last", "rating"],
-            "rapid_last": ["chess_rapid", "last", "date"],
-            "blitz_last": ["chess_blitz", "last", "date"],
-            "bullet_last": ["chess_bullet", "last", "date"],
-        }
-        output = {}
-        for k, v in names.items():
-            try:
-                val = info[v[0]][v[1]][v[2]]  # if not KeyError else None
-            except KeyError:
-                val = None
-            output[k] = val
-        output["rating_time"] = time.time()
-        return output
+        if state == "stale":
+            self.revalidate(chesscom, "stats")
+        info = dict(zip(COUNT_COLUMNS, row))
+        return info
 
     def set_rating(self, chesscom):
-        exists = self.get_exists(chesscom)
-        if exists is None or not exists:
+        stats = self.set_stats(chesscom)
+        if stats is None:
             return None
-
-        sql = """
-        UPDATE chess SET
-            rapid = ?,
-            blitz = ?,
-            bullet = ?,
-            rapid_last = ?,
-            blitz_last = ?,
-            bullet_last = ?,
-            rating_time = ?
-        WHERE chess.chesscom = ?
-        ;"""
-        info = self._set_rating(chesscom)
-        params = (
-            info["rapid"],
-            info["blitz"],
-            info["bullet"],
-            info["rapid_last"],
-            info["blitz_last"],
-            info["bullet_last"],
-            info["rating_time"],
-            chesscom,
-        )
-        self.cur.execute(sql, params)
-        self.conn.commit()
-        return info
+        return {c: stats[c] for c in RATING_COLUMNS}
 
     def get_rating(self, chesscom):
         exists = self.get_exists(chesscom)
@@ -359,13 +954,356 @@ def get_rating(self, chesscom):
         WHERE c.chesscom = ? AND c.rating_time IS NOT NULL
         ;"""
         params = (chesscom,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
+        with self.lock:
+            row = fsq.fetch_one(self.conn, sql, params)
 
-        if len(df) == 0 or (time.time() - df["rating_time"][0] > self.wait_time):
+        state = self.cache_state("rating", row[-1] if row else None)
+        if state == "expired":
             return self.set_rating(chesscom)
-        else:
-            info = {str(c): df[c][0] for c in df.columns}
-            return info
+        if state == "stale":
+            self.revalidate(chesscom, "stats")
+        info = dict(zip(RATING_COLUMNS, row))
+        return info
+
+    def _query_ratings(self, chesscoms):
+        dfs = []
+        for chunk in fsq.in_chunks(chesscoms):
+            sql = f"""
+            SELECT
+                c.chesscom,
+                c.exists_user,
+                c.exists_time,
+                c.rapid,
+                c.blitz,
+                c.bullet,
+                c.rapid_last,
+                c.blitz_last,
+                c.bullet_last,
+                c.rating_time
+            FROM chess AS c
+            WHERE c.chesscom IN ({fsq.in_list(chunk)})
+            ;"""
+            with self.lock:
+                dfs.append(pd.read_sql_query(sql, self.conn, params=chunk))
+        return pd.concat(dfs, ignore_index=True).set_index("chesscom")
+
+    def refresh_ratings(self, chesscoms):
+        """Fetch the users of `chesscoms` whose cached rating has expired
+
+        Afterwards the chess table can be read, or joined from another
+        database, instead of calling get_ratings.  Returns how many users were
+        fetched, zero means the cached rows were already current.
+        """
+        chesscoms = list(dict.fromkeys(c for c in chesscoms if isinstance(c, str)))
+        return len(self._refresh_ratings(chesscoms)[1])
+
+    def _refresh_ratings(self, chesscoms):
+        self.drain_refreshes()
+        lookup = [c for c in chesscoms if c not in self.missing]
+        df = self._query_ratings(lookup)
+        stale = []
+        for chesscom in lookup:
+            if chesscom not in df.index:
+                stale.append((chesscom, True))
+                continue
+            row = df.loc[chesscom]
+            exists_state = self.cache_state("exists", row["exists_time"])
+            if exists_state == "expired":
+                stale.append((chesscom, True))
+                continue
+            if exists_state == "stale":
+                self.revalidate(chesscom, "exists")
+            if not row["exists_user"]:
+                continue
+            rating_state = self.cache_state("rating", row["rating_time"])
+            if rating_state == "expired":
+                stale.append((chesscom, False))
+            elif rating_state == "stale":
+                self.revalidate(chesscom, "stats")
+
+        # Fetch stale users concurrently, but write from this thread only
+        if stale:
+            results = list(
+                self.executor.map(lambda args: self._fetch_stats(*args), stale)
+            )
+            with self.lock:
+                for (chesscom, check_exists), (exists_user, info) in zip(
+                    stale, results
+                ):
+                    if check_exists:
+                        self._store_exists(chesscom, exists_user)
+                    if info is not None:
+                        self._store_stats(chesscom, info)
+                self.conn.commit()
+            df = self._query_ratings(lookup)
+        return df, stale
+
+    def get_ratings(self, chesscoms):
+        """Batch version of get_rating
+
+        Returns a DataFrame indexed by chesscom with the `RATING_COLUMNS`, so
+        callers can attach ratings with `df["chesscom"].map(ratings["rapid"])`.
+        Usernames that do not exist on chess.com get NaN ratings.
+        """
+        chesscoms = list(dict.fromkeys(c for c in chesscoms if isinstance(c, str)))
+        if len(chesscoms) == 0:
+            return pd.DataFrame(columns=RATING_COLUMNS)
+
+        df, _ = self._refresh_ratings(chesscoms)
+        df = df[df["exists_user"] == 1]
+        return df[RATING_COLUMNS].reindex(chesscoms)
+
+    def _store_games(self, games):
+        sql = """
+        INSERT OR IGNORE INTO games(
+            id,
+            url,
+            white,
+            black,
+            white_result,
+            black_result,
+            time_control,
+            rated,
+            end_time,
+            raw
+        )
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ;"""
+        rows = [
+            (
+                game_id_from_url(game["url"]),
+                game["url"],
+                game["white"]["username"].lower(),
+                game["black"]["username"].lower(),
+                game["white"].get("result"),
+                game["black"].get("result"),
+                game.get("time_control"),
+                game.get("rated"),
+                game.get("end_time"),
+                compress_game(game),
+            )
+            for game in games
+        ]
+        with self.lock:
+            self.cur.executemany(sql, rows)
+            self.conn.commit()
+
+    def _sync_archive(self, response, last_end_time, until_game_id=None):
+        """Store games newer than `last_end_time` from a streamed archive
+
+        Archives are in chronological order, so when `until_game_id` is given
+        the download stops as soon as that game is stored.  Returns
+        `(added, last_end_time, found)`.
+        """
+        games = iter_archive_games(response)
+        batch, added, found = [], 0, False
+        try:
+            for game in games:
+                if game["end_time"] < last_end_time:
+                    continue
+                batch.append(game)
+                last_end_time = game["end_time"]
+                if len(batch) >= ARCHIVE_BATCH_SIZE:
+                    self._store_games(batch)
+                    added, batch = added + len(batch), []
+                if until_game_id is not None:
+                    if game_id_from_url(game["url"]) == until_game_id:
+                        found = True
+                        break
+        finally:
+            games.close()
+        self._store_games(batch)
+        return added + len(batch), last_end_time, found
+
+    def sync_archives(self, chesscom, months=None, until_game_id=None):
+        """Pull new games for `chesscom` into the local games mirror
+
+        Months that were synced after they ended are never fetched again, and
+        the current month is only downloaded again when its ETag changed.
+        With `until_game_id` the sync stops once that game is stored and the
+        month is marked unsynced so the rest of it is fetched next time.
+        Returns the number of games added.
+        """
+        chesscom = chesscom.lower()
+        months = archive_months() if months is None else months
+        sql = """
+        SELECT a.last_end_time, a.etag, a.sync_time FROM archive_sync AS a
+        WHERE a.chesscom = ? AND a.month = ?
+        ;"""
+        update_sql = """
+        INSERT OR REPLACE INTO archive_sync(
+            chesscom, month, last_end_time, etag, sync_time
+        )
+        VALUES(?, ?, ?, ?, ?)
+        ;"""
+        added = 0
+        for date in months:
+            month = f"{str(date.year).zfill(4)}/{str(date.month).zfill(2)}"
+            month_end = datetime.datetime(
+                date.year + date.month // 12, date.month % 12 + 1, 1
+            ).timestamp()
+            with self.lock:
+                row = self.cur.execute(sql, (chesscom, month)).fetchone()
+            last_end_time, etag, sync_time = row or (0, None, None)
+            if sync_time is not None and sync_time > month_end:
+                continue
+
+            response, etag = self.client.open_archive(
+                archive_path(chesscom, date), etag
+            )
+            found = False
+            if response is not None:
+                num_games, last_end_time, found = self._sync_archive(
+                    response, last_end_time, until_game_id
+                )
+                added += num_games
+            etag, sync_time = (None, None) if found else (etag, time.time())
+            params = (chesscom, month, last_end_time, etag, sync_time)
+            with self.lock:
+                self.cur.execute(update_sql, params)
+                self.conn.commit()
+            if found:
+                break
+        return added
+
+    def _query_game(self, chesscom, cc_game_id):
+        sql = """
+        SELECT g.raw FROM games AS g
+        WHERE g.id = ? AND (g.white = ? OR g.black = ?)
+        ;"""
+        params = (cc_game_id, chesscom.lower(), chesscom.lower())
+        with self.lock:
+            row = self.cur.execute(sql, params).fetchone()
+        return None if row is None else decompress_game(row[0])
+
+    def find_game(self, chesscom, cc_game_id):
+        """Look up a game played by `chesscom`, syncing its archive on a miss"""
+        game = self._query_game(chesscom, cc_game_id)
+        if game is None:
+            self.sync_archives(chesscom, until_game_id=cc_game_id)
+            game = self._query_game(chesscom, cc_game_id)
+        return game
+
+    def get_player_games(self, chesscom, start_time=0):
+        sql = """
+        SELECT g.raw FROM games AS g WHERE g.white = ? AND g.end_time >= ?
+        UNION ALL
+        SELECT g.raw FROM games AS g WHERE g.black = ? AND g.end_time >= ?
+        ;"""
+        params = (chesscom.lower(), start_time, chesscom.lower(), start_time)
+        with self.lock:
+            rows = self.cur.execute(sql, params).fetchall()
+        games = [decompress_game(row[0]) for row in rows]
+        return sorted(games, key=lambda g: g["end_time"])
+
+    def plan_refresh(self, chesscoms, lead_time=0, budget=None):
+        """List the `(chesscom, kind)` refreshes due within `lead_time` seconds
+
+        `kind` is one of `REFRESH_KINDS`.  The soonest expiring entries come
+        first and the plan holds at most `budget` requests.  Usernames in the
+        negative cache are left out.
+        """
+        self.drain_refreshes()
+        chesscoms = list(dict.fromkeys(c for c in chesscoms if isinstance(c, str)))
+        chesscoms = [c for c in chesscoms if c not in self.missing]
+        if len(chesscoms) == 0:
+            return []
+        dfs = []
+        for chunk in fsq.in_chunks(chesscoms):
+            sql = f"""
+            SELECT
+                c.chesscom,
+                c.exists_user,
+                c.exists_time,
+                c.count_time,
+                c.rating_time
+            FROM chess AS c
+            WHERE c.chesscom IN ({fsq.in_list(chunk)})
+            ;"""
+            with self.lock:
+                dfs.append(pd.read_sql_query(sql, self.conn, params=chunk))
+        df = pd.concat(dfs, ignore_index=True).set_index("chesscom")
+        for col in ["exists_time", "count_time", "rating_time"]:
+            df[col] = df[col].astype(float)
+
+        # Order refreshes by the time the data goes past its soft TTL
+        deadline = time.time() + lead_time
+        due = []
+        for chesscom in chesscoms:
+            if chesscom not in df.index:
+                due.append((-np.inf, chesscom, "exists"))
+                continue
+            row = df.loc[chesscom]
+            exists_expiry = row["exists_time"] + self.ttls["exists"][0]
+            exists_due = exists_expiry < deadline
+            if exists_due:
+                due.append((exists_expiry, chesscom, "exists"))
+            elif not row["exists_user"]:
+                continue
+
+            # Stats are due as soon as either the counts or the ratings are,
+            # but never before the user is known to still exist
+            expiries = [
+                row["count_time"] + self.ttls["count"][0],
+                row["rating_time"] + self.ttls["rating"][0],
+            ]
+            expiry = -np.inf if any(pd.isna(e) for e in expiries) else min(expiries)
+            if expiry < deadline:
+                if exists_due:
+                    expiry = max(expiry, exists_expiry)
+                due.append((expiry, chesscom, "stats"))
+
+        due = sorted(due, key=lambda x: (x[0], REFRESH_KINDS.index(x[2])))
+        plan = [(chesscom, kind) for _, chesscom, kind in due]
+        if budget is not None:
+            plan = plan[:budget]
+        return plan
+
+    def _fetch_refresh(self, chesscom, kind):
+        if kind == "exists":
+            return self._set_exists(chesscom)
+        return self.client.get_json(f"/player/{chesscom}/stats")
+
+    def fetch_refresh(self, plan):
+        """Network half of a refresh plan, safe to run outside the owning thread
+
+        Failed fetches come back as None and are skipped by `store_refresh`.
+        """
+        results = []
+        missing = set()
+        for chesscom, kind in plan:
+            if chesscom in missing:
+                results.append(None)
+                continue
+            try:
+                result = self._fetch_refresh(chesscom, kind)
+            except ChesscomHTTPError:
+                LOGGER.warning(
+                    "refresh %s failed for %s", kind, chesscom, exc_info=True
+                )
+                result = None
+            if kind == "exists" and not result:
+                missing.add(chesscom)
+            results.append(result)
+        return results
+
+    def store_refresh(self, plan, results):
+        store = {
+            "exists": self._store_exists,
+            "stats": self._store_stats,
+        }
+        with self.lock:
+            for (chesscom, kind), result in zip(plan, results):
+                if result is None:
+                    continue
+                store[kind](chesscom, result)
+            self.conn.commit()
+
+    def prewarm(self, chesscoms, lead_time=0, budget=None):
+        plan = self.plan_refresh(chesscoms, lead_time=lead_time, budget=budget)
+        results = self.fetch_refresh(plan)
+        self.store_refresh(plan, results)
+        return plan
 
 
 if __name__ == "__main__":
@@ -1,8 +1,10 @@
+import asyncio
 import datetime
 import logging
 import os
 import re
 import subprocess
+import tempfile
 from pprint import pformat, pprint
 from typing import Optional
 
@@ -11,6 +13,7 @@
 import funcs_general as fgg
 import funcs_google as fgo
 import funcs_league as flg
+import funcs_sqlite as fsq
 import numpy as np
 import pandas as pd
 import pytz
@@ -28,6 +31,10 @@
 ANNOUNCE_SUB_CHANNEL = "league-moderation"
 ELO_EXTRA = 100
 
+# Refresh chess.com data for league members before it expires
+PREWARM_REQUESTS_PER_MINUTE = 30
+PREWARM_LEAD_TIME = 5 * 60
+
 logging.basicConfig(
     filename=LOG_FILE,
     level=logging.INFO,
@@ -72,15 +79,47 @@ def test_unittest():
 
 LDB = flg.LeagueDatabase()
 
+# Commands await these instead of blocking the event loop on LDB
+ALDB = fsq.AsyncDatabase(LDB, LDB.executor, LDB.lock)
+ACDB = fsq.AsyncDatabase(LDB.chess_db, LDB.executor)
+
+
+def backup_db():
+    """Upload a consistent snapshot, the live file may have commits in its WAL"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "rapid_league.sqlite3")
+        LDB.backup(path)
+        fgo.backup_db(path)
+
 
 @tasks.loop(seconds=60 * 15)
 async def regular_backup():
-    fgo.backup_db()
+    await asyncio.get_running_loop().run_in_executor(None, backup_db)
 
 
 regular_backup.start()
 
 
+@tasks.loop(seconds=60)
+async def prewarm_chesscom():
+    chesscoms = []
+    for month_delta in [0, 1]:
+        chesscoms += await ALDB.get_season_chesscoms(fgg.get_month(month_delta))
+    plan = await ACDB.plan_refresh(
+        chesscoms,
+        lead_time=PREWARM_LEAD_TIME,
+        budget=PREWARM_REQUESTS_PER_MINUTE,
+    )
+    if len(plan) == 0:
+        return
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(None, LDB.chess_db.fetch_refresh, plan)
+    await ACDB.store_refresh(plan, results)
+
+
+prewarm_chesscom.start()
+
+
 # General commands
 async def get_all_threads(guild):
     threads = list(guild.threads)
@@ -94,18 +133,18 @@ async def get_all_threads(guild):
     return threads
 
 
-def update_discord_names(guild):
+async def update_discord_names(guild):
     members = list(guild.members)
     print(members)
-    for member in tqdm(members):
-        LDB.update_discord_name(member.id, str(member))
+    names = [(member.id, str(member)) for member in members]
+    await LDB.write(LDB.update_discord_names, names)
 
 
 async def announce_pairing(bot, guild):
     season_name = fgg.get_month(0)
     week_num = 4
 
-    df = LDB.get_games_by_week(season_name, week_num)
+    df = await ALDB.get_games_by_week(season_name, week_num)
     channel = discord.utils.get(guild.channels, name="📆-league-scheduling")
 
     rows = list(df.itertuples())
@@ -122,7 +161,7 @@ async def announce_pairing(bot, guild):
             type=discord.ChannelType.public_thread,
             reason="league-pairing",
         )
-        LDB.set_thread_id(row.game_id, thread.id)
+        await LDB.write(LDB.set_thread_id, row.game_id, thread.id)
         message = (
             "Hi! October Rapid League Week 4 has started, please use "
             "this thread so I can help you.  This thread is for:\n"
@@ -170,7 +209,7 @@ async def announce_substitute(mention, team_mention, guild, seed_id, week_num):
         reason="testing-purposes",
     )
 
-    LDB.set_sub_thread_id(seed_id, thread.id)
+    await LDB.write(LDB.set_sub_thread_id, seed_id, thread.id)
 
     message = (
         f"{mention} has requested a substitute on week {week_num}.  "
@@ -235,9 +274,8 @@ async def save_discord_history(guild):
     print(f"updated {DISCORD_HISTORY_PARQUET}")
 
 
-def gen_season_info(season_name):
+def gen_season_info(season_name, member_df):
     # Standings
-    member_df = LDB.get_member_info(season_name)
     game_df = LDB.get_season_games(season_name)
     request_df = LDB.get_request_info(season_name)
 
@@ -325,21 +363,26 @@ def gen_season_info(season_name):
     return dfs
 
 
-def update_google_sheet():
+async def update_google_sheet():
+    # Uploads don't touch the database, run them without holding its lock
+    loop = asyncio.get_running_loop()
+
     # Sign-up info
     season_name = fgg.get_month()
-    dfs = gen_season_info(season_name)
-    fgg.dfs_to_sheet(dfs, sheet=0)
+    member_df = await ALDB.get_member_info(season_name)
+    dfs = await ALDB.run(gen_season_info, season_name, member_df)
+    await loop.run_in_executor(None, lambda: fgg.dfs_to_sheet(dfs, sheet=0))
 
     # Next season sign-up info
     season_name = fgg.get_month(1)
-    dfs = gen_season_info(season_name)
-    fgg.dfs_to_sheet(dfs, sheet=1)
+    member_df = await ALDB.get_member_info(season_name)
+    dfs = await ALDB.run(gen_season_info, season_name, member_df)
+    await loop.run_in_executor(None, lambda: fgg.dfs_to_sheet(dfs, sheet=1))
 
     # Pairings
     for week_num in [1, 2, 3, 4]:
         season_name = fgg.get_month(0)
-        df = LDB.get_games_by_week(season_name, week_num)
+        df = await ALDB.get_games_by_week(season_name, week_num)
         to_sheet = df[
             [
                 "game_id",
@@ -358,7 +401,9 @@ def update_google_sheet():
             DISPLAY_RESULT[r] if r in DISPLAY_RESULT else "-"
             for r in np.array(to_sheet["result"])
         ]
-        fgg.df_to_sheet(to_sheet, sheet=week_num + 1)
+        await loop.run_in_executor(
+            None, lambda: fgg.df_to_sheet(to_sheet, sheet=week_num + 1)
+        )
 
 
 # Exception handling
@@ -415,13 +460,13 @@ def on_command_error(ctx, exception):
 
 # Define league membership commands
 async def general_set_chesscom(mention, user, chesscom):
-    if not LDB.chess_db.get_exists(chesscom):
+    if not await ACDB.get_exists(chesscom):
         message = f"{mention} Chess.com username not found: `{chesscom}`"
         return message
 
-    user_data = LDB.get_user_data(user.id)
-    LDB.set_chesscom(user.id, str(user), chesscom)
-    if len(user_data) < 1:
+    user_data = await ALDB.get_user_data(user.id)
+    await LDB.write(LDB.set_chesscom, user.id, str(user), chesscom)
+    if user_data is None:
         message = (
             f"{mention} successfully linked "
             f"{user.mention} to Chess.com username `{chesscom}`"
@@ -429,7 +474,7 @@ async def general_set_chesscom(mention, user, chesscom):
     else:
         message = (
             f"{mention} user {user.mention} was linked to Chess.com username "
-            f'`{user_data["chesscom"][0]}` but is now linked to `{chesscom}`'
+            f"`{user_data.chesscom}` but is now linked to `{chesscom}`"
         )
     return message
 
@@ -455,15 +500,15 @@ async def mod_set_chesscom(ctx, discord_mention: discord.Member, chesscom: str):
 async def general_join(mention, user, season_name, join_type, mod=False):
     join_error_message = f"{mention} Errors:"
 
-    user_data = LDB.get_user_data(user.id)
+    user_data = await ALDB.get_user_data(user.id)
     player_args = ["player", "substitute"]
 
     errors = []
-    if len(user_data) < 1:
+    if user_data is None:
         errors.append(gen_chesscom_username_error(mention, user.mention, mod))
     else:
-        chesscom = user_data["chesscom"][0]
-        count_info = LDB.chess_db.get_count(chesscom)
+        chesscom = user_data.chesscom
+        count_info = await ACDB.get_count(chesscom)
         num_games = count_info["total_count"]
         num_rapid_games = count_info["rapid_count"]
         if join_type not in player_args:
@@ -484,7 +529,8 @@ async def general_join(mention, user, season_name, join_type, mod=False):
         errors = [join_error_message] + errors
         message = "\n".join(errors)
     else:
-        LDB.league_join(
+        await LDB.write(
+            LDB.league_join,
             season_name,
             user.id,
             join_type == "player",
@@ -562,13 +608,13 @@ async def mod_join_substitute(ctx, user: discord.Member, join_type: str):
 
 
 async def general_leave(mention, user, season_name):
-    if not LDB.is_member(season_name, user.id):
+    if not await ALDB.is_member(season_name, user.id):
         message = (
             f"{mention} user {user.mention} is not currently signed up "
             f"for the rapid league `{season_name}` season"
         )
     else:
-        LDB.league_leave(season_name, user.id)
+        await LDB.write(LDB.league_leave, season_name, user.id)
         message = (
             f"{mention} user {user.mention} has left the "
             f"rapid league `{season_name}` season"
@@ -653,7 +699,7 @@ async def general_schedule(mention, user, ctx, date_str, time_str, time_zone):
 
     # Get game ID from thread name
     game_id = title_to_game_id(ctx.message.channel.name)
-    game_df = LDB.get_game_by_id(game_id)
+    game_df = await ALDB.get_game_by_id(game_id)
     if len(game_df) == 0:
         message = f"{mention} Game ID not found, pinging {GRUBBER_MENTION}"
         return message
@@ -688,7 +734,9 @@ async def general_schedule(mention, user, ctx, date_str, time_str, time_zone):
         fgo.delete_event_by_id(game_dict["event_id"])
 
     # Save the event_id
-    LDB.schedule(game_id, event_id, f"{str(game_datetime)} {time_zone}")
+    await LDB.write(
+        LDB.schedule, game_id, event_id, f"{str(game_datetime)} {time_zone}"
+    )
     message = (
         f"{mention} Scheduled game `{game_id}` at `{str(game_datetime)}` "
         f"in time zone `{time_zone}`, see the game on the calendar at {url}"
@@ -730,31 +778,31 @@ async def mod_schedule(
     await ctx.send(message)
 
 
-def general_set_result(mention, user, game_id, url=None, mod=False, result=None):
+async def general_set_result(mention, user, game_id, url=None, mod=False, result=None):
 
     # Mods bypass everything
     if mod and url is None:
         if result not in [-1, 0, 1]:
             message = f"Result must be in `{[-1, 0, 1]}`"
         else:
-            LDB.set_result(game_id, result, url)
+            await LDB.write(LDB.set_result, game_id, result, url)
             display_result = DISPLAY_RESULT[result]
             message = f"{mention} Set result for game `{game_id}` to `{display_result}`"
         return message
 
     # Pull game info from the database
-    game_df = LDB.get_game_by_id(game_id)
+    game_df = await ALDB.get_game_by_id(game_id)
     if len(game_df) == 0:
         message = f"{mention} Game ID not found, pinging {GRUBBER_MENTION}"
         return message
     game_dict = {str(c): game_df[c][0] for c in game_df.columns}
 
     # Verify the user has a real chess.com username
-    user_data = LDB.get_user_data(user.id)
-    if len(user_data) < 1:
+    user_data = await ALDB.get_user_data(user.id)
+    if user_data is None:
         message = gen_chesscom_username_error(mention, user.mention)
         return message
-    chesscom = user_data["chesscom"][0]
+    chesscom = user_data.chesscom
 
     # Get cc_game_id from url
     cc_game_id = fcc.game_id_from_url(url)
@@ -762,18 +810,14 @@ def general_set_result(mention, user, game_id, url=None, mod=False, result=None)
         message = f"{mention} No chesscom game_id found in url"
         return message
 
-    # Get games and index by cc_game_id
-    games = fcc.get_game_history_api(chesscom)
-    cc_game_id_dict = {fcc.game_id_from_url(game["url"]): game for game in games}
-
     # Make sure the user has played the game in question
-    if cc_game_id not in cc_game_id_dict:
+    game = await ACDB.find_game(chesscom, cc_game_id)
+    if game is None:
         message = f"{mention} Game not found in user game history: {url}"
         return message
 
     # Log errors about the game
     errors = []
-    game = cc_game_id_dict[cc_game_id]
     chesscoms = {
         "white": game["white"]["username"].lower(),
         "black": game["black"]["username"].lower(),
@@ -815,9 +859,9 @@ def general_set_result(mention, user, game_id, url=None, mod=False, result=None)
         message = "\n".join(errors)
     else:
         if result is None:
-            game_result = cc_game_id_dict[cc_game_id]["white"]["result"]
+            game_result = game["white"]["result"]
             result = WHITE_RESULTS_CODES[game_result]
-        LDB.set_result(game_id, result, url)
+        await LDB.write(LDB.set_result, game_id, result, url)
         display_result = DISPLAY_RESULT[result]
         message = f"{mention} Set result for game `{game_id}` to `{display_result}`"
     return message
@@ -838,7 +882,7 @@ async def user_set_result(ctx, url):
         message = "This command must be used in a game thread"
     else:
         game_id = title_to_game_id(ctx.message.channel.name)
-        message = general_set_result(mention, user, game_id, url)
+        message = await general_set_result(mention, user, game_id, url)
     await ctx.send(message)
 
 
@@ -852,7 +896,7 @@ async def mod_set_result(ctx, user: discord.Member, url: str):
         message = "This command must be used in a game thread"
     else:
         game_id = title_to_game_id(ctx.message.channel.name)
-        message = general_set_result(mention, user, game_id, url, mod=True)
+        message = await general_set_result(mention, user, game_id, url, mod=True)
     await ctx.send(message)
 
 
@@ -873,7 +917,7 @@ async def mod_custom_result(
         message = "This command must be used in a game thread"
     else:
         game_id = title_to_game_id(ctx.message.channel.name)
-        message = general_set_result(
+        message = await general_set_result(
             mention, user, game_id, result=result, mod=True, url=url
         )
     await ctx.send(message)
@@ -883,20 +927,20 @@ async def mod_custom_result(
 async def general_claim_substitute(mention, user, guild, seed_id):
 
     # Ensure seed_id exists
-    df = LDB.get_claim_sub_from(seed_id)
-    if len(df) == 0:
+    claim = await ALDB.get_claim_sub_from(seed_id)
+    if claim is None:
         message = f"{mention} Seed ID `{seed_id}` does not require a substitute"
         return message
 
-    team_name = df["team_name"][0]
-    season_name = df["season_name"][0]
-    week_num = df["week_num"][0]
-    chesscom = df["chesscom"][0]
-    rapid_rating = LDB.chess_db.get_rating(chesscom)["rapid"]
+    team_name = claim.team_name
+    season_name = claim.season_name
+    week_num = claim.week_num
+    chesscom = claim.chesscom
+    rapid_rating = (await ACDB.get_rating(chesscom))["rapid"]
     max_elo = rapid_rating + ELO_EXTRA
 
     # Ensure player is playing this season
-    df = LDB.get_claim_sub_to(season_name, user.id)
+    df = await ALDB.get_claim_sub_to(season_name, user.id)
     if len(df) == 0:
         message = (
             f"{mention} User {user.mention} is not playing in "
@@ -915,7 +959,7 @@ async def general_claim_substitute(mention, user, guild, seed_id):
         return message
 
     # Ensure the player is playing less than 2 games
-    df = LDB.get_games_by_week(season_name, week_num)
+    df = await ALDB.get_games_by_week(season_name, week_num)
     if len(df) >= 2:
         message = (
             f"{mention} User {user.mention} is already playing `{len(df)}` "
@@ -924,7 +968,7 @@ async def general_claim_substitute(mention, user, guild, seed_id):
         return message
 
     # Ensure the player is below ELO_EXTRA
-    new_rapid_rating = LDB.chess_db.get_rating(new_chesscom)["rapid"]
+    new_rapid_rating = (await ACDB.get_rating(new_chesscom))["rapid"]
     if new_rapid_rating > max_elo:
         message = (
             f"{mention} Error, max Elo for this game is `{max_elo}`, but "
@@ -933,8 +977,8 @@ async def general_claim_substitute(mention, user, guild, seed_id):
         return message
 
     # Do the substitute
-    LDB.update_sub(season_name, seed_id, user.id)
-    df = LDB.get_gameid_from_seedid(seed_id)
+    await LDB.write(LDB.update_sub, season_name, seed_id, user.id)
+    df = await ALDB.get_gameid_from_seedid(seed_id)
     game_id = df["game_id"][0]
     white_discord_id = df["white_discord_id"][0]
     black_discord_id = df["black_discord_id"][0]
@@ -1006,28 +1050,28 @@ async def general_request_substitute(
         return message
 
     # Get user chesscom
-    user_data = LDB.get_user_data(user.id)
-    if len(user_data) == 0:
+    user_data = await ALDB.get_user_data(user.id)
+    if user_data is None:
         message = gen_chesscom_username_error(mention, user.mention, mod=False)
         return message
-    # chesscom = user_data["chesscom"][0]
+    # chesscom = user_data.chesscom
 
     # Verify that the user is signed up for the season
     season_name = fgg.get_month(int(is_next_season))
-    if not LDB.is_member(season_name, user.id):
+    if not await ALDB.is_member(season_name, user.id):
         message = (
             f"{mention} User {user.mention} is not signed up for "
             f"the Rapid League `{season_name}` season"
         )
         return message
 
-    LDB.request_sub(season_name, week_num, user.id)
+    await LDB.write(LDB.request_sub, season_name, week_num, user.id)
     message = (
         f"{mention} user {user.mention} has requested a substitute on "
         f"week {week_num} of the rapid league `{season_name}` season"
     )
 
-    df = LDB.get_sub_announce(season_name, week_num, user.id)
+    df = await ALDB.get_sub_announce(season_name, week_num, user.id)
     if len(df) > 0:
         # seed_id = df["seed_id"][0]
         team_name = df["team_name"][0]
@@ -1109,13 +1153,37 @@ async def mod_request_substitute_next(
     await ctx.send(message)
 
 
+# Season setup
+@commands.command(name="mod_assign_teams")
+@commands.has_any_role(*MODERATOR_ROLES)
+async def mod_assign_teams(ctx):
+    """Split the players and substitutes of the upcoming season into teams"""
+    mention = ctx.message.author.mention
+    season_name = fgg.get_month(1)
+    await ctx.send(f"{mention} assigning teams for the `{season_name}` season...")
+    await LDB.write(LDB.set_team_names, season_name, flg.SEASON_TEAMS)
+    await LDB.assign_teams_async(season_name)
+    await LDB.assign_teams_async(season_name, assign_sub=True)
+    await ctx.send(f"{mention} teams for the `{season_name}` season are assigned")
+
+    # Pair every week now, each week's seed_games then reads the plan.  The
+    # ratings are fetched first, not while the write holds the database lock
+    await ACDB.refresh_ratings(await ALDB.get_season_chesscoms(season_name))
+    if await LDB.write(LDB.plan_season, season_name) is None:
+        await ctx.send(
+            f"{mention} no `{season_name}` season avoids every rematch, "
+            "weeks will be paired one at a time"
+        )
+
+
 # Other commands
 @commands.command(name="reboot")
 @commands.has_any_role(*MODERATOR_ROLES)
 async def reboot(ctx):
     """Reboot GrubberBot, which also pulls the latest from production"""
     await ctx.send("Backing up database...")
-    fgo.backup_db()
+    await LDB.write_queue.close()
+    await asyncio.get_running_loop().run_in_executor(None, backup_db)
     await ctx.send("Database backed up, rebooting now...")
     subprocess.run("sudo reboot", shell=True, cwd=".", capture_output=True)
 
@@ -1141,7 +1209,7 @@ async def league_info(ctx, discord_mention: Optional[discord.Member] = None):
             ]
         )
     else:
-        df = LDB.get_league_info(fgg.get_month(1), user.id)
+        df = await ALDB.get_league_info(fgg.get_month(1), user.id)
         if len(df) == 0:
             message = (
                 f"{mention} user {user.mention} is not signed up for the "
@@ -1164,7 +1232,7 @@ async def on_ready(self):
         guild = discord.utils.get(self.guilds, name=GUILD_NAME)
         print(f"Client {self.user} has connected to {guild.name}")
 
-        update_discord_names(guild)
+        await update_discord_names(guild)
         print("done")
         # save_user_data(guild)
         # await save_discord_history(guild)
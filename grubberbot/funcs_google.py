@@ -115,8 +115,9 @@ def upload_to_bucket(blob_filename, local_filename, bucket_name):
     return blob.public_url
 
 
-def backup_db():
-    if not os.path.exists(DB_PATH):
+def backup_db(path=DB_PATH):
+    """Upload the database file at `path`, a snapshot of DB_PATH"""
+    if not os.path.exists(path):
         return
 
     timestamp = datetime.datetime.now(datetime.timezone.utc)
@@ -125,13 +126,13 @@ def backup_db():
 
     upload_to_bucket(
         f"sqlite_backup/{timestamp}_UTC.sqlite3",
-        DB_PATH,
+        path,
         "grubberbot_backup",
     )
 
     upload_to_bucket(
         "rapid_league.sqlite3",
-        DB_PATH,
+        path,
         "grubberbot_backup",
     )
 
@@ -5,10 +5,12 @@
 import re
 import sqlite3
 import string
+import threading
 import time
 import urllib
 import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 
 import chess
@@ -17,6 +19,8 @@
 import funcs_chesscom as fcc
 import funcs_general as fgg
 import funcs_google as fgo
+import funcs_pairing as fpa
+import funcs_sqlite as fsq
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
@@ -35,123 +39,432 @@
 LEAGUE_DB = "data/rapid_league.sqlite3"
 SIGNUP_TEAM = "signup"
 CORRUPTED_TEAM = "corrupted"
+SEASON_TEAMS = ["Team Nepomniachtchi", "Team Carlsen"]
+
+# Seconds each restart of the team balancer searches for
+SPLIT_KWARGS = {"iter_time": 4}
 
 fgo.download_db()
 
+# Users, id is their discord id
+USER_TBL_SQL = """
+CREATE TABLE IF NOT EXISTS user(
+    id integer PRIMARY KEY,
+    discord_id integer NOT NULL UNIQUE,
+    discord_name text NOT NULL,
+    chesscom text
+);"""
+
+# Seasons, name is the name of the season
+SEASON_TBL_SQL = """
+CREATE TABLE IF NOT EXISTS season(
+    id integer PRIMARY KEY,
+    name text NOT NULL UNIQUE,
+    week_num INTEGER NOT NULL DEFAULT 0
+);"""
+
+# Teams, name is the name of the team. team 'signup' is not yet assigned
+TEAM_TBL_SQL = """
+CREATE TABLE IF NOT EXISTS team(
+    id integer PRIMARY KEY,
+    season_id integer NOT NULL REFERENCES season(id),
+    name text NOT NULL,
+    discord_id INTEGER NOT NULL DEFAULT 0,
+    UNIQUE(season_id, name)
+);"""
+
+# Membership, bridge table from users to teams (many to many)
+MEMBER_TBL_SQL = """
+CREATE TABLE IF NOT EXISTS member(
+    id integer PRIMARY KEY,
+    user_id integer NOT NULL REFERENCES user(id),
+    team_id integer NOT NULL REFERENCES team(id) ON UPDATE CASCADE,
+    is_player integer NOT NULL,
+    UNIQUE(user_id, team_id)
+);"""
+
+# Weeks per-league
+WEEK_TBL_SQL = """
+CREATE TABLE IF NOT EXISTS week(
+    id integer PRIMARY KEY,
+    season_id text NOT NULL REFERENCES season(id),
+    num integer NOT NULL,
+    UNIQUE(season_id, num)
+);"""
+
+# Seed per-player
+SEED_TBL_SQL = """
+CREATE TABLE IF NOT EXISTS seed(
+    id integer NOT NULL PRIMARY KEY,
+    week_id integer NOT NULL REFERENCES week(id),
+    member_id integer NOT NULL REFERENCES member(id) ON DELETE CASCADE,
+    sub_member_id integer NOT NULL REFERENCES member(id),
+    request integer NOT NULL DEFAULT 0,
+    note text,
+    sub_thread_id INTEGER,
+    UNIQUE(week_id, member_id)
+);"""
+
+# Games per-week
+GAME_TBL_SQL = """
+CREATE TABLE IF NOT EXISTS game(
+    id integer NOT NULL PRIMARY KEY,
+    white_seed_id integer NOT NULL REFERENCES seed(id),
+    black_seed_id integer NOT NULL REFERENCES seed(id),
+    schedule text,
+    event_id text,
+    result integer,
+    url text,
+    thread_id INTEGER,
+    UNIQUE(white_seed_id, black_seed_id)
+);"""
+
+# Planned games per-week, colors are drawn when the week is seeded
+PLAN_TBL_SQL = """
+CREATE TABLE IF NOT EXISTS plan(
+    id integer NOT NULL PRIMARY KEY,
+    week_id integer NOT NULL REFERENCES week(id),
+    member_id integer NOT NULL REFERENCES member(id) ON DELETE CASCADE,
+    opponent_id integer NOT NULL REFERENCES member(id) ON DELETE CASCADE,
+    UNIQUE(week_id, member_id),
+    UNIQUE(week_id, opponent_id)
+);"""
+PLAN_MEMBER_IDX_SQL = """
+CREATE INDEX IF NOT EXISTS plan_member_idx ON plan(member_id)
+;"""
+PLAN_OPPONENT_IDX_SQL = """
+CREATE INDEX IF NOT EXISTS plan_opponent_idx ON plan(opponent_id)
+;"""
+
+# TODO: Force users in a game to also be in the season
+
+# Secondary indexes for the foreign key join paths.  seed.week_id,
+# member.user_id and game.white_seed_id are already covered by the UNIQUE
+# constraint indexes.
+MEMBER_TEAM_IDX_SQL = """
+CREATE INDEX IF NOT EXISTS member_team_idx ON member(team_id, user_id, is_player)
+;"""
+SEED_SUB_MEMBER_IDX_SQL = """
+CREATE INDEX IF NOT EXISTS seed_sub_member_idx ON seed(sub_member_id, week_id)
+;"""
+SEED_MEMBER_IDX_SQL = """
+CREATE INDEX IF NOT EXISTS seed_member_idx ON seed(member_id)
+;"""
+GAME_BLACK_SEED_IDX_SQL = """
+CREATE INDEX IF NOT EXISTS game_black_seed_idx ON game(black_seed_id, white_seed_id)
+;"""
+
+# Read model of games with both players, their teams and the week, so game
+# listings are single table reads.  game_info_view defines it, game_info
+# materializes it and triggers refresh it inside the writing transaction.
+GAME_INFO_COLUMNS = {
+    "game_id": "integer PRIMARY KEY",
+    "season_id": "integer",
+    "week_num": "integer",
+    "white_seed_id": "integer",
+    "black_seed_id": "integer",
+    "schedule": "text",
+    "event_id": "text",
+    "result": "integer",
+    "url": "text",
+    "thread_id": "integer",
+}
+for color in ["white", "black"]:
+    GAME_INFO_COLUMNS.update(
+        {
+            f"{color}_member_id": "integer",
+            f"{color}_user_id": "integer",
+            f"{color}_week_num": "integer",
+            f"{color}_team_name": "text",
+            f"{color}_discord_id": "integer",
+            f"{color}_discord_name": "text",
+            f"{color}_chesscom": "text",
+        }
+    )
+GAME_INFO_COLUMN_SQL = ", ".join(GAME_INFO_COLUMNS)
+
+GAME_INFO_VIEW_SQL = """
+CREATE VIEW IF NOT EXISTS game_info_view AS
+SELECT
+    g.id AS game_id,
+    CAST(ww.season_id AS integer) AS season_id,
+    ww.num AS week_num,
+    g.white_seed_id AS white_seed_id,
+    g.black_seed_id AS black_seed_id,
+    g.schedule AS schedule,
+    g.event_id AS event_id,
+    g.result AS result,
+    g.url AS url,
+    g.thread_id AS thread_id,
+
+    wm.id AS white_member_id,
+    wu.id AS white_user_id,
+    ww.num AS white_week_num,
+    wt.name AS white_team_name,
+    wu.discord_id AS white_discord_id,
+    wu.discord_name AS white_discord_name,
+    wu.chesscom AS white_chesscom,
+
+    bm.id AS black_member_id,
+    bu.id AS black_user_id,
+    bw.num AS black_week_num,
+    bt.name AS black_team_name,
+    bu.discord_id AS black_discord_id,
+    bu.discord_name AS black_discord_name,
+    bu.chesscom AS black_chesscom
+FROM game AS g
+LEFT JOIN seed AS ws ON g.white_seed_id = ws.id
+LEFT JOIN week AS ww ON ws.week_id = ww.id
+LEFT JOIN member AS wm ON ws.sub_member_id = wm.id
+LEFT JOIN user AS wu ON wm.user_id = wu.id
+LEFT JOIN team AS wt ON wm.team_id = wt.id
+
+LEFT JOIN seed AS bs ON g.black_seed_id = bs.id
+LEFT JOIN week AS bw ON bs.week_id = bw.id
+LEFT JOIN member AS bm ON bs.sub_member_id = bm.id
+LEFT JOIN user AS bu ON bm.user_id = bu.id
+LEFT JOIN team AS bt ON bm.team_id = bt.id
+;"""
+
+GAME_INFO_TBL_SQL = "CREATE TABLE IF NOT EXISTS game_info({});".format(
+    ", ".join(f"{c} {t}" for c, t in GAME_INFO_COLUMNS.items())
+)
+
+
+def game_info_refresh_sql(where):
+    """Rebuild the game_info rows of the games matching `where`"""
+    return f"""
+    INSERT OR REPLACE INTO game_info({GAME_INFO_COLUMN_SQL})
+    SELECT {GAME_INFO_COLUMN_SQL} FROM game_info_view WHERE {where}
+    ;"""
+
+
+def game_info_index_sql(*columns):
+    return f"""
+    CREATE INDEX IF NOT EXISTS game_info_{columns[0]}_idx
+    ON game_info({", ".join(columns)})
+    ;"""
+
+
+def game_info_trigger_sql(table, event, where):
+    """Refresh game_info after `event` on `table`, `where` selects the games"""
+    name = event.split()[0].lower()
+    return f"""
+    CREATE TRIGGER IF NOT EXISTS game_info_{table}_{name}_trg
+    AFTER {event} ON {table}
+    BEGIN
+        {game_info_refresh_sql(where)}
+    END
+    ;"""
+
+
+GAME_INFO_MIGRATION = [
+    GAME_INFO_VIEW_SQL,
+    GAME_INFO_TBL_SQL,
+    game_info_index_sql("season_id", "week_num"),
+    game_info_index_sql("white_seed_id"),
+    game_info_index_sql("black_seed_id"),
+    game_info_index_sql("white_member_id"),
+    game_info_index_sql("black_member_id"),
+    game_info_index_sql("white_user_id"),
+    game_info_index_sql("black_user_id"),
+    game_info_trigger_sql("game", "INSERT", "game_id = NEW.id"),
+    game_info_trigger_sql("game", "UPDATE", "game_id = NEW.id"),
+    """
+    CREATE TRIGGER IF NOT EXISTS game_info_game_delete_trg
+    AFTER DELETE ON game
+    BEGIN
+        DELETE FROM game_info WHERE game_id = OLD.id;
+    END
+    ;""",
+    game_info_trigger_sql(
+        "seed",
+        "UPDATE OF week_id, sub_member_id",
+        "white_seed_id = NEW.id OR black_seed_id = NEW.id",
+    ),
+    game_info_trigger_sql(
+        "member",
+        "UPDATE OF user_id, team_id",
+        "white_member_id = NEW.id OR black_member_id = NEW.id",
+    ),
+    game_info_trigger_sql(
+        "user",
+        "UPDATE OF discord_id, discord_name, chesscom",
+        "white_user_id = NEW.id OR black_user_id = NEW.id",
+    ),
+    game_info_trigger_sql(
+        "team",
+        "UPDATE OF name",
+        """white_member_id IN (SELECT id FROM member WHERE team_id = NEW.id)
+        OR black_member_id IN (SELECT id FROM member WHERE team_id = NEW.id)""",
+    ),
+    game_info_refresh_sql("1"),
+]
+
+# Schema versions, migration i moves PRAGMA user_version from i to i + 1.
+# Only ever append, the live database is migrated in place on startup.
+LEAGUE_MIGRATIONS = [
+    [
+        USER_TBL_SQL,
+        SEASON_TBL_SQL,
+        TEAM_TBL_SQL,
+        MEMBER_TBL_SQL,
+        WEEK_TBL_SQL,
+        SEED_TBL_SQL,
+        GAME_TBL_SQL,
+    ],
+    [
+        MEMBER_TEAM_IDX_SQL,
+        SEED_SUB_MEMBER_IDX_SQL,
+        SEED_MEMBER_IDX_SQL,
+        GAME_BLACK_SEED_IDX_SQL,
+    ],
+    GAME_INFO_MIGRATION,
+    # Member deletes cascade into the plan through these indexes
+    [PLAN_TBL_SQL, PLAN_MEMBER_IDX_SQL, PLAN_OPPONENT_IDX_SQL],
+]
+
+
+# Tables behind the game_info read model
+GAME_INFO_TABLES = ("game", "seed", "member", "user", "team", "week")
+
+
+class UserRow(fsq.Row):
+    __slots__ = ("id", "discord_id", "discord_name", "chesscom")
+
+
+class ClaimSubRow(fsq.Row):
+    __slots__ = ("team_name", "chesscom", "season_name", "week_num")
+
+
+class IdCache:
+    """Season, week and team ids by name, loaded once from the database
+
+    Seasons, weeks and teams are only created by `init_season` and
+    `set_team_names`, which `clear` the cache.
+    """
+
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+        self.loaded = False
+
+    def clear(self):
+        self.loaded = False
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            sql = "SELECT s.name, s.id FROM season AS s;"
+            self.seasons = dict(self.conn.execute(sql).fetchall())
+            season_names = {v: k for k, v in self.seasons.items()}
+
+            # week.season_id is a text column
+            sql = "SELECT w.season_id, w.num, w.id FROM week AS w;"
+            self.weeks = {
+                (season_names[int(season_id)], num): week_id
+                for season_id, num, week_id in self.conn.execute(sql)
+            }
+            sql = "SELECT t.season_id, t.name, t.id FROM team AS t ORDER BY t.id;"
+            self.teams = {
+                (season_names[season_id], name): team_id
+                for season_id, name, team_id in self.conn.execute(sql)
+            }
+            self.loaded = True
+
+    def season(self, season_name):
+        self.load()
+        return self.seasons.get(season_name)
+
+    def week(self, season_name, week_num):
+        self.load()
+        return self.weeks.get((season_name, int(week_num)))
+
+    def team(self, season_name, team_name):
+        self.load()
+        return self.teams.get((season_name, team_name))
+
+    def season_weeks(self, season_name):
+        self.load()
+        return [v for (s, _), v in self.weeks.items() if s == season_name]
+
+    def season_teams(self, season_name):
+        self.load()
+        return [v for (s, _), v in self.teams.items() if s == season_name]
+
+    def team_names(self, season_name):
+        self.load()
+        return [n for (s, n) in self.teams if s == season_name]
+
 
 class LeagueDatabase:
-    def __init__(self, path=LEAGUE_DB):
+    def __init__(self, path=LEAGUE_DB, chess_db=None, cache_reads=True):
         self.path = path
-        self.conn = sqlite3.connect(self.path)
+        self.pool = fsq.ConnectionPool(self.path)
+        self.conn = self.pool.writer
         self.cur = self.conn.cursor()
         self.conn.execute("PRAGMA foreign_keys = 1")
         self.conn.commit()
-        # self.init_tables()
+
+        # Blocking calls made for the event loop run on these threads, one at
+        # a time, both databases are used under the same lock
+        self.lock = threading.RLock()
+        self.ids = IdCache(self.conn, self.lock)
+        self.cache = fsq.QueryCache(
+            self.conn, sources={"chess": self.chess_version}, enabled=cache_reads
+        )
+        self.executor = ThreadPoolExecutor(max_workers=fsq.DB_WORKERS)
+        self.write_queue = fsq.WriteQueue(
+            self.conn, executor=self.executor, lock=self.lock
+        )
+        self.init_tables()
         self.init_season()
-        self.chess_db = fcc.ChesscomDatabase()
+        self.chess_db = chess_db or fcc.ChesscomDatabase(stale_while_revalidate=True)
+
+        # Ratings are joined from the chess.com database in the same statement
+        self.pool.attach("chess", self.chess_db.pool.uri)
 
     def quit(self):
-        self.conn.close()
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+    def chess_version(self):
+        """Generation of the attached ratings, it also ticks as they age"""
+        soft_ttl = self.chess_db.ttls["rating"][0]
+        return self.chess_db.conn.total_changes, int(time.time() // soft_ttl)
+
+    def backup(self, path):
+        self.pool.backup(path)
+
+    def read_rated(self, sql, params, chesscom_columns):
+        """Run a query that joins ratings from the attached chess database
+
+        If the cached rating of any chesscom in `chesscom_columns` had expired
+        it is fetched, and the query reruns to pick it up.  The lock is only
+        held while reading, not while fetching.
+        """
+        with self.lock, self.pool.reader() as conn:
+            df = pd.read_sql_query(sql, conn, params=params)
+        chesscoms = [c for column in chesscom_columns for c in df[column]]
+        if self.chess_db.refresh_ratings(chesscoms):
+            with self.lock, self.pool.reader() as conn:
+                df = pd.read_sql_query(sql, conn, params=params)
+        return df
 
     def get_all_tables(self):
         sql = "SELECT name FROM sqlite_master WHERE type='table';"
-        output = self.conn.execute(sql)
         df_dict = {}
-        for table in output.fetchall():
-            df = pd.read_sql_query(f"SELECT * FROM {table[0]}", self.conn)
-            df_dict[table[0]] = df
+        with self.pool.reader() as conn:
+            for table in conn.execute(sql).fetchall():
+                df = pd.read_sql_query(f"SELECT * FROM {table[0]}", conn)
+                df_dict[table[0]] = df
         return df_dict
 
     def init_tables(self):
+        return fsq.migrate(self.conn, LEAGUE_MIGRATIONS)
 
-        # Users, id is their discord id
-        user_tbl_sql = """
-        CREATE TABLE IF NOT EXISTS user(
-            id integer PRIMARY KEY,
-            discord_id integer NOT NULL UNIQUE,
-            discord_name text NOT NULL,
-            chesscom text
-        );"""
-
-        # Seasons, name is the name of the season
-        season_tbl_sql = """
-        CREATE TABLE IF NOT EXISTS season(
-            id integer PRIMARY KEY,
-            name text NOT NULL UNIQUE,
-            week_num INTEGER NOT NULL DEFAULT 0
-        );"""
-
-        # Teams, name is the name of the team. team 'signup' is not yet assigned
-        team_tbl_sql = """
-        CREATE TABLE IF NOT EXISTS team(
-            id integer PRIMARY KEY,
-            season_id integer NOT NULL REFERENCES season(id),
-            name text NOT NULL,
-            discord_id INTEGER NOT NULL DEFAULT 0,
-            UNIQUE(season_id, name)
-        );"""
-
-        # Membership, bridge table from users to teams (many to many)
-        member_tbl_sql = """
-        CREATE TABLE IF NOT EXISTS member(
-            id integer PRIMARY KEY,
-            user_id integer NOT NULL REFERENCES user(id),
-            team_id integer NOT NULL REFERENCES team(id) ON UPDATE CASCADE,
-            is_player integer NOT NULL,
-            UNIQUE(user_id, team_id)
-        );"""
-
-        # Weeks per-league
-        week_tbl_sql = """
-        CREATE TABLE IF NOT EXISTS week(
-            id integer PRIMARY KEY,
-            season_id text NOT NULL REFERENCES season(id),
-            num integer NOT NULL,
-            UNIQUE(season_id, num)
-        );"""
-
-        # Seed per-player
-        seed_tbl_sql = """
-        CREATE TABLE IF NOT EXISTS seed(
-            id integer NOT NULL PRIMARY KEY,
-            week_id integer NOT NULL REFERENCES week(id),
-            member_id integer NOT NULL REFERENCES member(id) ON DELETE CASCADE,
-            sub_member_id integer NOT NULL REFERENCES member(id),
-            request integer NOT NULL DEFAULT 0,
-            note text,
-            sub_thread_id INTEGER,
-            UNIQUE(week_id, member_id)
-        );"""
-
-        # Games per-week
-        game_tbl_sql = """
-        CREATE TABLE IF NOT EXISTS game(
-            id integer NOT NULL PRIMARY KEY,
-            white_seed_id integer NOT NULL REFERENCES seed(id),
-            black_seed_id integer NOT NULL REFERENCES seed(id),
-            schedule text,
-            event_id text,
-            result integer,
-            url text,
-            thread_id INTEGER,
-            UNIQUE(white_seed_id, black_seed_id)
-        );"""
-
-        # TODO: Force users in a game to also be in the season
-
-        queries = [
-            user_tbl_sql,
-            season_tbl_sql,
-            team_tbl_sql,
-            member_tbl_sql,
-            week_tbl_sql,
-            seed_tbl_sql,
-            game_tbl_sql,
-        ]
-        for query in queries:
-            self.cur.execute(query)
-        self.conn.commit()
-
+    @fsq.writes("season", "week", "team")
     def init_season(self):
         season_sql = """
         INSERT OR IGNORE INTO season(name) VALUES(?)
@@ -176,20 +489,26 @@ def init_season(self):
             self.cur.execute(signup_sql, (month, SIGNUP_TEAM))
 
         self.conn.commit()
+        self.ids.clear()
 
+    @fsq.cached_read("team", "member", "user")
     def is_member(self, season_name, discord_id):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?)
         SELECT m.id FROM member AS m
         WHERE m.team_id IN team_ids
         AND m.user_id in user_ids
+        LIMIT 1
         ;"""
-        params = (season_name, discord_id)
-        df = pd.read_sql_query(sql, self.conn, params=params)
-        return len(df) > 0
+        params = (*team_ids, discord_id)
+        return fsq.fetch_value(self.conn, sql, params) is not None
 
+    @fsq.locks_itself
+    @fsq.cached_read("season", "week", "member", "seed", "user", "chess")
     def get_league_info(self, season_name, discord_id):
         sql = """
         WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
@@ -202,7 +521,8 @@ def get_league_info(self, season_name, discord_id):
         WHERE u.id IS NOT NULL
         ;"""
         params = (season_name, discord_id)
-        df = pd.read_sql_query(sql, self.conn, params=params)
+        with self.lock:
+            df = pd.read_sql_query(sql, self.conn, params=params)
         df = df.pivot(
             index=["discord_name", "chesscom", "is_player"],
             columns="num",
@@ -212,10 +532,10 @@ def get_league_info(self, season_name, discord_id):
         yes_no_dict = {0: "No", 1: "Yes"}
         substitute_dict = {0: "Substitute", 1: "Player"}
         print(df)
+        chesscoms = df.index.get_level_values("chesscom")
+        ratings = self.chess_db.get_ratings(chesscoms)
         df_dict = {
-            "Rapid Rating": [
-                self.chess_db.get_rating(row[1])["rapid"] for row in df.index
-            ],
+            "Rapid Rating": chesscoms.map(ratings["rapid"]),
             "Discord Name": [row[0] for row in df.index],
             "Chesscom Name": [row[1] for row in df.index],
             "Role": [substitute_dict[row[2]] for row in df.index],
@@ -234,14 +554,37 @@ def get_league_info(self, season_name, discord_id):
         )
         return df
 
+    async def write(self, method, *args, **kwargs):
+        """Run a write method through the write queue, in a group commit"""
+        return await self.write_queue.submit(method, *args, **kwargs)
+
+    def transaction(self):
+        return fsq.transaction(self.conn)
+
+    def get_user_ids(self, discord_ids):
+        user_ids = {}
+        for chunk in fsq.in_chunks(discord_ids):
+            sql = f"""
+            SELECT u.discord_id, u.id FROM user AS u
+            WHERE u.discord_id IN ({fsq.in_list(chunk)})
+            ;"""
+            user_ids.update(self.cur.execute(sql, chunk).fetchall())
+        return user_ids
+
     def update_discord_name(self, discord_id, discord_name):
+        self.update_discord_names([(discord_id, discord_name)])
+
+    @fsq.writes("user")
+    def update_discord_names(self, names):
+        """Rename many users at once, `names` holds (discord_id, discord_name)"""
         sql = """
         UPDATE user SET discord_name = ? WHERE user.discord_id = ?
         ;"""
-        params = (discord_id, discord_name)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        params = [(discord_name, discord_id) for discord_id, discord_name in names]
+        with self.transaction():
+            self.cur.executemany(sql, params)
 
+    @fsq.writes("user")
     def set_chesscom(self, discord_id, discord_name, chesscom):
         sql = """
         INSERT INTO user(discord_id, discord_name, chesscom)
@@ -250,45 +593,50 @@ def set_chesscom(self, discord_id, discord_name, chesscom):
         UPDATE SET discord_name = ?, chesscom = ?
         ;"""
         params = (discord_id, discord_name, chesscom, discord_name, chesscom)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        with self.transaction():
+            self.cur.execute(sql, params)
 
+    @fsq.cached_read("user")
     def get_user_data(self, discord_id):
+        """The linked user as a UserRow, None if they never set a chesscom"""
         sql = """
-        SELECT * FROM user WHERE discord_id = ?
+        SELECT u.id, u.discord_id, u.discord_name, u.chesscom FROM user AS u
+        WHERE u.discord_id = ?
         ;"""
         params = (discord_id,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
-        return df
+        return fsq.fetch_one(self.conn, sql, params, UserRow)
 
+    @fsq.writes("seed")
     def request_sub(self, season_name, week_num, discord_id):
         week_num = int(week_num)
         assert week_num in [1, 2, 3, 4]
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?),
         member_ids AS (
             SELECT m.id FROM member AS m
             WHERE m.team_id IN team_ids AND m.user_id IN user_ids
         ),
-        week_ids AS (
-            SELECT w.id FROM week AS w
-            WHERE w.num = ? AND w.season_id IN season_ids
-        )
+        week_ids AS (SELECT w.id FROM week AS w WHERE w.id = ?)
 
         UPDATE seed SET request = 1
         WHERE seed.sub_member_id IN member_ids
         AND seed.week_id IN week_ids
         ;"""
-        params = (season_name, discord_id, week_num)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        params = (*team_ids, discord_id, self.ids.week(season_name, week_num))
+        with self.transaction():
+            self.cur.execute(sql, params)
 
+    @fsq.writes("game")
     def set_game(self, season_name, week_num, w_discord_id, b_discord_id):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         white_user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?),
         black_user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?),
         white_member_ids AS (
@@ -299,14 +647,9 @@ def set_game(self, season_name, week_num, w_discord_id, b_discord_id):
             SELECT m.id FROM member AS m
             WHERE m.team_id IN team_ids AND m.user_id IN black_user_ids
         ),
-        week_ids AS (
-            SELECT w.id FROM week AS w
-            WHERE w.num = ? AND w.season_id IN season_ids
-        ),
         seed_subset AS (
-            SELECT s.id, s.sub_member_id FROM seed AS s
-            WHERE s.week_id IN week_ids
-        ),
+            SELECT s.id, s.sub_member_id FROM seed AS s WHERE s.week_id = ?
+        )
 
         INSERT INTO game(white_seed_id, black_seed_id)
         VALUES(
@@ -317,24 +660,35 @@ def set_game(self, season_name, week_num, w_discord_id, b_discord_id):
             (
                 SELECT s.id FROM seed_subset AS s
                 WHERE s.sub_member_id IN black_member_ids
-            ),
+            )
         )
         ;"""
 
-        params = (season_name, w_discord_id, b_discord_id, week_num)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        params = (
+            *team_ids,
+            w_discord_id,
+            b_discord_id,
+            self.ids.week(season_name, week_num),
+        )
+        with self.transaction():
+            self.cur.execute(sql, params)
 
+    @fsq.cached_read("team", "week", "member", "seed", "game", "user")
     def get_all_games(self, season_name, discord_id):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        team_ids = self.ids.season_teams(season_name)
+        week_ids = self.ids.season_weeks(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?),
         member_ids AS (
             SELECT m.id FROM member AS m
             WHERE m.team_id IN team_ids AND m.user_id IN user_ids
         ),
-        week_ids AS (SELECT w.id FROM week AS w WHERE w.season_id IN season_ids),
+        week_ids AS (
+            SELECT w.id FROM week AS w WHERE w.id IN ({fsq.in_list(week_ids)})
+        ),
         seed_ids AS (
             SELECT s.id FROM seed AS s
             WHERE s.week_id IN week_ids AND s.sub_member_id IN member_ids
@@ -343,28 +697,34 @@ def get_all_games(self, season_name, discord_id):
         WHERE g.black_seed_id IN seed_ids
         OR g.white_seed_id IN seed_ids
         ;"""
-        params = (season_name, discord_id)
+        params = (*team_ids, discord_id, *week_ids)
         df = pd.read_sql_query(sql, self.conn, params=params)
         return df
 
+    @fsq.writes("member")
     def league_player_to_sub(self, season_name, discord_id):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?)
 
         UPDATE member SET is_player = 0
         WHERE member.user_id IN user_ids
         AND member.team_id IN team_ids
         ;"""
-        params = (season_name, discord_id)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        params = (*team_ids, discord_id)
+        with self.transaction():
+            self.cur.execute(sql, params)
 
+    @fsq.writes("member", "seed")
     def league_leave(self, season_name, discord_id):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?)
 
         DELETE FROM member AS m
@@ -373,10 +733,10 @@ def league_leave(self, season_name, discord_id):
         ;"""
 
         # If user has a game, just make them a sub
-        params = (season_name, discord_id)
+        params = (*team_ids, discord_id)
         try:
-            self.cur.execute(sql, params)
-            self.conn.commit()
+            with self.transaction():
+                self.cur.execute(sql, params)
         except sqlite3.IntegrityError as e:
             print(e)
             self.league_player_to_sub(season_name, discord_id)
@@ -384,80 +744,86 @@ def league_leave(self, season_name, discord_id):
     def league_join(
         self, season_name, discord_id, is_player, team=SIGNUP_TEAM, sub_week=None
     ):
-
-        # Default team is signup
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (
-            SELECT t.id FROM team AS t
-            WHERE t.season_id IN season_ids AND t.name = ?
-        )
-
-        INSERT OR REPLACE INTO member(user_id, team_id, is_player)
-        VALUES(
-            (SELECT id FROM user WHERE discord_id = ?),
-            (SELECT * FROM team_ids),
-            ?)
-        ;"""
-        params = (season_name, team, discord_id, is_player)
         try:
-            self.cur.execute(sql, params)
+            self.league_join_many(season_name, [(discord_id, is_player)], team)
         except sqlite3.IntegrityError:
             return
 
-        # Create seeds for the player
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (
-            SELECT t.id FROM team AS t
-            WHERE t.season_id IN season_ids AND t.name = ?
-        ),
-        user_ids AS (SELECT id FROM user WHERE discord_id = ?),
-        member_ids AS (
-            SELECT m.id FROM member AS m
-            WHERE m.team_id IN team_ids AND m.user_id IN user_ids
-        ),
-        week_ids AS (
-            SELECT id FROM week WHERE num = ? AND season_id IN season_ids
-        )
-
-        INSERT INTO seed(week_id, member_id, sub_member_id)
-        VALUES(
-            (SELECT * FROM week_ids),
-            (SELECT * FROM member_ids),
-            (SELECT * FROM member_ids)
-        )
-        ON CONFLICT(week_id, member_id) DO UPDATE SET request = 0
-        WHERE member_id IN member_ids AND week_id IN week_ids
-        ;"""
-        for i in range(1, 5):
-            params = (season_name, team, discord_id, i)
-            self.cur.execute(sql, params)
-        self.conn.commit()
-
         if sub_week is not None:
             self.request_sub(season_name, sub_week, discord_id)
 
-    def get_team_names(self, season_name):
-        # Grab team names
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?)
-        SELECT t.name FROM team AS t WHERE t.season_id IN season_ids
+    @fsq.writes("member", "seed", "game")
+    def league_join_many(self, season_name, members, team=SIGNUP_TEAM):
+        """Add many users to a team with their four weekly seeds
+
+        `members` holds (discord_id, is_player).  Runs in one transaction,
+        if any user can't join nobody is added and IntegrityError is raised.
+        """
+        members = list(members)
+        team_id = self.ids.team(season_name, team)
+        with self.transaction():
+            user_ids = self.get_user_ids(d for d, _ in members)
+
+            # Default team is signup
+            sql = """
+            INSERT OR REPLACE INTO member(user_id, team_id, is_player)
+            VALUES(?, ?, ?)
+            ;"""
+            params = [(user_ids.get(d), team_id, p) for d, p in members]
+            self.cur.executemany(sql, params)
+
+            # Create seeds for the players
+            sql = """
+            INSERT INTO seed(week_id, member_id, sub_member_id)
+            VALUES(
+                ?,
+                (SELECT m.id FROM member AS m WHERE m.user_id = ? AND m.team_id = ?),
+                (SELECT m.id FROM member AS m WHERE m.user_id = ? AND m.team_id = ?)
+            )
+            ON CONFLICT(week_id, member_id) DO UPDATE SET request = 0
+            ;"""
+            params = [
+                (
+                    self.ids.week(season_name, i),
+                    user_ids.get(d),
+                    team_id,
+                    user_ids.get(d),
+                    team_id,
+                )
+                for d, _ in members
+                for i in range(1, 5)
+            ]
+            self.cur.executemany(sql, params)
+
+    @fsq.writes("member")
+    def set_member_teams(self, season_name, assignments):
+        """Move many users between teams of a season in one transaction
+
+        `assignments` holds (user_id, team_name).
+        """
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        UPDATE member SET team_id = ?
+        WHERE member.user_id = ?
+        AND member.team_id IN ({fsq.in_list(team_ids)})
         ;"""
-        params = (season_name,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
-        team_names = [n for n in df["name"] if n != SIGNUP_TEAM]
+        params = [
+            (self.ids.team(season_name, team_name), user_id, *team_ids)
+            for user_id, team_name in assignments
+        ]
+        with self.transaction():
+            self.cur.executemany(sql, params)
+
+    def get_team_names(self, season_name):
+        team_names = self.ids.team_names(season_name)
+        team_names = [n for n in team_names if n != SIGNUP_TEAM]
         return team_names
 
+    @fsq.cached_read("team", "member", "user")
     def get_team_members(self, season_name, team, get_subs=False):
         # Then grab users to split into teams
         sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (
-            SELECT t.id FROM team AS t
-            WHERE t.season_id IN season_ids
-            AND t.name = ?
-        ),
+        WITH team_ids AS (SELECT t.id FROM team AS t WHERE t.id = ?),
         user_ids AS (
             SELECT m.user_id FROM member AS m
             WHERE m.team_id IN team_ids
@@ -471,17 +837,16 @@ def get_team_members(self, season_name, team, get_subs=False):
             u.chesscom AS chesscom
         FROM user AS u WHERE u.id IN user_ids
         ;"""
-        params = (season_name, team, int(not get_subs))
+        params = (self.ids.team(season_name, team), int(not get_subs))
         df = pd.read_sql_query(sql, self.conn, params=params)
         return df
 
     def reset_teams(self, season_name, assign_sub=False):
         # Then grab users to split into teams
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (
-            SELECT t.id FROM team AS t
-            WHERE t.season_id IN season_ids
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
         ),
         user_ids AS (
             SELECT m.user_id FROM member AS m
@@ -491,185 +856,208 @@ def reset_teams(self, season_name, assign_sub=False):
 
         SELECT u.id, u.chesscom FROM user AS u WHERE u.id IN user_ids
         ;"""
-        params = (season_name, int(not assign_sub))
+        params = (*team_ids, int(not assign_sub))
         df = pd.read_sql_query(sql, self.conn, params=params)
 
-        # Update sql
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids)
-        UPDATE member
-        SET team_id = (
-            SELECT t.id FROM team AS t
-            WHERE t.name = ?
-            AND t.season_id IN season_ids
-        )
-        WHERE member.team_id IN team_ids AND member.user_id = ?
-        ;"""
-        dfs = {SIGNUP_TEAM: df}
-        for team_name, df in dfs.items():
-            for row in df.itertuples():
-                params = (season_name, team_name, row.id)
-                self.cur.execute(sql, params)
-        self.conn.commit()
+        self.set_member_teams(season_name, [(i, SIGNUP_TEAM) for i in df["id"]])
+
+    @fsq.locks_itself
+    def get_split_pool(self, season_name, assign_sub=False):
+        """Players waiting for a team, with their ratings, and the team names"""
+        with self.lock:
+            team_names = self.get_team_names(season_name)
+            df = self.get_team_members(season_name, SIGNUP_TEAM, assign_sub)
+        ratings = self.chess_db.get_ratings(df["chesscom"])
+        df["rating"] = df["chesscom"].map(ratings["rapid"])
+        return df, team_names
 
     def assign_teams(self, season_name, assign_sub=False):
-        team_names = self.get_team_names(season_name)
-        df = self.get_team_members(season_name, SIGNUP_TEAM, assign_sub)
+        df, team_names = self.get_split_pool(season_name, assign_sub)
+        dfs, score = fpa.multi_start(even_split, (df, team_names), SPLIT_KWARGS)
+        self.set_member_teams(season_name, split_assignments(dfs))
+
+    async def assign_teams_async(self, season_name, assign_sub=False):
+        """`assign_teams` for the bot, splitting teams in other processes"""
+        adb = fsq.AsyncDatabase(self, self.executor, self.lock)
+        df, team_names = await adb.get_split_pool(season_name, assign_sub)
+        dfs, score = await fpa.multi_start_async(
+            even_split, (df, team_names), SPLIT_KWARGS
+        )
+        await self.write(self.set_member_teams, season_name, split_assignments(dfs))
 
-        # Assign users to teams
-        ratings = [self.chess_db.get_rating(c)["rapid"] for c in df["chesscom"]]
-        df["rating"] = ratings
+    def get_pairing_pool(self, season_name, rant_df, nort_df, planned=()):
+        """Both teams by rating and the (rant, nort) index pairs to avoid
 
-        score = np.inf
-        dfs = []
-        for _ in range(8):
-            new_dfs, new_score = even_split(df, team_names, verbose=False, iter_time=4)
-            if new_score < score:
-                score = new_score
-                dfs = new_dfs
-                print("new_score", score)
+        Those are the pairs that played this season and the `planned` pairs
+        of (rant, nort) user ids.
+        """
+        ratings = self.chess_db.get_ratings(
+            list(rant_df["chesscom"]) + list(nort_df["chesscom"])
+        )
+        rant_df["rating"] = rant_df["chesscom"].map(ratings["rapid"])
+        nort_df["rating"] = nort_df["chesscom"].map(ratings["rapid"])
 
-        # Update sql
+        rant_df = rant_df.sort_values(by=["rating"], ignore_index=True)
+        nort_df = nort_df.sort_values(by=["rating"], ignore_index=True)
+        rant_inds = {int(i): ind for ind, i in enumerate(rant_df["user_id"])}
+        nort_inds = {int(i): ind for ind, i in enumerate(nort_df["user_id"])}
+
+        game_history = set()
+        for rant_id, nort_id in self.get_game_pairs(season_name) | set(planned):
+            if rant_id in rant_inds and nort_id in nort_inds:
+                game_history.add((rant_inds[rant_id], nort_inds[nort_id]))
+        return rant_df, nort_df, game_history
+
+    @fsq.cached_read(*GAME_INFO_TABLES)
+    def get_game_pairs(self, season_name):
+        """(rant, nort) user ids of the games seeded this season"""
         sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids)
-        UPDATE member
-        SET team_id = (
-            SELECT t.id FROM team AS t
-            WHERE t.name = ?
-            AND t.season_id in season_ids
-        )
-        WHERE member.team_id IN team_ids AND member.user_id = ?
+        SELECT gi.white_team_name, gi.white_user_id, gi.black_user_id
+        FROM game_info AS gi
+        WHERE gi.season_id = ?
         ;"""
-        for team_name, df in dfs.items():
-            for row in df.itertuples():
-                params = (season_name, team_name, row.user_id)
-                self.cur.execute(sql, params)
-        self.conn.commit()
+        params = (self.ids.season(season_name),)
+        with self.pool.reader() as conn:
+            rows = fsq.fetch_all(conn, sql, params)
+        pairs = set()
+        for team_name, white_id, black_id in rows:
+            if team_name == "Team Carlsen":
+                pairs.add((white_id, black_id))
+            else:
+                pairs.add((black_id, white_id))
+        return pairs
 
-    def seed_games(self, season_name, week_num):
-        # TODO: don't let a player sit out more than one game a season
+    def pair_week(self, season_name, rant_df, nort_df, planned=()):
+        """(rant, nort) user ids of one week's games, avoiding `planned` pairs"""
+        rant_df, nort_df, game_history = self.get_pairing_pool(
+            season_name, rant_df, nort_df, planned
+        )
 
-        rant_df = self.get_team_members(season_name, "Team Carlsen")
-        rant_df["rating"] = [
-            self.chess_db.get_rating(row.chesscom)["rapid"]
-            for row in rant_df.itertuples()
-        ]
+        # Exact minimum over all pairings of the largest squared rating gap
+        # plus 0.01 of the mean, rematches forbidden
+        ratings = rant_df["rating"], nort_df["rating"]
+        try:
+            costs = fpa.pairing_costs(*ratings, game_history)
+            rant_rows, nort_rows, score = fpa.best_pairing(costs)
+        except fpa.PairingError:
+            # Late in a season some rematches may be unavoidable
+            rant_rows, nort_rows, score = fpa.multi_start(
+                fpa.search_pairing, (*ratings, game_history), {"iter_time": 4}
+            )
+        return list(
+            zip(
+                rant_df["user_id"].iloc[rant_rows].astype(int),
+                nort_df["user_id"].iloc[nort_rows].astype(int),
+            )
+        )
 
-        nort_df = self.get_team_members(season_name, "Team Nepomniachtchi")
-        nort_df["rating"] = [
-            self.chess_db.get_rating(row.chesscom)["rapid"]
-            for row in nort_df.itertuples()
-        ]
+    @fsq.writes("plan")
+    def plan_season(self, season_name, week_nums=(1, 2, 3, 4)):
+        """Pair the weeks `week_nums` all at once and store them as the plan
 
-        rant_df = rant_df.sort_values(by=["rating"], ignore_index=True)
-        nort_df = nort_df.sort_values(by=["rating"], ignore_index=True)
-        rant_df_ids = [int(i) for i in rant_df["discord_id"]]
-        nort_df_ids = [int(i) for i in nort_df["discord_id"]]
-
-        games_df = self.get_season_games(season_name)
-        game_history = []
-        for row in games_df.itertuples():
-            print(row)
-            if row.white_team_name == "Team Carlsen":
-                rant_id = row.white_discord_id
-                nort_id = row.black_discord_id
-            else:
-                nort_id = row.white_discord_id
-                rant_id = row.black_discord_id
+        Nobody meets the same opponent twice in the season and the largest
+        squared rating gap is as small as such a season allows, it is
+        returned.  `seed_games` then reads each week from the plan.  When no
+        such season exists the weeks are left unplanned and None returned,
+        `seed_games` then pairs each week on its own like `pair_week` does.
+        """
+        rant_df, nort_df, game_history = self.get_pairing_pool(
+            season_name,
+            self.get_team_members(season_name, "Team Carlsen"),
+            self.get_team_members(season_name, "Team Nepomniachtchi"),
+        )
+        costs = fpa.pairing_costs(rant_df["rating"], nort_df["rating"], game_history)
+        try:
+            max_gap, plan = fpa.season_pairings(costs, len(week_nums))
+        except fpa.PairingError:
+            max_gap, plan = None, []
 
-            if rant_id not in rant_df_ids:
-                continue
-            if nort_id not in nort_df_ids:
-                continue
+        sql = """
+        INSERT INTO plan(week_id, member_id, opponent_id)
+        VALUES(
+            ?,
+            (SELECT m.id FROM member AS m WHERE m.team_id = ? AND m.user_id = ?),
+            (SELECT m.id FROM member AS m WHERE m.team_id = ? AND m.user_id = ?)
+        )
+        ;"""
+        rant_team_id = self.ids.team(season_name, "Team Carlsen")
+        nort_team_id = self.ids.team(season_name, "Team Nepomniachtchi")
+        week_ids = [self.ids.week(season_name, num) for num in week_nums]
+        params = [
+            (
+                week_id,
+                rant_team_id,
+                int(rant_df["user_id"].iloc[r]),
+                nort_team_id,
+                int(nort_df["user_id"].iloc[n]),
+            )
+            for week_id, (rant_rows, nort_rows) in zip(week_ids, plan)
+            for r, n in zip(rant_rows, nort_rows)
+        ]
+        delete_sql = f"""
+        DELETE FROM plan WHERE plan.week_id IN ({fsq.in_list(week_ids)})
+        ;"""
+        with self.transaction():
+            self.cur.execute(delete_sql, week_ids)
+            self.cur.executemany(sql, params)
+        return max_gap
+
+    @fsq.cached_read("plan", "member")
+    def get_week_plan(self, season_name, week_num):
+        """(member, opponent) user ids of the planned games of a week"""
+        sql = """
+        SELECT m.user_id, o.user_id FROM plan AS p
+        JOIN member AS m ON p.member_id = m.id
+        JOIN member AS o ON p.opponent_id = o.id
+        WHERE p.week_id = ?
+        ;"""
+        params = (self.ids.week(season_name, week_num),)
+        with self.pool.reader() as conn:
+            return fsq.fetch_all(conn, sql, params)
 
-            rant_ind = rant_df_ids.index(rant_id)
-            nort_ind = nort_df_ids.index(nort_id)
-
-            game_history.append((rant_ind, nort_ind))
-        game_history = set(game_history)
-
-        def score_inds(rant_inds, nort_inds, verbose=False):
-            for r, n in zip(rant_inds, nort_inds):
-                if (int(r), int(n)) in game_history:
-                    return np.inf
-            rdf = rant_df.iloc[rant_inds]
-            ndf = nort_df.iloc[nort_inds]
-
-            scores = []
-            for rr, nr in zip(rdf.itertuples(), ndf.itertuples()):
-                scores.append((rr.rating - nr.rating) ** 2)
-
-            score = 0.01 * int(np.mean(scores)) + max(scores)
-            if verbose:
-                print(sorted(scores))
-            return score
-
-        def swap_random(seq):
-            idx = range(len(seq))
-            i1, i2 = random.sample(idx, 2)
-            seq[i1], seq[i2] = seq[i2], seq[i1]
-
-        def gen_team_dfs():
-            print(rant_df)
-            rant_inds = list(range(len(rant_df)))
-            nort_inds = list(range(len(nort_df)))
-            score = score_inds(rant_inds, nort_inds)
-            start = time.time()
-            rdf = rant_df.iloc[rant_inds]
-            ndf = nort_df.iloc[nort_inds]
-            counter = 0
-            iter_count = 1
-            while time.time() - start < 4:
-                counter += 1
-                old_rant_inds = list(rant_inds)
-                old_nort_inds = list(nort_inds)
-                iter_count += 0.01
-                for _ in range(int(iter_count)):
-                    if random.random() < 0.5:
-                        swap_random(rant_inds)
-                    else:
-                        swap_random(nort_inds)
-                    new_score = score_inds(rant_inds, nort_inds)
-
-                    if new_score < score:
-                        iter_count = 1
-
-                        old_rant_inds = rant_inds
-                        old_nort_inds = nort_inds
-
-                        rdf = rant_df.iloc[old_rant_inds]
-                        ndf = nort_df.iloc[old_nort_inds]
-                        to_print = [
-                            ((rr.rating - nr.rating) ** 2, f"{rr.rating}-{nr.rating}")
-                            for rr, nr in zip(rdf.itertuples(), ndf.itertuples())
-                        ]
-                        to_print = sorted(to_print)
-                        to_print = [t[1] for t in to_print]
-                        print(score, new_score, to_print[-1], time.time() - start)
-                        score = new_score
-
-                rant_inds = old_rant_inds
-                nort_inds = old_nort_inds
-            print()
-            return score, rdf, ndf
+    @fsq.cached_read("plan", "week", "member")
+    def get_later_plan(self, season_name, week_num):
+        """(member, opponent) user ids planned for the weeks after `week_num`"""
+        sql = """
+        SELECT m.user_id, o.user_id FROM plan AS p
+        JOIN week AS w ON p.week_id = w.id
+        JOIN member AS m ON p.member_id = m.id
+        JOIN member AS o ON p.opponent_id = o.id
+        WHERE w.season_id = ? AND w.num > ?
+        ;"""
+        params = (self.ids.season(season_name), week_num)
+        with self.pool.reader() as conn:
+            return fsq.fetch_all(conn, sql, params)
 
-        dfs = [gen_team_dfs() for _ in range(16)]
-        dfs = sorted(dfs, key=lambda x: x[0])
-        print([d[0] for d in dfs])
-        score, rdf, ndf = dfs[0]
+    @fsq.writes("game")
+    def seed_games(self, season_name, week_num):
+        # TODO: don't let a player sit out more than one game a season
 
-        rant_df = rdf
-        nort_df = ndf
-        print(rdf)
-        print(ndf)
-        print(score)
-        print(score)
+        rant_df = self.get_team_members(season_name, "Team Carlsen")
+        nort_df = self.get_team_members(season_name, "Team Nepomniachtchi")
 
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        # Planned games of players still on their teams that haven't played
+        # already, the rest of the players, like late joiners, are paired
+        # now without taking a game planned for a later week
+        rant_ids, nort_ids = set(rant_df["user_id"]), set(nort_df["user_id"])
+        played = self.get_game_pairs(season_name)
+        pairs = [
+            (r, n)
+            for r, n in self.get_week_plan(season_name, week_num)
+            if r in rant_ids and n in nort_ids and (r, n) not in played
+        ]
+        planned = [user_id for pair in pairs for user_id in pair]
+        rant_df = rant_df[~rant_df["user_id"].isin(planned)]
+        nort_df = nort_df[~nort_df["user_id"].isin(planned)]
+        if len(rant_df) and len(nort_df):
+            later = self.get_later_plan(season_name, week_num)
+            pairs += self.pair_week(season_name, rant_df, nort_df, later)
+
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         white_member_ids AS (
             SELECT m.id FROM member AS m
             WHERE m.team_id IN team_ids AND m.user_id = ?
@@ -677,10 +1065,6 @@ def gen_team_dfs():
         black_member_ids AS (
             SELECT m.id FROM member AS m
             WHERE m.team_id IN team_ids AND m.user_id = ?
-        ),
-        week_ids AS (
-            SELECT w.id FROM week AS w
-            WHERE w.num = ? AND w.season_id IN season_ids
         )
 
         INSERT INTO game(white_seed_id, black_seed_id)
@@ -688,102 +1072,70 @@ def gen_team_dfs():
             (
                 SELECT s.id FROM seed AS s
                 WHERE s.sub_member_id IN white_member_ids
-                AND s.week_id in week_ids
+                AND s.week_id = ?
             ),
             (
                 SELECT s.id FROM seed AS s
                 WHERE s.sub_member_id IN black_member_ids
-                AND s.week_id in week_ids
+                AND s.week_id = ?
             )
         )
         ;"""
 
-        for r, n in zip(rdf.itertuples(), ndf.itertuples()):
-            both_ids = [r.user_id, n.user_id]
+        week_id = self.ids.week(season_name, week_num)
+        params = []
+        for pair in pairs:
+            both_ids = list(pair)
             np.random.shuffle(both_ids)
             white_id, black_id = int(both_ids[0]), int(both_ids[1])
-            params = (season_name, white_id, black_id, week_num)
-            print(params)
-            self.cur.execute(sql, params)
-        self.conn.commit()
+            params.append((*team_ids, white_id, black_id, week_id, week_id))
+        with self.transaction():
+            self.cur.executemany(sql, params)
 
+    @fsq.locks_itself
+    @fsq.cached_read(*GAME_INFO_TABLES, "chess")
     def get_games_by_week(self, season_name, week_num):
         sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
-        user_ids AS (SELECT u.id FROM user AS u),
-        member_ids AS (
-            SELECT m.id FROM member AS m
-            WHERE m.team_id IN team_ids AND m.user_id IN user_ids
-        ),
-        week_ids AS (
-            SELECT w.id FROM week AS w
-            WHERE w.season_id IN season_ids AND w.num = ?
-        ),
-        seed_ids AS (
-            SELECT s.id FROM seed AS s
-            WHERE s.week_id IN week_ids AND s.sub_member_id IN member_ids
-        )
         SELECT
-            g.id,
-            g.schedule,
-            g.result,
-            g.url,
-            wu.discord_id,
-            wu.discord_name,
-            wu.chesscom,
-            bu.discord_id,
-            bu.discord_name,
-            bu.chesscom
-        FROM game AS g
-        LEFT JOIN seed AS ws ON g.white_seed_id = ws.id
-        LEFT JOIN member AS wm ON ws.sub_member_id = wm.id
-        LEFT JOIN user AS wu ON wm.user_id = wu.id
-        LEFT JOIN seed AS bs ON g.black_seed_id = bs.id
-        LEFT JOIN member AS bm ON bs.sub_member_id = bm.id
-        LEFT JOIN user AS bu ON bm.user_id = bu.id
-        WHERE g.black_seed_id IN seed_ids OR g.white_seed_id IN seed_ids
+            gi.game_id,
+            gi.schedule,
+            gi.result,
+            gi.url,
+            gi.white_discord_id,
+            gi.white_discord_name,
+            gi.white_chesscom,
+            gi.black_discord_id,
+            gi.black_discord_name,
+            gi.black_chesscom,
+            wc.rapid AS white_rapid_rating,
+            bc.rapid AS black_rapid_rating
+        FROM game_info AS gi
+        LEFT JOIN chess.chess AS wc
+            ON gi.white_chesscom = wc.chesscom AND wc.exists_user = 1
+        LEFT JOIN chess.chess AS bc
+            ON gi.black_chesscom = bc.chesscom AND bc.exists_user = 1
+        WHERE gi.season_id = ? AND gi.week_num = ?
+        ORDER BY
+            white_rapid_rating NULLS LAST,
+            black_rapid_rating NULLS LAST
         ;"""
-        params = (season_name, week_num)
-        df = pd.read_sql_query(sql, self.conn, params=params)
-        df.columns = [
-            "game_id",
-            "schedule",
-            "result",
-            "url",
-            "white_discord_id",
-            "white_discord_name",
-            "white_chesscom",
-            "black_discord_id",
-            "black_discord_name",
-            "black_chesscom",
-        ]
-        df["white_rapid_rating"] = [
-            self.chess_db.get_rating(c)["rapid"] for c in df["white_chesscom"]
-        ]
-        df["black_rapid_rating"] = [
-            self.chess_db.get_rating(c)["rapid"] for c in df["black_chesscom"]
-        ]
-        df = df.sort_values(
-            by=["white_rapid_rating", "black_rapid_rating"],
-            ignore_index=True,
-        )
+        params = (self.ids.season(season_name), week_num)
+        df = self.read_rated(sql, params, ["white_chesscom", "black_chesscom"])
         return df
 
+    @fsq.cached_read("team", "week", "member", "seed", "user")
     def get_sub_announce(self, season_name, week_num, discord_id):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?),
         member_ids AS (
             SELECT m.id FROM member AS m
             WHERE m.team_id IN team_ids AND m.user_id IN user_ids
         ),
-        week_ids AS (
-            SELECT w.id FROM week AS w
-            WHERE w.season_id IN season_ids
-            AND w.num = ?
-        )
+        week_ids AS (SELECT w.id FROM week AS w WHERE w.id = ?)
         SELECT
             s.id AS seed_id,
             u.discord_name AS discord_name,
@@ -794,28 +1146,25 @@ def get_sub_announce(self, season_name, week_num, discord_id):
         LEFT JOIN team AS t ON m.team_id = t.id
         WHERE s.week_id IN week_ids AND s.sub_member_id IN member_ids
         ;"""
-        params = (season_name, discord_id, week_num)
+        params = (*team_ids, discord_id, self.ids.week(season_name, week_num))
         df = pd.read_sql_query(sql, self.conn, params=params)
         return df
 
+    @fsq.writes("seed")
     def set_sub_thread_id(self, seed_id, sub_thread_id):
         sql = """
         UPDATE seed SET sub_thread_id = ? WHERE seed.id = ?
         ;"""
         params = (sub_thread_id, seed_id)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        with self.transaction():
+            self.cur.execute(sql, params)
 
+    @fsq.cached_read(*GAME_INFO_TABLES)
     def get_gameid_from_seedid(self, seed_id):
         sql = """
-        SELECT g.id, wu.discord_id, bu.discord_id FROM game AS g
-        LEFT JOIN seed AS ws ON g.white_seed_id = ws.id
-        LEFT JOIN member AS wm ON ws.sub_member_id = wm.id
-        LEFT JOIN user AS wu ON wm.user_id = wu.id
-        LEFT JOIN seed AS bs ON g.black_seed_id = bs.id
-        LEFT JOIN member AS bm ON bs.sub_member_id = bm.id
-        LEFT JOIN user AS bu ON bm.user_id = bu.id
-        WHERE g.white_seed_id = ? OR g.black_seed_id = ?
+        SELECT gi.game_id, gi.white_discord_id, gi.black_discord_id
+        FROM game_info AS gi
+        WHERE gi.white_seed_id = ? OR gi.black_seed_id = ?
         ;"""
         params = (seed_id, seed_id)
         df = pd.read_sql_query(sql, self.conn, params=params)
@@ -826,6 +1175,7 @@ def get_gameid_from_seedid(self, seed_id):
         ]
         return df
 
+    @fsq.cached_read("season", "team", "week", "member", "seed", "user")
     def get_claim_sub_from(self, seed_id):
         sql = """
         SELECT
@@ -843,13 +1193,15 @@ def get_claim_sub_from(self, seed_id):
         AND request = 1
         ;"""
         params = (seed_id,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
-        return df
+        return fsq.fetch_one(self.conn, sql, params, ClaimSubRow)
 
+    @fsq.cached_read("team", "member", "user")
     def get_claim_sub_to(self, season_name, discord_id):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?),
         member_ids AS (
             SELECT m.id FROM member AS m
@@ -860,7 +1212,7 @@ def get_claim_sub_to(self, season_name, discord_id):
         LEFT JOIN team AS t on m.team_id = t.id
         WHERE m.user_id IN user_ids AND m.team_id IN team_ids
         ;"""
-        params = (season_name, discord_id)
+        params = (*team_ids, discord_id)
         df = pd.read_sql_query(sql, self.conn, params=params)
         df.columns = [
             "member_id",
@@ -869,10 +1221,13 @@ def get_claim_sub_to(self, season_name, discord_id):
         ]
         return df
 
+    @fsq.writes("seed", "game")
     def update_sub(self, season_name, seed_id, discord_id):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (SELECT t.id FROM team AS t WHERE t.season_id IN season_ids),
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        ),
         user_ids AS (SELECT u.id FROM user AS u WHERE u.discord_id = ?)
         UPDATE seed SET
         sub_member_id = (
@@ -882,36 +1237,37 @@ def update_sub(self, season_name, seed_id, discord_id):
         request = 0
         WHERE seed.id = ?
         ;"""
-        params = (season_name, discord_id, seed_id)
-        self.cur.execute(sql, params)
-        self.conn.commit()
-
-        sql = """
-        WITH seed_ids AS (SELECT s.id FROM seed AS s WHERE s.id = ?)
-        UPDATE game SET
-        schedule = ?
-        WHERE game.black_seed_id IN seed_ids OR game.white_seed_id IN seed_ids
+        params = (*team_ids, discord_id, seed_id)
+        game_sql = """
+        UPDATE game SET schedule = ?
+        WHERE game.black_seed_id = ? OR game.white_seed_id = ?
         ;"""
-        params = (seed_id, None)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        game_params = (None, seed_id, seed_id)
+        with self.transaction():
+            self.cur.execute(sql, params)
+            self.cur.execute(game_sql, game_params)
 
+    @fsq.writes("team")
     def set_team_names(self, season_name, team_names):
         sql = """
-        INSERT OR IGNORE INTO team(season_id, name)
-        VALUES(
-            (SELECT s.id FROM season AS s WHERE s.name = ?),
-            ?
-        );"""
-        for team_name in team_names:
-            params = (season_name, team_name)
-            self.cur.execute(sql, params)
-        self.conn.commit()
+        INSERT OR IGNORE INTO team(season_id, name) VALUES(?, ?)
+        ;"""
+        season_id = self.ids.season(season_name)
+        params = [(season_id, team_name) for team_name in team_names]
+        try:
+            with self.transaction():
+                self.cur.executemany(sql, params)
+        finally:
+            self.ids.clear()
 
+    @fsq.locks_itself
+    @fsq.cached_read("week", "member", "seed", "user", "chess")
     def update_signup_info(self, season_name):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        week_ids AS (SELECT w.id FROM week AS w WHERE w.season_id IN season_ids)
+        week_ids = self.ids.season_weeks(season_name)
+        sql = f"""
+        WITH week_ids AS (
+            SELECT w.id FROM week AS w WHERE w.id IN ({fsq.in_list(week_ids)})
+        )
         SELECT
             u.discord_name,
             u.chesscom,
@@ -924,8 +1280,9 @@ def update_signup_info(self, season_name):
         LEFT JOIN user AS u ON mb.user_id = u.id
         WHERE sd.week_id IN week_ids
         ;"""
-        params = (season_name,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
+        params = week_ids
+        with self.lock:
+            df = pd.read_sql_query(sql, self.conn, params=params)
         df = df.pivot(
             index=["discord_name", "chesscom", "is_player"],
             columns="num",
@@ -934,10 +1291,10 @@ def update_signup_info(self, season_name):
         df.columns = df.columns.get_level_values(0)
         yes_no_dict = {0: "No", 1: "Yes"}
         substitute_dict = {0: "Substitute", 1: "Player"}
+        chesscoms = df.index.get_level_values("chesscom")
+        ratings = self.chess_db.get_ratings(chesscoms)
         df_dict = {
-            "Rapid Rating": [
-                self.chess_db.get_rating(row[1])["rapid"] for row in df.index
-            ],
+            "Rapid Rating": chesscoms.map(ratings["rapid"]),
             "Discord Name": [row[0] for row in df.index],
             "Chesscom Name": [row[1] for row in df.index],
             "Role": [substitute_dict[row[2]] for row in df.index],
@@ -957,69 +1314,69 @@ def update_signup_info(self, season_name):
 
         return df
 
+    @fsq.writes("game")
     def set_result(self, game_id, result, url=None):
         sql = """
         UPDATE game SET result = ?, url = ? WHERE game.id = ?
         ;"""
         params = (result, url, game_id)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        with self.transaction():
+            self.cur.execute(sql, params)
 
+    @fsq.writes("game")
     def set_thread_id(self, game_id, thread_id):
         sql = """
         UPDATE game SET thread_id = ? WHERE game.id = ?
         ;"""
         params = (game_id, thread_id)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        with self.transaction():
+            self.cur.execute(sql, params)
 
+    @fsq.writes("game")
     def schedule(self, game_id, event_id, game_datetime):
         sql = """
         UPDATE game SET schedule = ?, event_id = ? WHERE game.id = ?
         ;"""
         params = (str(game_datetime), str(event_id), game_id)
-        self.cur.execute(sql, params)
-        self.conn.commit()
+        with self.transaction():
+            self.cur.execute(sql, params)
 
+    @fsq.locks_itself
+    @fsq.cached_read(*GAME_INFO_TABLES, "chess")
     def get_game_by_id(self, game_id):
         sql = """
         SELECT
-            g.id AS game_id,
-            g.schedule AS schedule,
-            g.event_id AS event_id,
-            g.result AS result,
-            g.url AS url,
-            wu.discord_id AS white_discord_id,
-            wu.discord_name AS white_discord_name,
-            wu.chesscom AS white_chesscom,
-            bu.discord_id AS black_discord_id,
-            bu.discord_name AS black_discord_name,
-            bu.chesscom AS black_chesscom
-        FROM game AS g
-        LEFT JOIN seed AS ws ON g.white_seed_id = ws.id
-        LEFT JOIN member AS wm ON ws.sub_member_id = wm.id
-        LEFT JOIN user AS wu ON wm.user_id = wu.id
-        LEFT JOIN seed AS bs ON g.black_seed_id = bs.id
-        LEFT JOIN member AS bm ON bs.sub_member_id = bm.id
-        LEFT JOIN user AS bu ON bm.user_id = bu.id
-        WHERE g.id = ?
+            gi.game_id,
+            gi.schedule,
+            gi.event_id,
+            gi.result,
+            gi.url,
+            gi.white_discord_id,
+            gi.white_discord_name,
+            gi.white_chesscom,
+            gi.black_discord_id,
+            gi.black_discord_name,
+            gi.black_chesscom,
+            wc.rapid AS white_rapid_rating,
+            bc.rapid AS black_rapid_rating
+        FROM game_info AS gi
+        LEFT JOIN chess.chess AS wc
+            ON gi.white_chesscom = wc.chesscom AND wc.exists_user = 1
+        LEFT JOIN chess.chess AS bc
+            ON gi.black_chesscom = bc.chesscom AND bc.exists_user = 1
+        WHERE gi.game_id = ?
         ;"""
         params = (game_id,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
-        df["white_rapid_rating"] = [
-            self.chess_db.get_rating(c)["rapid"] for c in df["white_chesscom"]
-        ]
-        df["black_rapid_rating"] = [
-            self.chess_db.get_rating(c)["rapid"] for c in df["black_chesscom"]
-        ]
+        df = self.read_rated(sql, params, ["white_chesscom", "black_chesscom"])
         return df
 
+    @fsq.locks_itself
+    @fsq.cached_read("team", "member", "user", "chess")
     def get_member_info(self, season_name):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (
-            SELECT t.id AS id FROM team AS t
-            WHERE t.season_id in season_ids
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
         )
 
         SELECT
@@ -1028,25 +1385,40 @@ def get_member_info(self, season_name):
             m.is_player AS is_player,
             t.name AS team_name,
             u.discord_name AS discord_name,
-            u.chesscom AS chesscom
+            u.chesscom AS chesscom,
+            c.rapid AS rapid_rating
         FROM member as m
         LEFT JOIN team AS t ON m.team_id = t.id
         LEFT JOIN user AS u ON m.user_id = u.id
+        LEFT JOIN chess.chess AS c
+            ON u.chesscom = c.chesscom AND c.exists_user = 1
         WHERE m.team_id IN team_ids
         ;"""
-        params = (season_name,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
-        df["rapid_rating"] = [
-            self.chess_db.get_rating(c)["rapid"] for c in df["chesscom"]
-        ]
+        params = team_ids
+        df = self.read_rated(sql, params, ["chesscom"])
         return df
 
+    @fsq.cached_read("team", "member", "user")
+    def get_season_chesscoms(self, season_name):
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
+        )
+        SELECT DISTINCT u.chesscom FROM member AS m
+        LEFT JOIN user AS u ON m.user_id = u.id
+        WHERE m.team_id IN team_ids AND u.chesscom IS NOT NULL
+        ;"""
+        params = team_ids
+        df = pd.read_sql_query(sql, self.conn, params=params)
+        return list(df["chesscom"])
+
+    @fsq.cached_read("team", "week", "member", "seed", "user")
     def get_request_info(self, season_name):
-        sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        team_ids AS (
-            SELECT t.id AS id FROM team AS t
-            WHERE t.season_id in season_ids
+        team_ids = self.ids.season_teams(season_name)
+        sql = f"""
+        WITH team_ids AS (
+            SELECT t.id FROM team AS t WHERE t.id IN ({fsq.in_list(team_ids)})
         ),
         member_ids AS (
             SELECT m.id AS id FROM member AS m
@@ -1062,52 +1434,39 @@ def get_request_info(self, season_name):
         LEFT JOIN week AS w ON s.week_id = w.id
         WHERE s.member_id IN member_ids
         ;"""
-        params = (season_name,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
+        params = team_ids
+        with self.pool.reader() as conn:
+            df = pd.read_sql_query(sql, conn, params=params)
         return df
 
+    @fsq.cached_read(*GAME_INFO_TABLES)
     def get_season_games(self, season_name):
         sql = """
-        WITH season_ids AS (SELECT s.id FROM season AS s WHERE s.name = ?),
-        week_ids AS (SELECT w.id FROM week AS w WHERE w.season_id IN season_ids),
-        seed_ids AS (SELECT s.id FROM seed AS s WHERE s.week_id IN week_ids)
-
         SELECT
-            g.id AS game_id,
-            g.schedule AS schedule,
-            g.result AS result,
-            g.url AS url,
-
-            wm.id AS white_member_id,
-            ww.num AS white_week_num,
-            wt.name AS white_team_name,
-            wu.discord_id AS white_discord_id,
-            wu.discord_name AS white_discord_name,
-            wu.chesscom AS white_chesscom,
-
-            bm.id AS black_member_id,
-            bw.num AS black_week_num,
-            bt.name AS black_team_name,
-            bu.discord_id AS black_discord_id,
-            bu.discord_name AS black_discord_name,
-            bu.chesscom AS black_chesscom
-        FROM game AS g
-        LEFT JOIN seed AS ws ON g.white_seed_id = ws.id
-        LEFT JOIN week AS ww ON ws.week_id = ww.id
-        LEFT JOIN member AS wm ON ws.sub_member_id = wm.id
-        LEFT JOIN user AS wu ON wm.user_id = wu.id
-        LEFT JOIN team AS wt ON wm.team_id = wt.id
-
-        LEFT JOIN seed AS bs ON g.black_seed_id = bs.id
-        LEFT JOIN week AS bw ON bs.week_id = bw.id
-        LEFT JOIN member AS bm ON bs.sub_member_id = bm.id
-        LEFT JOIN user AS bu ON bm.user_id = bu.id
-        LEFT JOIN team AS bt ON bm.team_id = bt.id
-
-        WHERE (g.black_seed_id IN seed_ids OR g.white_seed_id IN seed_ids)
+            gi.game_id,
+            gi.schedule,
+            gi.result,
+            gi.url,
+
+            gi.white_member_id,
+            gi.white_week_num,
+            gi.white_team_name,
+            gi.white_discord_id,
+            gi.white_discord_name,
+            gi.white_chesscom,
+
+            gi.black_member_id,
+            gi.black_week_num,
+            gi.black_team_name,
+            gi.black_discord_id,
+            gi.black_discord_name,
+            gi.black_chesscom
+        FROM game_info AS gi
+        WHERE gi.season_id = ?
         ;"""
-        params = (season_name,)
-        df = pd.read_sql_query(sql, self.conn, params=params)
+        params = (self.ids.season(season_name),)
+        with self.pool.reader() as conn:
+            df = pd.read_sql_query(sql, conn, params=params)
         return df
 
 
@@ -1123,6 +1482,73 @@ def gen_split_score(df, splits):
     return score
 
 
+class TeamSplit:
+    """Players split into teams, kept scored as `gen_split_score` would
+
+    Each team keeps its count, sum and sum of squares of known ratings,
+    centred on the pool mean, so a swap between two teams rescores them in
+    constant time instead of slicing the whole DataFrame.  The per-team
+    stats are plain lists, scalar access to them is the hot path.
+    """
+
+    def __init__(self, ratings, splits):
+        ratings = np.asarray(ratings, dtype=float)
+        known = ~np.isnan(ratings)
+        center = ratings[known].mean() if known.any() else 0.0
+        self.values = np.where(known, ratings - center, 0.0)
+        self.known = known.astype(float)
+        self.target_std = ratings[known].std(ddof=1) if known.sum() > 1 else np.nan
+        self.value_list = self.values.tolist()
+        self.known_list = self.known.tolist()
+        self.restore(splits)
+
+    def restore(self, splits):
+        self.splits = [np.array(s, dtype=int) for s in splits]
+        self.counts = [float(self.known[s].sum()) for s in self.splits]
+        self.sums = [float(self.values[s].sum()) for s in self.splits]
+        self.squares = [float((self.values[s] ** 2).sum()) for s in self.splits]
+        self.terms = [self.term(t) for t in range(len(self.splits))]
+
+    def snapshot(self):
+        return [s.copy() for s in self.splits]
+
+    def term(self, team):
+        count, total = self.counts[team], self.sums[team]
+        if count < 2:
+            return np.nan
+        variance = max((self.squares[team] - total * total / count) / (count - 1), 0)
+        return abs(total / count) + abs(variance**0.5 - self.target_std)
+
+    def score(self):
+        return sum(self.terms) / len(self.terms)
+
+    def move(self, team, player, sign):
+        value = self.value_list[player]
+        self.counts[team] += sign * self.known_list[player]
+        self.sums[team] += sign * value
+        self.squares[team] += sign * value * value
+
+    def swap(self, a, a_ind, b, b_ind):
+        """Swap a player of team a with one of team b, returning the new score"""
+        a_player, b_player = int(self.splits[a][a_ind]), int(self.splits[b][b_ind])
+        self.splits[a][a_ind], self.splits[b][b_ind] = b_player, a_player
+        self.move(a, a_player, -1)
+        self.move(a, b_player, 1)
+        self.move(b, b_player, -1)
+        self.move(b, a_player, 1)
+        self.terms[a] = self.term(a)
+        self.terms[b] = self.term(b)
+        return self.score()
+
+
+def split_assignments(dfs):
+    return [
+        (user_id, team_name)
+        for team_name, df in dfs.items()
+        for user_id in df["user_id"]
+    ]
+
+
 def even_split(df, team_names, iter_time=10, verbose=False):
     num_teams = len(team_names)
     df = df.reset_index(drop=True)
@@ -1133,49 +1559,28 @@ def even_split(df, team_names, iter_time=10, verbose=False):
         splits[r % num_teams].append(i)
     np.random.shuffle(splits)
 
-    score = gen_split_score(df, splits)
+    split = TeamSplit(df["rating"], splits)
+    score = split.score()
+    best_splits = split.snapshot()
     start = time.time()
     while time.time() - start < iter_time:
 
-        # Shuffle splits, preserve old splits if things go wrong
-        old_splits = [list(j) for j in splits]
-        old_score = score
+        # Wander for a round of swaps, then go back to the best split seen
         for _ in range(101):
-            a, b = [int(i) for i in random.sample(range(num_teams), 2)]
-            a_ind = int(random.sample(range(len(splits[a])), 1)[0])
-            b_ind = int(random.sample(range(len(splits[b])), 1)[0])
-            splits[a][a_ind], splits[b][b_ind] = splits[b][b_ind], splits[a][a_ind]
+            a, b = random.sample(range(num_teams), 2)
+            a_ind = random.randrange(len(split.splits[a]))
+            b_ind = random.randrange(len(split.splits[b]))
 
-            new_score = gen_split_score(df, splits)
+            new_score = split.swap(a, a_ind, b, b_ind)
             if new_score < score:
                 if verbose:
                     print(score, new_score)
                 score = new_score
-                for s in splits:
-                    if verbose:
-                        print(
-                            list(
-                                df.iloc[s].sort_values(by="rating", ignore_index=True)[
-                                    "rating"
-                                ]
-                            )
-                        )
-                if verbose:
-                    print()
-                new_splits = [list(j) for j in splits]
-        if score < old_score:
-            splits = new_splits
-            old_score = score
-        else:
-            splits = old_splits
-
-    if score < old_score:
-        splits = new_splits
-        old_score = score
-    else:
-        splits = old_splits
-    dfs = {t: df.iloc[s] for t, s in zip(team_names, splits)}
-    return dfs, old_score
+                best_splits = split.snapshot()
+        split.restore(best_splits)
+
+    dfs = {t: df.iloc[s] for t, s in zip(team_names, best_splits)}
+    return dfs, score
 
 
 def read_history():
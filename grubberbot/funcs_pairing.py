@@ -0,0 +1,468 @@
+import asyncio
+import heapq
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_flow
+
+# A pairing scores its largest squared rating gap plus this much of the mean
+# squared gap, so the worst game decides and the rest break ties
+MEAN_WEIGHT = 0.01
+
+# Independent restarts of a search, and how many must reach the best score
+# before the rest are cancelled
+RESTARTS = 8
+AGREE = 3
+
+# Process pool shared by every multi-start search, see `process_pool`
+POOL = None
+POOL_LOCK = threading.Lock()
+
+
+class PairingError(ValueError):
+    pass
+
+
+def pairing_costs(ratings_a, ratings_b, forbidden=()):
+    """Squared rating gap of every possible game, np.inf for rematches
+
+    `forbidden` holds (index in a, index in b) pairs that already played.
+    Missing ratings are treated as the median of the known ones.
+    """
+    a, b = fill_ratings(ratings_a, ratings_b)
+    costs = (a[:, None] - b[None, :]) ** 2
+    for i, j in forbidden:
+        costs[i, j] = np.inf
+    return costs
+
+
+def fill_ratings(ratings_a, ratings_b):
+    """Both teams' ratings as float arrays, missing ones set to the median"""
+    ratings = np.concatenate(
+        [np.asarray(ratings_a, dtype=float), np.asarray(ratings_b, dtype=float)]
+    )
+    known = ratings[~np.isnan(ratings)]
+    fill = np.median(known) if len(known) else 0.0
+    ratings = np.where(np.isnan(ratings), fill, ratings)
+    return ratings[: len(ratings_a)], ratings[len(ratings_a) :]
+
+
+def score_pairing(costs, rows, cols):
+    gaps = costs[rows, cols]
+    return gaps.max() + MEAN_WEIGHT * gaps.mean()
+
+
+def full_matching(costs, threshold):
+    """Whether every player of the smaller side has a game costing <= threshold"""
+    num_rows, num_cols = costs.shape
+    source, sink = num_rows + num_cols, num_rows + num_cols + 1
+    row_ind, col_ind = np.nonzero(costs <= threshold)
+    tails = [np.full(num_rows, source), row_ind, num_rows + np.arange(num_cols)]
+    heads = [np.arange(num_rows), num_rows + col_ind, np.full(num_cols, sink)]
+    graph = unit_graph(np.concatenate(tails), np.concatenate(heads), sink + 1)
+    value, _ = max_flow(graph, source, sink)
+    return value == min(costs.shape)
+
+
+def unit_graph(tails, heads, size, caps=None):
+    caps = np.ones(len(tails)) if caps is None else caps
+    return csr_matrix(
+        (np.asarray(caps, dtype=np.int32), (tails, heads)), shape=(size, size)
+    )
+
+
+def max_flow(graph, source, sink):
+    result = maximum_flow(graph, source, sink)
+    # scipy before 1.8 calls the flow `residual`
+    flow = result.flow if hasattr(result, "flow") else result.residual
+    return result.flow_value, flow
+
+
+def bottleneck(costs):
+    """Smallest largest-gap any complete pairing can have
+
+    The least total cost pairing bounds it from above and the cheapest game
+    of every player of the smaller side from below.  Binary search over the
+    distinct costs in between, each step a maximum flow through the games
+    that fit under the threshold.
+    """
+    rows, cols = min_cost_pairing(costs, np.inf)
+    if not np.isfinite(costs[rows, cols]).all():
+        raise PairingError("No pairing avoids every rematch")
+    axis = 1 if costs.shape[0] <= costs.shape[1] else 0
+    lower = costs.min(axis=axis).max()
+    upper = costs[rows, cols].max()
+    candidates = np.unique(costs[(costs >= lower) & (costs <= upper)])
+    low, high = 0, len(candidates) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if full_matching(costs, candidates[middle]):
+            high = middle
+        else:
+            low = middle + 1
+    return candidates[low]
+
+
+def min_cost_pairing(costs, threshold):
+    """Pairing with the least total cost among games costing <= threshold"""
+    allowed = np.isfinite(costs) & (costs <= threshold)
+    # Costlier than any pairing of allowed games, so used only when forced
+    big = costs[allowed].sum() + 1
+    return linear_sum_assignment(np.where(allowed, costs, big))
+
+
+def best_pairing(costs):
+    """Exact minimum of `score_pairing` over complete pairings
+
+    Every player of the smaller side gets a game.  The optimum has some
+    largest gap t, and for a given t the best pairing is the least total cost
+    one using games up to t.  Trying t from the bottleneck upwards can stop
+    once t alone exceeds the best score found.  Returns (rows, cols, score).
+    """
+    costs = np.asarray(costs, dtype=float)
+    if min(costs.shape) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, 0.0
+    start = bottleneck(costs)
+    candidates = np.unique(costs[np.isfinite(costs) & (costs >= start)])
+
+    best = None
+    for threshold in candidates:
+        if best is not None and threshold >= best[2]:
+            break
+        rows, cols = min_cost_pairing(costs, threshold)
+        score = score_pairing(costs, rows, cols)
+        if best is None or score < best[2]:
+            best = rows, cols, score
+    return best
+
+
+class PairingSearch:
+    """Local search over pairings that may have to repeat games
+
+    When `best_pairing` finds no pairing free of rematches, this swaps
+    opponents at random, keeping swaps that do not make the score worse.
+    Scores are (rematches, largest gap + MEAN_WEIGHT * mean gap).
+
+    Every player of the smaller team has a board.  `order` lists the other
+    team, the first of them facing the boards in turn and the rest sitting
+    out.  A swap changes at most two boards, updating the rematch count and
+    gap total in place and pushing the new gaps onto a max-heap.  Stale heap
+    entries are dropped when they reach the top, so a swap costs O(log n).
+    """
+
+    def __init__(self, ratings_a, ratings_b, forbidden=()):
+        a, b = fill_ratings(ratings_a, ratings_b)
+        rematch = np.zeros((len(a), len(b)), dtype=bool)
+        for i, j in forbidden:
+            rematch[i, j] = True
+        self.transposed = len(a) > len(b)
+        if self.transposed:
+            a, b, rematch = b, a, rematch.T
+        # Nested lists, indexing them is far cheaper than indexing arrays
+        self.gaps = ((a[:, None] - b[None, :]) ** 2).tolist()
+        self.rematch = rematch.tolist()
+        self.num_boards = len(a)
+        # Start from both teams zipped by rating
+        self.order = np.argsort(b, kind="stable").tolist()
+        boards = np.argsort(np.argsort(a, kind="stable"))
+        self.order[: len(a)] = [self.order[k] for k in boards]
+
+        self.board_gaps = [self.gaps[i][self.order[i]] for i in range(len(a))]
+        self.total = sum(self.board_gaps)
+        self.rematches = sum(self.rematch[i][self.order[i]] for i in range(len(a)))
+        self.heap = [(-gap, i) for i, gap in enumerate(self.board_gaps)]
+        heapq.heapify(self.heap)
+
+    def max_gap(self):
+        while self.heap and -self.heap[0][0] != self.board_gaps[self.heap[0][1]]:
+            heapq.heappop(self.heap)
+        return -self.heap[0][0] if self.heap else 0.0
+
+    def score(self):
+        if not self.num_boards:
+            return 0, 0.0
+        mean = self.total / self.num_boards
+        return self.rematches, self.max_gap() + MEAN_WEIGHT * mean
+
+    def set_board(self, board, opponent):
+        self.total += self.gaps[board][opponent] - self.board_gaps[board]
+        self.rematches += self.rematch[board][opponent]
+        self.rematches -= self.rematch[board][self.order[board]]
+        self.order[board] = opponent
+        self.board_gaps[board] = self.gaps[board][opponent]
+        heapq.heappush(self.heap, (-self.board_gaps[board], board))
+
+    def swap(self, x, y):
+        """Swap places x and y of `order`, returning the new score"""
+        opponent_x, opponent_y = self.order[x], self.order[y]
+        if x < self.num_boards:
+            self.set_board(x, opponent_y)
+        else:
+            self.order[x] = opponent_y
+        if y < self.num_boards:
+            self.set_board(y, opponent_x)
+        else:
+            self.order[y] = opponent_x
+        # Rebuild once stale entries dominate, keeping the heap O(n)
+        if len(self.heap) > 4 * self.num_boards + 16:
+            self.heap = [(-gap, i) for i, gap in enumerate(self.board_gaps)]
+            heapq.heapify(self.heap)
+        return self.score()
+
+    def run(self, iter_time=1.0, seed=None):
+        """Hill climb for `iter_time` seconds, returning (rows, cols, score)
+
+        Without a seed it draws from the `random` module, see `run_seeded`.
+        """
+        rng = random if seed is None else random.Random(seed)
+        score = self.score()
+        start = time.time()
+        size = len(self.order)
+        while self.num_boards and size > 1 and time.time() - start < iter_time:
+            # Check the clock every so often, it costs more than a swap
+            for _ in range(256):
+                x, y = rng.randrange(self.num_boards), rng.randrange(size)
+                if x == y:
+                    continue
+                new_score = self.swap(x, y)
+                if new_score <= score:
+                    score = new_score
+                else:
+                    self.swap(x, y)
+        return (*self.pairing(), score)
+
+    def pairing(self):
+        boards = np.arange(self.num_boards)
+        opponents = np.array(self.order[: self.num_boards], dtype=int)
+        if self.transposed:
+            return opponents, boards
+        return boards, opponents
+
+
+def season_factor(allowed, num_real, weeks, bench):
+    """Games for every player in each of `weeks` weeks, or None if impossible
+
+    `allowed` is square, its first `num_real` rows are the smaller team and
+    the rest are byes, "players" the larger team meets to sit a week out.
+    `bench` caps the byes of each player of the larger team.  Max flow from
+    every row and to every column `weeks` times, byes passing through a
+    bench node per column, gives a `weeks`-regular bipartite graph of the
+    games, returned as a bool matrix.
+    """
+    size = len(allowed)
+    source, sink = 3 * size, 3 * size + 1
+    rows = np.arange(size)
+    # Nodes are rows, then bench nodes, then columns, then source and sink
+    row_ind, col_ind = np.nonzero(allowed)
+    real = row_ind < num_real
+    heads = np.where(real, 2 * size + col_ind, size + col_ind)
+    tails = [np.full(size, source), row_ind, size + rows, 2 * size + rows]
+    heads = [rows, heads, 2 * size + rows, np.full(size, sink)]
+    caps = [np.full(size, weeks), np.ones(len(row_ind)), bench, np.full(size, weeks)]
+    graph = unit_graph(
+        np.concatenate(tails), np.concatenate(heads), sink + 1, np.concatenate(caps)
+    )
+    value, flow = max_flow(graph, source, sink)
+    if value < weeks * size:
+        return None
+    # Games are the flow out of the rows, into a bench node or a column
+    flow = flow.tocoo()
+    games = (flow.data > 0) & (flow.row < size)
+    factor = np.zeros_like(allowed)
+    factor[flow.row[games], flow.col[games] % size] = True
+    return factor
+
+
+def cheapest_week(costs, allowed):
+    """Least total cost week of games within `allowed`, or None"""
+    big = costs[allowed].sum() + 1
+    rows, cols = linear_sum_assignment(np.where(allowed, costs, big))
+    if not allowed[rows, cols].all():
+        return None
+    return cols
+
+
+def without_week(allowed, bench, cols, num_real):
+    """Games and byes still allowed once the week `cols` is played"""
+    rest = allowed.copy()
+    rest[np.arange(len(cols)), cols] = False
+    bench = bench - np.bincount(cols[num_real:], minlength=len(bench))
+    rest[num_real:, bench == 0] = False
+    return rest, bench
+
+
+def season_pairings(costs, weeks):
+    """`weeks` weeks of pairings at once, no game repeated within them
+
+    The largest cost of any game is the least any such season can have,
+    found by binary search over max flow feasibility, see `season_factor`.
+    Each player of the larger team sits out at most its share of the weeks.
+    Weeks are then taken one at a time, the cheapest that leaves the rest
+    feasible, else the cheapest within a feasible season.  Returns the
+    largest cost and a (rows, cols) pairing per week.
+    """
+    costs = np.asarray(costs, dtype=float)
+    transposed = costs.shape[0] > costs.shape[1]
+    if transposed:
+        costs = costs.T
+    num_real, size = costs.shape
+    if num_real == 0 or weeks == 0:
+        empty = np.zeros(0, dtype=int)
+        return 0.0, [(empty, empty)] * weeks
+
+    # Pad with byes, free and allowed against everyone
+    padded = np.vstack([costs, np.zeros((size - num_real, size))])
+    byes = -(-(size - num_real) * weeks // size)
+    bench = np.full(size, byes)
+
+    candidates = np.unique(costs[np.isfinite(costs)])
+    candidates = candidates[candidates >= bottleneck(costs)]
+
+    def feasible(threshold):
+        return season_factor(padded <= threshold, num_real, weeks, bench)
+
+    # Gallop up from the bound for one week, the sparse graphs near it are
+    # cheaper to test than the dense ones at the top
+    low, high, step = 0, 0, 1
+    while feasible(candidates[high]) is None:
+        if high == len(candidates) - 1:
+            raise PairingError("No season of pairings avoids every rematch")
+        low, high, step = high + 1, min(high + step, len(candidates) - 1), 2 * step
+    while low < high:
+        middle = (low + high) // 2
+        if feasible(candidates[middle]) is not None:
+            high = middle
+        else:
+            low = middle + 1
+    threshold = candidates[low]
+
+    allowed = padded <= threshold
+    plan = []
+    for left in range(weeks, 0, -1):
+        cols = cheapest_week(padded, allowed)
+        rest, rest_bench = without_week(allowed, bench, cols, num_real)
+        if season_factor(rest, num_real, left - 1, rest_bench) is None:
+            # Any week of a feasible season leaves the rest of it feasible
+            factor = season_factor(allowed, num_real, left, bench)
+            cols = cheapest_week(padded, factor)
+            rest, rest_bench = without_week(allowed, bench, cols, num_real)
+        allowed, bench = rest, rest_bench
+
+        rows = np.arange(num_real)
+        plan.append((cols[:num_real], rows) if transposed else (rows, cols[:num_real]))
+    return threshold, plan
+
+
+def search_pairing(ratings_a, ratings_b, forbidden=(), iter_time=1.0):
+    return PairingSearch(ratings_a, ratings_b, forbidden).run(iter_time)
+
+
+def run_seeded(func, seed, args, kwargs):
+    """Call `func` with both global random generators seeded, in a worker"""
+    random.seed(seed)
+    np.random.seed(seed)
+    return func(*args, **kwargs)
+
+
+def score_key(score):
+    """Sortable form of a float or tuple score, NaN ranking last"""
+    values = np.atleast_1d(np.asarray(score, dtype=float))
+    return tuple(np.where(np.isnan(values), np.inf, values))
+
+
+class BestOutcome:
+    """Best of the outcomes seen so far, each a tuple ending in its score"""
+
+    def __init__(self, agree):
+        self.agree = agree
+        self.outcome = None
+        self.keys = []
+
+    def add(self, outcome):
+        """Keep `outcome` if it is the best yet, True once enough agree"""
+        key = score_key(outcome[-1])
+        if self.outcome is None or key < score_key(self.outcome[-1]):
+            self.outcome = outcome
+        self.keys.append(key)
+        best = score_key(self.outcome[-1])
+        return sum(np.allclose(k, best) for k in self.keys) >= self.agree
+
+
+def process_pool():
+    """The worker processes every restart runs in, started on first use
+
+    Workers are spawned rather than forked, the bot's threads can't be
+    safely forked.  Each one imports the main module as `__mp_main__` when
+    it starts, which is why the pool is kept rather than started per call,
+    and entry points keep running the bot under `if __name__ == "__main__"`.
+    """
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            context = multiprocessing.get_context("spawn")
+            POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=context)
+        return POOL
+
+
+def submit_restarts(executor, func, args, kwargs, restarts, seed):
+    seeds = np.random.SeedSequence(seed).spawn(restarts)
+    return [
+        executor.submit(run_seeded, func, int(s.generate_state(1)[0]), args, kwargs)
+        for s in seeds
+    ]
+
+
+def multi_start(
+    func, args=(), kwargs=None, restarts=RESTARTS, agree=AGREE, seed=None, executor=None
+):
+    """Best of `restarts` calls of `func(*args, **kwargs)` across processes
+
+    `func` must be a module level function returning a tuple that ends in
+    its score, lower being better.  Every restart gets its own seed, see
+    `run_seeded`.  Once `agree` restarts have reached the best score the
+    remaining ones are cancelled.  Without an `executor` they run in the
+    shared `process_pool`.
+    """
+    pool = executor or process_pool()
+    futures = []
+    try:
+        futures = submit_restarts(pool, func, args, kwargs or {}, restarts, seed)
+        best = BestOutcome(agree)
+        for future in as_completed(futures):
+            if best.add(future.result()):
+                break
+    finally:
+        # Restarts still queued are dropped, the pool outlives the call
+        for future in futures:
+            future.cancel()
+    return best.outcome
+
+
+async def multi_start_async(
+    func, args=(), kwargs=None, restarts=RESTARTS, agree=AGREE, seed=None, executor=None
+):
+    """`multi_start` that awaits the restarts instead of blocking"""
+    pool = executor or process_pool()
+    futures = []
+    try:
+        futures = [
+            asyncio.wrap_future(f)
+            for f in submit_restarts(pool, func, args, kwargs or {}, restarts, seed)
+        ]
+        best = BestOutcome(agree)
+        for next_outcome in asyncio.as_completed(futures):
+            if best.add(await next_outcome):
+                break
+    finally:
+        # Restarts still queued are dropped, the pool outlives the call
+        for future in futures:
+            future.cancel()
+    return best.outcome
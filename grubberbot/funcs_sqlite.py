@@ -0,0 +1,542 @@
+import asyncio
+import collections
+import contextlib
+import copy
+import functools
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+# Read-only connections kept per database, and how long a connection waits
+# for a lock before raising "database is locked"
+POOL_READERS = 4
+BUSY_TIMEOUT_MS = 5000
+
+# Results kept by a QueryCache before the least recently used are dropped
+QUERY_CACHE_SIZE = 256
+
+# Most writes a WriteQueue applies under one commit
+WRITE_BATCH_SIZE = 64
+
+# Threads running blocking database calls for the event loop
+DB_WORKERS = 4
+
+# Names for in-memory databases, which must be named to be attached elsewhere
+MEMORY_NAMES = itertools.count()
+
+# Names for the savepoints of nested transactions
+SAVEPOINT_NAMES = itertools.count()
+
+# Most variables bound in one statement, the limit of SQLite before 3.32
+MAX_VARIABLES = 999
+
+
+class ConnectionPool:
+    """One writer connection plus a small pool of read-only connections
+
+    File databases are switched to WAL journaling, so a reader works on the
+    last committed snapshot and never blocks, or is blocked by, the writer.
+    The writer may be used from any thread but only by one at a time, callers
+    on several threads serialize on a lock like `AsyncDatabase` does.  Readers
+    can be borrowed from any thread.  An in-memory database lives in
+    a single connection, there `reader()` hands out the writer.
+
+    `uri` opens the database read-only, other pools can `attach` it to join
+    across databases.
+    """
+
+    def __init__(self, path, readers=POOL_READERS):
+        self.path = path
+        self.memory = path == ":memory:"
+        if self.memory:
+            name = f"memory-{next(MEMORY_NAMES)}"
+            self.uri = f"file:{name}?mode=memory&cache=shared"
+            self.writer = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        else:
+            path = urllib.parse.quote(os.path.abspath(self.path))
+            self.uri = f"file:{path}?mode=ro"
+            self.writer = sqlite3.connect(self.path, check_same_thread=False)
+        self.writer.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        if not self.memory:
+            self.writer.execute("PRAGMA journal_mode = WAL")
+            self.writer.execute("PRAGMA synchronous = NORMAL")
+        self.size = readers
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.attached = {}
+
+    def connect_reader(self):
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        for name, uri in self.attached.items():
+            conn.execute("ATTACH DATABASE ? AS ?", (uri, name))
+        return conn
+
+    def attach(self, name, uri):
+        """Attach the database at `uri` as schema `name` on every connection
+
+        Call before the pool hands out readers, readers opened later attach it
+        when they connect.
+        """
+        self.attached[name] = uri
+        self.writer.execute("ATTACH DATABASE ? AS ?", (uri, name))
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Borrow a read-only connection, waiting if all of them are in use
+
+        Everything read inside the `with` block comes from one snapshot.
+        """
+        if self.memory:
+            yield self.writer
+            return
+
+        with self.lock:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = None
+                create = self.created < self.size
+                self.created += create
+        if conn is None:
+            conn = self.connect_reader() if create else self.idle.get()
+        try:
+            conn.execute("BEGIN")
+            yield conn
+        finally:
+            conn.rollback()
+            self.idle.put(conn)
+
+    def backup(self, path):
+        """Copy a consistent snapshot of the database to `path`"""
+        dest = sqlite3.connect(path)
+        try:
+            with self.reader() as conn:
+                conn.backup(dest)
+        finally:
+            dest.close()
+
+    def close(self):
+        self.writer.close()
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    """Run the block as one transaction, or join the one already open
+
+    Only the outermost block commits, so bulk writes can be composed and still
+    cost a single commit.  Any exception rolls the whole transaction back, a
+    joined block is a savepoint and an exception leaving it undoes just that
+    block.
+    """
+    if conn.in_transaction:
+        name = f"nested_{next(SAVEPOINT_NAMES)}"
+        conn.execute(f"SAVEPOINT {name}")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute(f"ROLLBACK TO {name}")
+            conn.execute(f"RELEASE {name}")
+            raise
+        conn.execute(f"RELEASE {name}")
+        return
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+class Row:
+    """Compact result row, subclasses name their columns in `__slots__`
+
+    Columns read as attributes or by name, `row.chesscom == row["chesscom"]`.
+    Pass the class as `row` to `fetch_one` or `fetch_all`.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def factory(cls, cursor, values):
+        return cls(*values)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __repr__(self):
+        values = ", ".join(f"{n}={v!r}" for n, v in zip(self.__slots__, self))
+        return f"{type(self).__name__}({values})"
+
+    def as_dict(self):
+        return dict(zip(self.__slots__, self))
+
+
+def fetch_one(conn, sql, params=(), row=None):
+    """First row of a query as a `row` instance or a tuple, None if empty
+
+    Point lookups use this instead of `pd.read_sql_query`, a DataFrame costs
+    far more to build than the query itself.
+    """
+    cur = conn.execute(sql, params)
+    if row is not None:
+        cur.row_factory = row.factory
+    return cur.fetchone()
+
+
+def fetch_all(conn, sql, params=(), row=None):
+    cur = conn.execute(sql, params)
+    if row is not None:
+        cur.row_factory = row.factory
+    return cur.fetchall()
+
+
+def fetch_value(conn, sql, params=()):
+    """First column of the first row, None if there are no rows"""
+    values = conn.execute(sql, params).fetchone()
+    return None if values is None else values[0]
+
+
+class QueryCache:
+    """Read-through cache of query results, invalidated by write generations
+
+    Every table has a generation that write methods bump.  A cached result is
+    served while the tables it was read from are at the generation it was
+    stored with, and callers get a copy they are free to modify.  `sources`
+    maps extra dependencies, like an attached database, to a function
+    returning their current generation.  Writes made on `conn` outside the
+    write methods show up in `total_changes` and invalidate every entry.
+    """
+
+    def __init__(self, conn, sources=None, size=QUERY_CACHE_SIZE, enabled=True):
+        self.conn = conn
+        self.sources = sources or {}
+        self.size = size
+        self.enabled = enabled
+        self.generations = collections.Counter()
+        self.changes = conn.total_changes
+        self.entries = collections.OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+
+    def bump(self, tables):
+        with self.lock:
+            for table in tables:
+                self.generations[table] += 1
+            self.changes = self.conn.total_changes
+
+    def version(self, tables):
+        with self.lock:
+            if self.conn.total_changes != self.changes:
+                self.generations[None] += 1
+                self.changes = self.conn.total_changes
+            version = [self.generations[None]]
+            version += [self.generations[t] for t in tables if t not in self.sources]
+        version += [self.sources[t]() for t in tables if t in self.sources]
+        return tuple(version)
+
+    def storable(self):
+        # Uncommitted writes may still roll back, and pooled readers can't see
+        # them yet, so nothing read meanwhile is kept
+        return not self.conn.in_transaction
+
+    def read(self, method, tables, obj, args, kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+        if not self.enabled or key is None:
+            return method(obj, *args, **kwargs)
+
+        version = self.version(tables)
+        storable = self.storable()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return copy_result(entry[1])
+            self.stats["misses"] += 1
+
+        result = method(obj, *args, **kwargs)
+
+        # Only keep results no write overlapped, including writes made by the
+        # read itself such as refreshing ratings
+        if storable and self.storable() and self.version(tables) == version:
+            with self.lock:
+                self.entries[key] = (version, result)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return copy_result(result)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class WriteQueue:
+    """Single writer task applying queued writes in group commits
+
+    `submit` queues a call and waits for its result.  The writer takes every
+    call queued so far, up to `max_batch`, and runs them in one transaction
+    with a savepoint each, so a failing call only rolls back itself and
+    raises in its caller, while the batch costs a single commit.  Calls must
+    write through `conn` and join the open transaction, `transaction()` does.
+    With an `executor` batches run on its threads holding `lock`, and the
+    event loop stays free meanwhile.
+    """
+
+    def __init__(self, conn, max_batch=WRITE_BATCH_SIZE, executor=None, lock=None):
+        self.conn = conn
+        self.max_batch = max_batch
+        self.executor = executor
+        self.lock = lock or threading.RLock()
+        self.queue = None
+        self.task = None
+        self.metrics = {
+            "batches": 0,
+            "writes": 0,
+            "failures": 0,
+            "last_batch_size": 0,
+            "last_batch_seconds": 0.0,
+            "max_batch_size": 0,
+            "max_batch_seconds": 0.0,
+            "total_batch_seconds": 0.0,
+        }
+
+    def start(self):
+        """Start the writer task, on first use from the running event loop"""
+        if self.task is None or self.task.done():
+            self.queue = asyncio.Queue()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def submit(self, func, *args, **kwargs):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((func, args, kwargs, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            writes = [w for w in batch if w is not None]
+            if writes:
+                await self.apply(writes)
+            if len(writes) < len(batch):
+                return
+
+    async def apply(self, batch):
+        if self.executor is None:
+            outcomes = self.execute(batch)
+        else:
+            loop = asyncio.get_running_loop()
+            outcomes = await loop.run_in_executor(self.executor, self.execute, batch)
+        for future, result, error in outcomes:
+            if future.cancelled():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def execute(self, batch):
+        with self.lock:
+            start = time.perf_counter()
+            outcomes = []
+            try:
+                with transaction(self.conn):
+                    for func, args, kwargs, future in batch:
+                        self.conn.execute("SAVEPOINT write_queue")
+                        try:
+                            outcome = (future, func(*args, **kwargs), None)
+                        except Exception as e:
+                            self.conn.execute("ROLLBACK TO write_queue")
+                            outcome = (future, None, e)
+                        self.conn.execute("RELEASE write_queue")
+                        outcomes.append(outcome)
+            except Exception as e:
+                outcomes = [(future, None, e) for *_, future in batch]
+            elapsed = time.perf_counter() - start
+
+            metrics = self.metrics
+            metrics["batches"] += 1
+            metrics["writes"] += len(batch)
+            metrics["failures"] += sum(e is not None for _, _, e in outcomes)
+            metrics["last_batch_size"] = len(batch)
+            metrics["last_batch_seconds"] = elapsed
+            metrics["max_batch_size"] = max(metrics["max_batch_size"], len(batch))
+            metrics["max_batch_seconds"] = max(metrics["max_batch_seconds"], elapsed)
+            metrics["total_batch_seconds"] += elapsed
+        return outcomes
+
+    async def close(self):
+        """Apply the writes queued so far, then stop the writer task"""
+        if self.task is None or self.task.done():
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+
+class AsyncDatabase:
+    """Awaitable versions of a database's methods, run in a thread pool
+
+    `await adb.method(...)` runs `db.method(...)` on a thread of `executor`
+    while holding `lock`, so a slow query or chess.com fetch doesn't freeze
+    the event loop.  Databases whose methods call each other must share the
+    lock, their connections then see one caller at a time.  With `lock=None`
+    the database does its own locking, so callers are not held up by a fetch
+    that only waits on the network.  Methods marked `locks_itself` are run
+    without the lock too.
+    """
+
+    def __init__(self, db, executor, lock=None):
+        self.db = db
+        self.executor = executor
+        self.lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return method
+
+    async def run(self, func, *args, **kwargs):
+        """Run any blocking `func` that uses the database the same way"""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.locked, func, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    def locked(self, func, *args, **kwargs):
+        if self.lock is None or getattr(func, "locks_itself", False):
+            return func(*args, **kwargs)
+        with self.lock:
+            return func(*args, **kwargs)
+
+
+def copy_result(result):
+    if hasattr(result, "copy"):
+        return result.copy()
+    return copy.deepcopy(result)
+
+
+def cached_read(*tables):
+    """Serve a method from `self.cache` while `tables` are unchanged"""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            return self.cache.read(method, tables, self, args, kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def locks_itself(method):
+    """Mark a method that holds `self.lock` only around its SQLite work
+
+    `AsyncDatabase` then runs it without the lock, so a chess.com fetch made
+    in between doesn't hold up the other callers.
+    """
+    method.locks_itself = True
+    return method
+
+
+def writes(*tables):
+    """Bump the generation of `tables` in `self.cache` after the method runs"""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.cache.bump(tables)
+
+        return wrapper
+
+    return decorator
+
+
+def in_list(values):
+    """Placeholders for `x IN (...)`, an empty list matches nothing"""
+    return ", ".join("?" for _ in values) or "NULL"
+
+
+def in_chunks(values, size=MAX_VARIABLES):
+    """`values` split into lists short enough to bind in one `x IN (...)`
+
+    There is always at least one list, so a query over no values still runs
+    once and returns its empty result.
+    """
+    values = list(values)
+    return [values[i : i + size] for i in range(0, len(values), size)] or [[]]
+
+
+def get_user_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, migrations):
+    """Bring a database up to date with a list of migrations
+
+    `migrations[i]` is a list of SQL statements that moves the database from
+    version `i` to `i + 1`, the version is stored in `PRAGMA user_version`.
+    Each migration runs in its own transaction, so a failing migration leaves
+    the database at the previous version.  Returns the versions applied.
+    """
+    current = get_user_version(conn)
+    if current > len(migrations):
+        raise sqlite3.DatabaseError(
+            f"Database is at version {current}, "
+            f"newer than the {len(migrations)} known migrations"
+        )
+    if conn.in_transaction:
+        conn.commit()
+
+    applied = []
+    for version in range(current + 1, len(migrations) + 1):
+        conn.execute("BEGIN")
+        try:
+            for statement in migrations[version - 1]:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        applied.append(version)
+    return applied
+
+
+def explain(conn, sql, params=()):
+    """`EXPLAIN QUERY PLAN` details of a query, one line per step"""
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [row[-1] for row in rows]
@@ -1,5 +1,12 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 
+import funcs_benchmark as fbm
 import funcs_chesscom as fcc
 
 
@@ -10,5 +17,372 @@ def test_normal_url(self):
         self.assertEqual(fcc.game_id_from_url(game_id), result)
 
 
+class TestChesscomClient(unittest.TestCase):
+    def setUp(self):
+        self.server = fbm.LocalChesscomServer(
+            {"pawngrubber": fbm.gen_stats()}, handshake_delay=0
+        ).start()
+        self.client = fcc.ChesscomClient(base_url=self.server.base_url)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_reuses_connection(self):
+        for _ in range(5):
+            info = self.client.get_json("/player/pawngrubber/stats")
+        self.assertEqual(info["chess_rapid"]["last"]["rating"], 1500)
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_not_found(self):
+        with self.assertRaises(fcc.ChesscomNotFound) as context:
+            self.client.get_json("/player/nobody")
+        self.assertEqual(context.exception.status, 404)
+        self.assertEqual(self.client.metrics["retries"], 0)
+
+    def test_retries_transient_errors(self):
+        client = fcc.ChesscomClient(base_url=self.server.base_url, backoff=0.001)
+        self.server.failures["/pub/player/pawngrubber/stats"] = [429, 503]
+        info = client.get_json("/player/pawngrubber/stats")
+        self.assertEqual(info["chess_rapid"]["last"]["rating"], 1500)
+        self.assertEqual(client.metrics["requests"], 3)
+        self.assertEqual(client.metrics["retries"], 2)
+
+        self.server.failures["/pub/player/pawngrubber"] = [503, 503]
+        client.retries = 1
+        with self.assertRaises(fcc.ChesscomUnavailable) as context:
+            client.get_json("/player/pawngrubber")
+        self.assertEqual(context.exception.status, 503)
+        client.close()
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_spaces_out_bursts(self):
+        now = [0.0]
+        bucket = fcc.TokenBucket(rate=2, capacity=2, clock=lambda: now[0])
+        self.assertEqual([bucket.reserve() for _ in range(4)], [0, 0, 0.5, 1.0])
+        now[0] = 3.0
+        self.assertEqual(bucket.reserve(), 0)
+        bucket.pause(5)
+        self.assertEqual(bucket.reserve(), 5)
+
+
+class TestStatsSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.players = {"pawngrubber": fbm.gen_stats(rapid=1500)}
+        self.server = fbm.LocalChesscomServer(self.players, handshake_delay=0)
+        self.server.start()
+        self.client = fcc.ChesscomClient(base_url=self.server.base_url)
+        self.db = fcc.ChesscomDatabase(path=":memory:", client=self.client)
+
+    def tearDown(self):
+        self.db.quit()
+        self.client.close()
+        self.server.stop()
+
+    def test_one_stats_request(self):
+        self.db.get_rating("pawngrubber")
+        self.db.get_count("pawngrubber")
+        # One profile request and one /stats request
+        self.assertEqual(self.server.requests, 2)
+
+        tables = self.db.get_all_tables()
+        row = tables["chess"].iloc[0]
+        self.assertEqual(row["rapid_win"], 40)
+        self.assertEqual(row["blitz_draw"], 10)
+        self.assertEqual(row["daily_loss"], 0)
+        self.assertEqual(
+            fcc.decompress_stats(row["stats_raw"]), self.players["pawngrubber"]
+        )
+
+    def test_backfill(self):
+        self.db.get_rating("pawngrubber")
+        self.db.conn.execute("UPDATE chess SET rapid_win = NULL, rapid = NULL;")
+        self.assertEqual(self.db.backfill_stats(), 1)
+        requests = self.server.requests
+        row = self.db.get_all_tables()["chess"].iloc[0]
+        self.assertEqual((row["rapid"], row["rapid_win"]), (1500, 40))
+        self.assertEqual(self.server.requests, requests)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_fetches_share_one_request(self):
+        players = {"pawngrubber": fbm.gen_stats()}
+        server = fbm.LocalChesscomServer(
+            players, handshake_delay=0, response_delay=0.2
+        ).start()
+        client = fcc.ChesscomClient(base_url=server.base_url)
+
+        results = []
+        barrier = threading.Barrier(5)
+
+        def fetch():
+            barrier.wait()
+            results.append(client.get_json("/player/PawnGrubber/stats"))
+
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client.close()
+        server.stop()
+
+        self.assertEqual(len(results), 5)
+        self.assertEqual(server.requests, 1)
+        self.assertEqual(client.flights.stats, {"calls": 5, "shared": 4})
+        self.assertEqual(client.flights.calls, {})
+
+
+class TestNegativeCache(unittest.TestCase):
+    def test_concurrent_expiry(self):
+        # The clock yields to the other threads, every name has expired
+        def clock():
+            time.sleep(0)
+            return 100
+
+        missing = fcc.NegativeCache(ttl=10, clock=clock)
+        errors = []
+        barrier = threading.Barrier(8)
+
+        def check():
+            barrier.wait()
+            try:
+                for i in range(200):
+                    missing.add(f"nobody{i % 20}", added_time=0)
+                    self.assertNotIn(f"Nobody{i % 20}", missing)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=check) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(missing.stats, {"hits": 0, "misses": 8 * 200})
+
+
+class TestChesscomDatabase(unittest.TestCase):
+    def setUp(self):
+        players = {f"player{i}": fbm.gen_stats(rapid=1000 + i) for i in range(3)}
+        self.server = fbm.LocalChesscomServer(players, handshake_delay=0).start()
+        self.client = fcc.ChesscomClient(base_url=self.server.base_url)
+        self.db = fcc.ChesscomDatabase(path=":memory:", client=self.client)
+
+    def tearDown(self):
+        self.db.quit()
+        self.client.close()
+        self.server.stop()
+
+    def test_batch(self):
+        chesscoms = ["player0", "player1", "player2", "nobody", "player0"]
+        ratings = self.db.get_ratings(chesscoms)
+        self.assertEqual(
+            list(ratings.index), ["player0", "player1", "player2", "nobody"]
+        )
+        self.assertEqual(list(ratings["rapid"][:3]), [1000, 1001, 1002])
+        self.assertTrue(ratings["rapid"].isna()["nobody"])
+        self.assertEqual(self.db.get_rating("player1")["rapid"], 1001)
+
+        # Everything is fresh now, so no more requests are made
+        requests = self.server.requests
+        self.db.get_ratings(chesscoms)
+        self.assertEqual(self.server.requests, requests)
+
+    def test_many_users(self):
+        # SQLite before 3.32 binds at most 999 variables in a statement
+        if hasattr(self.db.conn, "setlimit"):
+            self.db.conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        chesscoms = [f"user{i}" for i in range(1500)]
+        for chesscom in chesscoms:
+            self.db._store_exists(chesscom, True)
+            self.db._store_stats(chesscom, fbm.gen_stats(rapid=1000))
+        self.db.conn.commit()
+        ratings = self.db.get_ratings(chesscoms)
+        self.assertEqual(list(ratings["rapid"]), [1000] * 1500)
+        self.assertEqual(self.db.plan_refresh(chesscoms), [])
+        self.assertEqual(self.server.requests, 0)
+
+    def test_transient_error_not_recorded(self):
+        self.db.client.retries = 0
+        self.server.failures["/pub/player/player0"] = [503]
+        with self.assertRaises(fcc.ChesscomUnavailable):
+            self.db.get_exists("player0")
+        sql = "SELECT * FROM chess;"
+        self.assertEqual(self.db.conn.execute(sql).fetchall(), [])
+        self.assertTrue(self.db.get_exists("player0"))
+
+    def test_negative_cache(self):
+        self.assertFalse(self.db.get_exists("Nobody"))
+        requests = self.server.requests
+        self.assertFalse(self.db.get_exists("nobody"))
+        self.assertTrue(self.db.get_ratings(["nobody"])["rapid"].isna().all())
+        self.assertEqual(self.db.plan_refresh(["nobody"]), [])
+        self.assertEqual(self.server.requests, requests)
+        self.assertEqual(self.db.missing.stats["hits"], 3)
+
+    def test_negative_cache_restart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "chesscom.sqlite3")
+            db = fcc.ChesscomDatabase(path=path, client=self.client)
+            self.assertFalse(db.get_exists("nobody"))
+            db.quit()
+
+            # Known-bad names are loaded back, and dropped once they exist
+            db = fcc.ChesscomDatabase(path=path, client=self.client)
+            self.assertIn("nobody", db.missing)
+            self.server.players["nobody"] = fbm.gen_stats()
+            self.assertTrue(db.set_exists("nobody"))
+            self.assertEqual(len(db.missing), 0)
+            db.quit()
+
+    def test_prewarm(self):
+        plan = self.db.prewarm(["player0", "player1", "nobody"], budget=2)
+        self.assertEqual(plan, [("player0", "exists"), ("player1", "exists")])
+
+        plan = self.db.prewarm(["player0", "player1", "nobody"])
+        self.assertEqual(len(plan), 3)
+        requests = self.server.requests
+        self.assertEqual(self.db.get_count("player0")["rapid_count"], 80)
+        self.assertEqual(self.db.get_rating("player1")["rapid"], 1001)
+        self.assertFalse(self.db.get_exists("nobody"))
+        self.assertEqual(self.server.requests, requests)
+
+        # Nothing is due until the lead time reaches the expiry
+        self.assertEqual(self.db.plan_refresh(["player0"], lead_time=60), [])
+        self.assertEqual(len(self.db.plan_refresh(["player0"], lead_time=3600)), 2)
+
+    def test_plan_exists_first(self):
+        # An expired user without stats is checked before its stats are fetched
+        self.db._store_exists("player0", True)
+        sql = "UPDATE chess SET exists_time = exists_time - 3600;"
+        self.db.conn.execute(sql)
+        self.db.conn.commit()
+        plan = self.db.plan_refresh(["player0", "player1"])
+        self.assertEqual(
+            plan,
+            [("player1", "exists"), ("player0", "exists"), ("player0", "stats")],
+        )
+        self.assertEqual(self.db.plan_refresh(["player0"], budget=1), plan[1:2])
+
+    def test_refresh_failure_logged(self):
+        self.db.client.retries = 0
+        self.server.failures["/pub/player/player0"] = [503]
+        with self.assertLogs(fcc.LOGGER, "WARNING") as logs:
+            results = self.db.fetch_refresh([("player0", "exists")])
+        self.assertEqual(results, [None])
+        self.assertIn("Traceback", logs.output[0])
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    def setUp(self):
+        self.players = {"pawngrubber": fbm.gen_stats(rapid=1500)}
+        self.server = fbm.LocalChesscomServer(self.players, handshake_delay=0)
+        self.server.start()
+        self.client = fcc.ChesscomClient(base_url=self.server.base_url)
+        self.db = fcc.ChesscomDatabase(
+            path=":memory:",
+            client=self.client,
+            ttls={"rating": (60, 600)},
+            stale_while_revalidate=True,
+        )
+        self.db.get_rating("pawngrubber")
+        self.players["pawngrubber"] = fbm.gen_stats(rapid=1600)
+
+    def tearDown(self):
+        self.db.quit()
+        self.client.close()
+        self.server.stop()
+
+    def age_rating(self, seconds):
+        sql = "UPDATE chess SET rating_time = rating_time - ?;"
+        self.db.conn.execute(sql, (seconds,))
+        self.db.conn.commit()
+
+    def test_stale_row_served_then_refreshed(self):
+        self.age_rating(120)
+        self.assertEqual(self.db.get_rating("pawngrubber")["rapid"], 1500)
+        self.db.pending[("pawngrubber", "stats")].result()
+        self.assertEqual(self.db.get_rating("pawngrubber")["rapid"], 1600)
+
+    def test_hard_ttl_blocks(self):
+        self.age_rating(1200)
+        self.assertEqual(self.db.get_rating("pawngrubber")["rapid"], 1600)
+        self.assertEqual(self.db.pending, {})
+
+    def test_failed_refresh_logged(self):
+        self.age_rating(120)
+        self.db.client.retries = 0
+        self.server.failures["/pub/player/pawngrubber/stats"] = [503]
+        self.assertEqual(self.db.get_rating("pawngrubber")["rapid"], 1500)
+        with self.assertRaises(fcc.ChesscomUnavailable):
+            self.db.pending[("pawngrubber", "stats")].result()
+        with self.assertLogs(fcc.LOGGER, "WARNING") as logs:
+            self.db.drain_refreshes()
+        self.assertIn("ChesscomUnavailable", logs.output[0])
+        self.assertEqual(self.db.pending, {})
+
+
+class TestGameArchive(unittest.TestCase):
+    def setUp(self):
+        self.month = fcc.archive_months()[0].strftime("%Y/%m")
+        now = int(time.time())
+        self.archive = [
+            fbm.gen_game(100 + i, "PawnGrubber", "opponent", now - 100 + i)
+            for i in range(3)
+        ]
+        players = {"pawngrubber": fbm.gen_stats(), "opponent": fbm.gen_stats()}
+        archives = {("pawngrubber", self.month): self.archive}
+        self.server = fbm.LocalChesscomServer(players, archives, handshake_delay=0)
+        self.server.start()
+        self.client = fcc.ChesscomClient(base_url=self.server.base_url)
+        self.db = fcc.ChesscomDatabase(path=":memory:", client=self.client)
+
+    def tearDown(self):
+        self.db.quit()
+        self.client.close()
+        self.server.stop()
+
+    def test_find_game(self):
+        # The archive download stops at the requested game
+        self.assertEqual(self.db.find_game("pawngrubber", 101), self.archive[1])
+        self.assertEqual(len(self.db.get_player_games("pawngrubber")), 2)
+
+        # Hits come from the mirror, misses revalidate with the stored ETag
+        self.assertEqual(self.db.find_game("PawnGrubber", 100), self.archive[0])
+        self.assertEqual(self.server.requests, 1)
+        self.assertIsNone(self.db.find_game("pawngrubber", 999))
+        self.assertEqual(len(self.db.get_player_games("pawngrubber")), 3)
+        self.assertIsNone(self.db.find_game("pawngrubber", 999))
+        self.assertEqual(self.server.not_modified, 1)
+        self.assertIsNone(self.db.find_game("opponent", 99))
+
+    def test_find_game_api(self):
+        game = fcc.find_game_api("pawngrubber", 101, client=self.client)
+        self.assertEqual(game, self.archive[1])
+        self.assertIsNone(fcc.find_game_api("pawngrubber", 999, client=self.client))
+        self.assertEqual(
+            fcc.get_game_history_api("pawngrubber", client=self.client), self.archive
+        )
+
+    def test_iter_json_array(self):
+        body = json.dumps({"games": self.archive}).encode()
+        chunks = [body[i : i + 7] for i in range(0, len(body), 7)]
+        self.assertEqual(list(fcc.iter_json_array(chunks, "games")), self.archive)
+        self.assertEqual(list(fcc.iter_json_array([b'{"games": []}'], "games")), [])
+
+    def test_incremental_sync(self):
+        self.assertEqual(self.db.sync_archives("pawngrubber"), 3)
+        self.archive.append(
+            fbm.gen_game(103, "opponent", "pawngrubber", int(time.time()))
+        )
+        self.assertEqual(self.db.find_game("pawngrubber", 103), self.archive[3])
+        self.assertEqual(len(self.db.get_player_games("pawngrubber")), 4)
+        self.assertEqual(len(self.db.get_player_games("opponent")), 4)
+
+
 if __name__ == "__main__":
     unittest.main()
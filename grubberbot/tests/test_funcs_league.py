@@ -0,0 +1,518 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import funcs_benchmark as fbm
+import funcs_chesscom as fcc
+import funcs_general as fgg
+import funcs_league as fle
+import funcs_sqlite as fsq
+import numpy as np
+import pandas as pd
+
+
+class TestLeagueMigrations(unittest.TestCase):
+    def test_migrates_existing_database(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "league.sqlite3")
+            chess_db = fcc.ChesscomDatabase(path=":memory:")
+
+            # A database created before migrations existed is at version 0
+            ldb = fle.LeagueDatabase(path, chess_db)
+            ldb.conn.execute("PRAGMA user_version = 0")
+            ldb.quit()
+
+            ldb = fle.LeagueDatabase(path, chess_db)
+            version = fsq.get_user_version(ldb.conn)
+            self.assertEqual(version, len(fle.LEAGUE_MIGRATIONS))
+            sql = """
+            SELECT m.id FROM member AS m WHERE m.team_id IN (1, 2)
+            ;"""
+            self.assertIn("member_team_idx", fsq.explain(ldb.conn, sql)[0])
+            ldb.quit()
+            chess_db.quit()
+
+
+class TestRosterWrites(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.chess_db = fcc.ChesscomDatabase(path=":memory:")
+        path = os.path.join(self.tmp.name, "league.sqlite3")
+        self.ldb = fle.LeagueDatabase(path, self.chess_db)
+        self.season_name = fgg.get_month(0)
+        for i in range(20):
+            self.ldb.set_chesscom(1000 + i, f"user{i}#0001", f"player{i}")
+
+    def tearDown(self):
+        self.ldb.quit()
+        self.chess_db.quit()
+        self.tmp.cleanup()
+
+    def count(self, table):
+        return self.ldb.conn.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+
+    def test_bulk_join_is_one_transaction(self):
+        statements = []
+        self.ldb.conn.set_trace_callback(statements.append)
+        members = [(1000 + i, i % 2) for i in range(20)]
+        self.ldb.league_join_many(self.season_name, members)
+        self.ldb.conn.set_trace_callback(None)
+        self.assertEqual(statements.count("COMMIT"), 1)
+        self.assertEqual(self.count("member"), 20)
+        self.assertEqual(self.count("seed"), 80)
+
+        # An unknown user rolls back the whole batch
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.ldb.league_join_many(self.season_name, [(2000, 1), (9999, 1)])
+        self.assertEqual(self.count("member"), 20)
+        self.ldb.league_join(self.season_name, 9999, True)
+        self.assertEqual(self.count("member"), 20)
+
+    def test_nested_join_rolls_back(self):
+        # A failed batch inside an open transaction, like a group commit, is
+        # undone while the rest of the transaction still commits
+        with self.ldb.transaction():
+            with self.assertRaises(sqlite3.IntegrityError):
+                self.ldb.league_join_many(self.season_name, [(1000, 1), (9999, 1)])
+            self.ldb.league_join(self.season_name, 9999, True)
+            self.ldb.league_join(self.season_name, 1001, True)
+        self.assertEqual(self.count("member"), 1)
+        self.assertEqual(self.count("seed"), 4)
+
+    def test_bulk_team_assignment(self):
+        self.ldb.league_join_many(self.season_name, [(1000 + i, 1) for i in range(4)])
+        self.ldb.set_team_names(self.season_name, ["Team A", "Team B"])
+        self.assertEqual(
+            self.ldb.get_team_names(self.season_name), ["Team A", "Team B"]
+        )
+        user_ids = self.ldb.get_user_ids([1000, 1001])
+        self.ldb.set_member_teams(
+            self.season_name, [(user_ids[1000], "Team A"), (user_ids[1001], "Team B")]
+        )
+        df = self.ldb.get_team_members(self.season_name, "Team A")
+        self.assertEqual(list(df["discord_id"]), [1000])
+
+        self.ldb.reset_teams(self.season_name)
+        df = self.ldb.get_team_members(self.season_name, fle.SIGNUP_TEAM)
+        self.assertEqual(len(df), 4)
+
+    def test_id_cache(self):
+        ids = self.ldb.ids
+        self.assertEqual(len(ids.season_weeks(self.season_name)), 4)
+        self.assertEqual(ids.team_names(self.season_name), [fle.SIGNUP_TEAM])
+        self.assertIsNone(ids.team(self.season_name, "Team A"))
+
+        # New teams invalidate the cache
+        self.ldb.set_team_names(self.season_name, ["Team A"])
+        self.assertIsNotNone(ids.team(self.season_name, "Team A"))
+        self.ldb.league_join(self.season_name, 1000, True, team="Team A")
+        self.assertTrue(self.ldb.is_member(self.season_name, 1000))
+        self.assertFalse(self.ldb.is_member(fgg.get_month(1), 1000))
+        self.assertFalse(self.ldb.is_member("no such season", 1000))
+
+    def test_bulk_name_update(self):
+        self.ldb.update_discord_names([(1000, "renamed#0001"), (1001, "other#0001")])
+        self.ldb.update_discord_name(1002, "single#0001")
+        names = [self.ldb.get_user_data(d).discord_name for d in range(1000, 1003)]
+        self.assertEqual(names, ["renamed#0001", "other#0001", "single#0001"])
+
+    def assert_read_model_current(self):
+        columns = fle.GAME_INFO_COLUMN_SQL
+        rows = [
+            self.ldb.conn.execute(
+                f"SELECT {columns} FROM {table} ORDER BY game_id;"
+            ).fetchall()
+            for table in ["game_info", "game_info_view"]
+        ]
+        self.assertEqual(rows[0], rows[1])
+        return rows[0]
+
+    def test_game_read_model(self):
+        self.ldb.set_team_names(self.season_name, ["Team A", "Team B"])
+        self.ldb.league_join_many(self.season_name, [(1000, 1), (1001, 1)], "Team A")
+        self.ldb.league_join_many(self.season_name, [(1002, 1)], "Team B")
+        self.ldb.league_join_many(self.season_name, [(1003, 0)], "Team B")
+        self.ldb.set_game(self.season_name, 2, 1000, 1002)
+        self.ldb.set_game(self.season_name, 3, 1002, 1001)
+        self.assertEqual(len(self.assert_read_model_current()), 2)
+
+        df = self.ldb.get_season_games(self.season_name)
+        self.assertEqual(list(df["white_discord_id"]), [1000, 1002])
+        self.assertEqual(list(df["white_week_num"]), [2, 3])
+        self.assertEqual(list(df["white_team_name"]), ["Team A", "Team B"])
+
+        # Every write to a game or what it shows is reflected
+        game_id = int(df["game_id"][0])
+        self.ldb.set_result(game_id, 1, "https://example.com/game/1")
+        self.ldb.schedule(game_id, 7, "2021-01-01 12:00:00")
+        self.ldb.update_discord_name(1000, "renamed#0001")
+        seed_id = self.assert_read_model_current()[0][4]
+        self.ldb.update_sub(self.season_name, seed_id, 1003)
+        rows = self.assert_read_model_current()
+        self.assertEqual(rows[0][5], None)
+
+        df = self.ldb.get_gameid_from_seedid(seed_id)
+        self.assertEqual(list(df["game_id"]), [game_id])
+        self.assertEqual(list(df["black_discord_id"]), [1003])
+        self.assertEqual(self.ldb.get_season_games(fgg.get_month(1)).shape[0], 0)
+
+    def test_many_members(self):
+        # SQLite before 3.32 binds at most 999 variables in a statement
+        if hasattr(self.ldb.conn, "setlimit"):
+            self.ldb.conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        sql = "INSERT INTO user(discord_id, discord_name) VALUES(?, ?);"
+        users = [(2000 + i, f"user{i}#0001") for i in range(1500)]
+        self.ldb.conn.executemany(sql, users)
+        self.ldb.conn.commit()
+        self.ldb.league_join_many(self.season_name, [(d, 1) for d, _ in users])
+        self.assertEqual(self.count("member"), 1500)
+
+    def test_season_plan(self):
+        for i in range(20):
+            self.chess_db._store_exists(f"player{i}", True)
+            self.chess_db._store_stats(f"player{i}", fbm.gen_stats(rapid=1000 + 50 * i))
+        self.chess_db.conn.commit()
+        teams = ["Team Carlsen", "Team Nepomniachtchi"]
+        self.ldb.set_team_names(self.season_name, teams)
+        rant = [(1000 + 2 * i, 1) for i in range(10)]
+        nort = [(1001 + 2 * i, 1) for i in range(9)]
+        self.ldb.league_join_many(self.season_name, rant, teams[0])
+        self.ldb.league_join_many(self.season_name, nort, teams[1])
+        max_gap = self.ldb.plan_season(self.season_name)
+
+        # Planned weeks are seeded without looking at ratings
+        statements = []
+        self.chess_db.conn.set_trace_callback(statements.append)
+        self.ldb.seed_games(self.season_name, 1)
+        self.chess_db.conn.set_trace_callback(None)
+        self.assertEqual(statements, [])
+
+        # A late joiner meets the players sitting out, never one twice
+        self.ldb.league_join_many(self.season_name, [(1019, 1)], teams[1])
+        for week_num in [2, 3, 4]:
+            self.ldb.seed_games(self.season_name, week_num)
+        df = self.ldb.get_season_games(self.season_name)
+        self.assertEqual(len(df), 9 + 3 * 10)
+        pairs = {
+            frozenset(p) for p in zip(df["white_discord_id"], df["black_discord_id"])
+        }
+        self.assertEqual(len(pairs), len(df))
+        planned = df[df["white_discord_id"] != 1019]
+        planned = planned[planned["black_discord_id"] != 1019]
+        gaps = (planned["white_discord_id"] - planned["black_discord_id"]) * 50
+        self.assertEqual((gaps**2).max(), max_gap)
+
+    def test_plan_conflicts(self):
+        # Two players a team, one pairing has no rating gap and one has 500
+        for i in range(4):
+            self.chess_db._store_exists(f"player{i}", True)
+            self.chess_db._store_stats(
+                f"player{i}", fbm.gen_stats(rapid=1000 + 500 * (i // 2))
+            )
+        self.chess_db.conn.commit()
+        teams = ["Team Carlsen", "Team Nepomniachtchi"]
+        for season_name in [fgg.get_month(0), fgg.get_month(1)]:
+            self.ldb.set_team_names(season_name, teams)
+            self.ldb.league_join_many(season_name, [(1000, 1), (1002, 1)], teams[0])
+            self.ldb.league_join_many(season_name, [(1001, 1), (1003, 1)], teams[1])
+            self.ldb.plan_season(season_name, week_nums=(2,))
+
+        # Unplanned weeks leave the pairs planned for later weeks alone
+        self.ldb.seed_games(fgg.get_month(0), 1)
+        self.ldb.seed_games(fgg.get_month(0), 2)
+
+        # Planned pairs that already played are paired again
+        self.ldb.set_game(fgg.get_month(1), 1, 1000, 1001)
+        self.ldb.set_game(fgg.get_month(1), 1, 1003, 1002)
+        self.ldb.seed_games(fgg.get_month(1), 2)
+
+        for season_name in [fgg.get_month(0), fgg.get_month(1)]:
+            df = self.ldb.get_season_games(season_name)
+            pairs = zip(df["white_discord_id"], df["black_discord_id"])
+            self.assertEqual(len({frozenset(p) for p in pairs}), 4)
+
+    def test_unplannable_season(self):
+        # One player a team can't play four weeks without a rematch
+        for i in range(2):
+            self.chess_db._store_exists(f"player{i}", True)
+            self.chess_db._store_stats(f"player{i}", fbm.gen_stats())
+        self.chess_db.conn.commit()
+        teams = ["Team Carlsen", "Team Nepomniachtchi"]
+        self.ldb.set_team_names(self.season_name, teams)
+        self.ldb.league_join_many(self.season_name, [(1000, 1)], teams[0])
+        self.ldb.league_join_many(self.season_name, [(1001, 1)], teams[1])
+        self.assertIsNone(self.ldb.plan_season(self.season_name))
+        self.assertEqual(self.ldb.get_week_plan(self.season_name, 1), [])
+        self.ldb.seed_games(self.season_name, 1)
+        self.assertEqual(len(self.ldb.get_season_games(self.season_name)), 1)
+
+    def test_query_cache(self):
+        self.ldb.league_join_many(self.season_name, [(1000, 1), (1001, 1)])
+        self.ldb.set_game(self.season_name, 1, 1000, 1001)
+        df = self.ldb.get_season_games(self.season_name)
+        df["result"] = 5
+
+        # Unchanged tables are not queried again
+        statements = []
+        fbm.trace(self.ldb, statements.append)
+        df = self.ldb.get_season_games(self.season_name)
+        self.assertEqual(statements, [])
+        self.assertTrue(pd.isna(df["result"][0]))
+        self.assertTrue(self.ldb.is_member(self.season_name, 1000))
+        self.assertTrue(self.ldb.is_member(self.season_name, 1000))
+        self.assertEqual(len(statements), 1)
+
+        # Writes to a table only invalidate the reads that depend on it
+        self.ldb.set_result(int(df["game_id"][0]), 1)
+        self.assertTrue(self.ldb.is_member(self.season_name, 1000))
+        self.assertEqual(self.ldb.get_season_games(self.season_name)["result"][0], 1)
+
+        # As do writes that bypass the write methods
+        self.ldb.conn.execute("UPDATE game SET result = 0;")
+        self.ldb.conn.commit()
+        self.assertEqual(self.ldb.get_season_games(self.season_name)["result"][0], 0)
+        fbm.trace(self.ldb, None)
+        self.assertEqual(self.ldb.cache.stats["hits"], 3)
+
+    def test_group_commit(self):
+        async def burst():
+            joins = [
+                self.ldb.write(self.ldb.league_join_many, self.season_name, [(d, 1)])
+                for d in [1000, 1001, 9999, 1002]
+            ]
+            return await asyncio.gather(*joins, return_exceptions=True)
+
+        statements = []
+        self.ldb.conn.set_trace_callback(statements.append)
+        results = asyncio.run(burst())
+        self.ldb.conn.set_trace_callback(None)
+
+        # One commit for the batch, the failing join only undoes itself
+        self.assertEqual(statements.count("COMMIT"), 1)
+        self.assertIsInstance(results[2], sqlite3.IntegrityError)
+        self.assertEqual(self.count("member"), 3)
+        metrics = self.ldb.write_queue.metrics
+        self.assertEqual((metrics["batches"], metrics["last_batch_size"]), (1, 4))
+        self.assertEqual(metrics["failures"], 1)
+
+
+class TestRatingJoins(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        players = {f"player{i}": fbm.gen_stats(rapid=1600 - 100 * i) for i in range(3)}
+        self.server = fbm.LocalChesscomServer(players, handshake_delay=0).start()
+        self.client = fcc.ChesscomClient(base_url=self.server.base_url)
+        self.chess_db = fcc.ChesscomDatabase(
+            path=os.path.join(self.tmp.name, "chesscom.sqlite3"), client=self.client
+        )
+        path = os.path.join(self.tmp.name, "league.sqlite3")
+        self.ldb = fle.LeagueDatabase(path, self.chess_db)
+        self.season_name = fgg.get_month(0)
+        for i in range(4):
+            self.ldb.set_chesscom(1000 + i, f"user{i}#0001", f"player{i}")
+        self.ldb.league_join_many(self.season_name, [(1000 + i, 1) for i in range(4)])
+
+    def tearDown(self):
+        self.ldb.quit()
+        self.chess_db.quit()
+        self.client.close()
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def test_games_by_week(self):
+        # player3 doesn't exist on chess.com, so has no rating
+        self.ldb.set_game(self.season_name, 1, 1003, 1000)
+        self.ldb.set_game(self.season_name, 1, 1002, 1001)
+        df = self.ldb.get_games_by_week(self.season_name, 1)
+        self.assertEqual(list(df["white_discord_id"]), [1002, 1003])
+        self.assertEqual(df["white_rapid_rating"][0], 1400)
+        self.assertTrue(pd.isna(df["white_rapid_rating"][1]))
+        self.assertEqual(list(df["black_rapid_rating"]), [1500, 1600])
+
+        # Cached ratings are read without another request
+        requests = self.server.requests
+        df = self.ldb.get_member_info(self.season_name)
+        self.assertEqual(list(df["rapid_rating"][:3]), [1600, 1500, 1400])
+        self.assertEqual(self.server.requests, requests)
+
+    def test_league_info(self):
+        df = self.ldb.get_league_info(self.season_name, 1000)
+        self.assertEqual(list(df["Rapid Rating"]), [1600])
+
+        # A new rating is shown without waiting for the cached read to expire
+        self.chess_db._store_stats("player0", fbm.gen_stats(rapid=1700))
+        self.chess_db.conn.commit()
+        df = self.ldb.get_league_info(self.season_name, 1000)
+        self.assertEqual(list(df["Rapid Rating"]), [1700])
+
+
+class TestAsyncDatabase(unittest.TestCase):
+    def test_event_loop_stall(self):
+        # 5 of the 50 commands fetch from a chess.com taking 0.1s per request
+        players = {f"player{i}": fbm.gen_stats() for i in range(50)}
+        server = fbm.LocalChesscomServer(
+            players, handshake_delay=0, response_delay=0.1
+        ).start()
+        client = fcc.ChesscomClient(base_url=server.base_url)
+        tmp = tempfile.TemporaryDirectory()
+        chess_db = fcc.ChesscomDatabase(
+            path=os.path.join(tmp.name, "chesscom.sqlite3"), client=client
+        )
+        ldb = fle.LeagueDatabase(os.path.join(tmp.name, "league.sqlite3"), chess_db)
+        season_name = fgg.get_month(0)
+        for i in range(50):
+            ldb.set_chesscom(1000 + i, f"user{i}#0001", f"player{i}")
+            if i >= 5:
+                chess_db._store_exists(f"player{i}", True)
+                chess_db._store_stats(f"player{i}", players[f"player{i}"])
+        chess_db.conn.commit()
+        aldb = fsq.AsyncDatabase(ldb, ldb.executor, ldb.lock)
+        acdb = fsq.AsyncDatabase(chess_db, ldb.executor)
+
+        async def join(discord_id):
+            user_data = await aldb.get_user_data(discord_id)
+            await acdb.get_count(user_data.chesscom)
+            await ldb.write(ldb.league_join, season_name, discord_id, True)
+            return await aldb.is_member(season_name, discord_id)
+
+        async def watch(stop):
+            stall = 0
+            while not stop.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                stall = max(stall, time.perf_counter() - start - 0.001)
+            return stall
+
+        async def commands():
+            stop = asyncio.Event()
+            watcher = asyncio.create_task(watch(stop))
+            joined = await asyncio.gather(*[join(1000 + i) for i in range(50)])
+            stop.set()
+            return joined, await watcher
+
+        joined, stall = asyncio.run(commands())
+        self.assertEqual(joined, [True] * 50)
+        self.assertLess(stall, 0.05)
+
+        ldb.quit()
+        chess_db.quit()
+        client.close()
+        server.stop()
+        tmp.cleanup()
+
+    def test_fetch_contention(self):
+        # Every chess.com request takes 0.5s, the database commands none
+        players = {"slow": fbm.gen_stats(), "cached": fbm.gen_stats()}
+        server = fbm.LocalChesscomServer(
+            players, handshake_delay=0, response_delay=0.5
+        ).start()
+        client = fcc.ChesscomClient(base_url=server.base_url)
+        tmp = tempfile.TemporaryDirectory()
+        chess_db = fcc.ChesscomDatabase(
+            path=os.path.join(tmp.name, "chesscom.sqlite3"), client=client
+        )
+        ldb = fle.LeagueDatabase(os.path.join(tmp.name, "league.sqlite3"), chess_db)
+        ldb.set_chesscom(1000, "user0#0001", "cached")
+        chess_db._store_exists("cached", True)
+        chess_db._store_stats("cached", players["cached"])
+        chess_db.conn.commit()
+        aldb = fsq.AsyncDatabase(ldb, ldb.executor, ldb.lock)
+        acdb = fsq.AsyncDatabase(chess_db, ldb.executor)
+
+        async def timed(call):
+            start = time.perf_counter()
+            result = await call
+            return result, time.perf_counter() - start
+
+        async def commands():
+            fetch = asyncio.create_task(timed(acdb.get_rating("slow")))
+            await asyncio.sleep(0.1)
+            user_data, user_time = await timed(aldb.get_user_data(1000))
+            rating, rating_time = await timed(acdb.get_rating("cached"))
+            return await fetch, (user_data, user_time), (rating, rating_time)
+
+        fetch, user, rating = asyncio.run(commands())
+        self.assertIsNotNone(fetch[0])
+        self.assertGreater(fetch[1], 0.5)
+        self.assertEqual(user[0].chesscom, "cached")
+        self.assertLess(user[1], 0.2)
+        self.assertIsNotNone(rating[0])
+        self.assertLess(rating[1], 0.2)
+
+        ldb.quit()
+        chess_db.quit()
+        client.close()
+        server.stop()
+        tmp.cleanup()
+
+    def test_rated_read_contention(self):
+        # A league read whose member's rating must come from a slow chess.com
+        players = {"slow": fbm.gen_stats(), "cached": fbm.gen_stats()}
+        server = fbm.LocalChesscomServer(
+            players, handshake_delay=0, response_delay=0.5
+        ).start()
+        client = fcc.ChesscomClient(base_url=server.base_url)
+        tmp = tempfile.TemporaryDirectory()
+        chess_db = fcc.ChesscomDatabase(
+            path=os.path.join(tmp.name, "chesscom.sqlite3"), client=client
+        )
+        ldb = fle.LeagueDatabase(os.path.join(tmp.name, "league.sqlite3"), chess_db)
+        season_name = fgg.get_month(0)
+        ldb.set_chesscom(1000, "user0#0001", "cached")
+        ldb.set_chesscom(1001, "user1#0001", "slow")
+        ldb.league_join(season_name, 1001, True)
+        aldb = fsq.AsyncDatabase(ldb, ldb.executor, ldb.lock)
+
+        async def timed(call):
+            start = time.perf_counter()
+            result = await call
+            return result, time.perf_counter() - start
+
+        async def commands():
+            fetch = asyncio.create_task(timed(aldb.get_member_info(season_name)))
+            await asyncio.sleep(0.1)
+            user = await timed(aldb.get_user_data(1000))
+            return await fetch, user
+
+        fetch, user = asyncio.run(commands())
+        self.assertEqual(list(fetch[0]["chesscom"]), ["slow"])
+        self.assertFalse(fetch[0]["rapid_rating"].isna().any())
+        self.assertGreater(fetch[1], 0.5)
+        self.assertEqual(user[0].chesscom, "cached")
+        self.assertLess(user[1], 0.2)
+
+        ldb.quit()
+        chess_db.quit()
+        client.close()
+        server.stop()
+        tmp.cleanup()
+
+
+class TestEvenSplit(unittest.TestCase):
+    def test_incremental_score(self):
+        ratings = [800 + 37 * i % 1600 for i in range(30)] + [None, None]
+        df = pd.DataFrame({"rating": ratings}, dtype=float)
+        splits = [list(range(32))[t::3] for t in range(3)]
+        split = fle.TeamSplit(df["rating"], splits)
+        for i in range(50):
+            a, b = i % 3, (i + 1) % 3
+            score = split.swap(a, i % 10, b, (3 * i) % 10)
+            expected = fle.gen_split_score(df, [list(s) for s in split.splits])
+            self.assertTrue(np.isclose(score, expected))
+
+    def test_even_split(self):
+        df = pd.DataFrame({"rating": [1000 + 50 * i for i in range(20)]})
+        dfs, score = fle.even_split(df, ["a", "b"], iter_time=0.1)
+        self.assertEqual(sorted(len(d) for d in dfs.values()), [10, 10])
+        self.assertTrue(
+            np.isclose(
+                score, fle.gen_split_score(df, [list(d.index) for d in dfs.values()])
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
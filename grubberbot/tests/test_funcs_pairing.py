@@ -0,0 +1,173 @@
+import asyncio
+import itertools
+import random
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import funcs_pairing as fpa
+import numpy as np
+
+
+def brute_force(costs):
+    """Best score over every complete pairing, np.inf if there is none"""
+    transposed = costs.shape[0] > costs.shape[1]
+    if transposed:
+        costs = costs.T
+    rows = list(range(costs.shape[0]))
+    best = np.inf
+    for cols in itertools.permutations(range(costs.shape[1]), len(rows)):
+        best = min(best, fpa.score_pairing(costs, rows, list(cols)))
+    return best
+
+
+class TestBestPairing(unittest.TestCase):
+    def test_matches_brute_force(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            size_a, size_b = rng.randint(1, 5), rng.randint(1, 5)
+            ratings_a = [rng.randint(1000, 1100) for _ in range(size_a)]
+            ratings_b = [rng.randint(1000, 1100) for _ in range(size_b)]
+            history = [
+                (i, j)
+                for i in range(size_a)
+                for j in range(size_b)
+                if rng.random() < 0.3
+            ]
+            costs = fpa.pairing_costs(ratings_a, ratings_b, history)
+            expected = brute_force(costs)
+            if expected == np.inf:
+                with self.assertRaises(fpa.PairingError):
+                    fpa.best_pairing(costs)
+                continue
+            rows, cols, score = fpa.best_pairing(costs)
+            self.assertAlmostEqual(score, expected)
+            self.assertEqual(len(rows), min(size_a, size_b))
+            for pair in zip(rows, cols):
+                self.assertNotIn(pair, history)
+
+    def test_rematch_avoided(self):
+        costs = fpa.pairing_costs([1000, 1500], [1000, 1500], [(0, 0)])
+        rows, cols, score = fpa.best_pairing(costs)
+        self.assertEqual(list(zip(rows, cols)), [(0, 1), (1, 0)])
+        self.assertEqual(score, 500**2 * 1.01)
+
+    def test_missing_rating(self):
+        costs = fpa.pairing_costs([1000, None, 2000], [1500], [])
+        self.assertEqual(costs[1, 0], 0)
+
+    def test_empty_team(self):
+        rows, cols, score = fpa.best_pairing(fpa.pairing_costs([], [1000]))
+        self.assertEqual((len(rows), len(cols), score), (0, 0, 0.0))
+
+
+class TestSeasonPairings(unittest.TestCase):
+    def test_matches_brute_force(self):
+        rng = random.Random(0)
+        for _ in range(60):
+            size_a, size_b = rng.randint(1, 3), rng.randint(1, 4)
+            weeks = rng.randint(1, 3)
+            ratings_a = [rng.randint(1000, 1100) for _ in range(size_a)]
+            ratings_b = [rng.randint(1000, 1100) for _ in range(size_b)]
+            history = [(i, j) for i in range(size_a) for j in range(size_b)]
+            history = [pair for pair in history if rng.random() < 0.2]
+            costs = fpa.pairing_costs(ratings_a, ratings_b, history)
+
+            # Every season without rematches, and few enough byes each
+            transposed = size_a > size_b
+            small, large = sorted([size_a, size_b])
+            byes = -(-(large - small) * weeks // large)
+            expected = np.inf
+            weekly = list(itertools.permutations(range(large), small))
+            for season in itertools.product(weekly, repeat=weeks):
+                games = [(r, c) for cols in season for r, c in enumerate(cols)]
+                if transposed:
+                    games = [(c, r) for r, c in games]
+                sat_out = [sum(p not in cols for cols in season) for p in range(large)]
+                if len(set(games)) < len(games) or max(sat_out) > byes:
+                    continue
+                expected = min(expected, max(costs[r, c] for r, c in games))
+
+            if expected == np.inf:
+                with self.assertRaises(fpa.PairingError):
+                    fpa.season_pairings(costs, weeks)
+                continue
+            max_cost, plan = fpa.season_pairings(costs, weeks)
+            self.assertEqual(max_cost, expected)
+            games = [pair for rows, cols in plan for pair in zip(rows, cols)]
+            self.assertEqual(len(games), small * weeks)
+            self.assertEqual(len(set(games)), len(games))
+            self.assertLessEqual(max(costs[r, c] for r, c in games), max_cost)
+
+
+class TestPairingSearch(unittest.TestCase):
+    def test_incremental_score(self):
+        rng = random.Random(0)
+        ratings_a = [rng.randint(1000, 1300) for _ in range(6)]
+        ratings_b = [rng.randint(1000, 1300) for _ in range(8)]
+        history = {(rng.randrange(6), rng.randrange(8)) for _ in range(12)}
+        search = fpa.PairingSearch(ratings_a, ratings_b, history)
+        for _ in range(200):
+            score = search.swap(rng.randrange(6), rng.randrange(8))
+            rows, cols = search.pairing()
+            gaps = (np.array(ratings_a)[rows] - np.array(ratings_b)[cols]) ** 2
+            rematches = sum(pair in history for pair in zip(rows, cols))
+            self.assertEqual(score[0], rematches)
+            self.assertAlmostEqual(score[1], gaps.max() + 0.01 * gaps.mean())
+
+    def test_unavoidable_rematch(self):
+        history = [(0, 0), (0, 1)]
+        with self.assertRaises(fpa.PairingError):
+            fpa.best_pairing(fpa.pairing_costs([1000, 1100], [1000, 1100], history))
+        search = fpa.PairingSearch([1000, 1100], [1000, 1100], history)
+        rows, cols, score = search.run(iter_time=0.05, seed=0)
+        self.assertEqual(score, (1, 0.0))
+
+
+class TestMultiStart(unittest.TestCase):
+    def test_best_restart(self):
+        rng = random.Random(0)
+        ratings_a = [rng.randint(1000, 2000) for _ in range(12)]
+        ratings_b = [rng.randint(1000, 2000) for _ in range(12)]
+        args = (ratings_a, ratings_b, {(0, 0)})
+        kwargs = {"iter_time": 0.05}
+
+        rows, cols, score = fpa.multi_start(
+            fpa.search_pairing, args, kwargs, restarts=4, seed=0
+        )
+        self.assertEqual(sorted(cols), list(range(12)))
+        rows, cols, async_score = asyncio.run(
+            fpa.multi_start_async(fpa.search_pairing, args, kwargs, restarts=4, seed=0)
+        )
+        self.assertEqual(score[0], 0)
+        self.assertEqual(async_score[0], 0)
+
+    def test_python38_shutdown(self):
+        class Python38Executor(ThreadPoolExecutor):
+            # Python 3.8 has no cancel_futures argument
+            def shutdown(self, wait=True):
+                super().shutdown(wait)
+
+        process_pool = fpa.process_pool
+        fpa.process_pool = lambda: Python38Executor(max_workers=2)
+        try:
+            args = ([1000, 1100, 1200], [1050, 1150, 1250], {(0, 0)})
+            outcome = fpa.multi_start(fpa.search_pairing, args, {"iter_time": 0.01})
+            self.assertEqual(outcome[-1][0], 0)
+            outcome = asyncio.run(
+                fpa.multi_start_async(fpa.search_pairing, args, {"iter_time": 0.01})
+            )
+            self.assertEqual(outcome[-1][0], 0)
+        finally:
+            fpa.process_pool = process_pool
+
+    def test_agreement(self):
+        best = fpa.BestOutcome(agree=2)
+        self.assertFalse(best.add(("a", 3.0)))
+        self.assertFalse(best.add(("b", 1.0)))
+        self.assertFalse(best.add(("c", float("nan"))))
+        self.assertTrue(best.add(("d", 1.0)))
+        self.assertEqual(best.outcome, ("b", 1.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import funcs_sqlite as fsq
+
+MIGRATIONS = [
+    ["CREATE TABLE a(id integer PRIMARY KEY, b integer);"],
+    ["CREATE INDEX a_b_idx ON a(b);"],
+]
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_versions(self):
+        self.assertEqual(fsq.migrate(self.conn, MIGRATIONS[:1]), [1])
+        self.assertEqual(fsq.migrate(self.conn, MIGRATIONS), [2])
+        self.assertEqual(fsq.migrate(self.conn, MIGRATIONS), [])
+        self.assertEqual(fsq.get_user_version(self.conn), 2)
+        plan = fsq.explain(self.conn, "SELECT id FROM a WHERE b = ?;", (1,))
+        self.assertIn("a_b_idx", plan[0])
+
+    def test_failed_migration_rolls_back(self):
+        broken = MIGRATIONS + [["CREATE TABLE c(id integer);", "NOT SQL;"]]
+        with self.assertRaises(sqlite3.OperationalError):
+            fsq.migrate(self.conn, broken)
+        self.assertEqual(fsq.get_user_version(self.conn), 2)
+        sql = "SELECT name FROM sqlite_master WHERE name = 'c';"
+        self.assertEqual(self.conn.execute(sql).fetchall(), [])
+
+    def test_newer_database(self):
+        fsq.migrate(self.conn, MIGRATIONS)
+        with self.assertRaises(sqlite3.DatabaseError):
+            fsq.migrate(self.conn, MIGRATIONS[:1])
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "test.sqlite3")
+        self.pool = fsq.ConnectionPool(self.path, readers=2)
+        self.pool.writer.execute("CREATE TABLE a(id integer PRIMARY KEY);")
+        self.pool.writer.commit()
+
+    def tearDown(self):
+        self.pool.close()
+        self.tmp.cleanup()
+
+    def count(self, conn):
+        return conn.execute("SELECT COUNT(*) FROM a;").fetchone()[0]
+
+    def test_wal(self):
+        mode = self.pool.writer.execute("PRAGMA journal_mode;").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_readers_use_snapshots(self):
+        with self.pool.reader() as conn:
+            self.assertEqual(self.count(conn), 0)
+
+            # Writing and committing is not blocked by the open read
+            self.pool.writer.execute("INSERT INTO a(id) VALUES(1);")
+            self.assertEqual(self.count(conn), 0)
+            self.pool.writer.commit()
+            self.assertEqual(self.count(conn), 0)
+
+        with self.pool.reader() as conn:
+            self.assertEqual(self.count(conn), 1)
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("INSERT INTO a(id) VALUES(2);")
+
+    def test_backup_is_committed_snapshot(self):
+        self.pool.writer.execute("INSERT INTO a(id) VALUES(1);")
+        self.pool.writer.commit()
+        self.pool.writer.execute("INSERT INTO a(id) VALUES(2);")
+
+        path = os.path.join(self.tmp.name, "backup.sqlite3")
+        self.pool.backup(path)
+        conn = sqlite3.connect(path)
+        self.assertEqual(self.count(conn), 1)
+        conn.close()
+
+
+class Point(fsq.Row):
+    __slots__ = ("x", "y")
+
+
+class TestRow(unittest.TestCase):
+    def test_fetch(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE point(x integer, y integer);")
+        conn.executemany("INSERT INTO point VALUES(?, ?);", [(1, 2), (3, 4)])
+        sql = "SELECT x, y FROM point WHERE x = ?;"
+
+        point = fsq.fetch_one(conn, sql, (3,), Point)
+        self.assertEqual((point.x, point["y"]), (3, 4))
+        self.assertEqual(point.as_dict(), {"x": 3, "y": 4})
+        self.assertFalse(hasattr(point, "__dict__"))
+        self.assertEqual(fsq.fetch_one(conn, sql, (3,)), (3, 4))
+        self.assertIsNone(fsq.fetch_one(conn, sql, (5,), Point))
+        self.assertIsNone(fsq.fetch_value(conn, sql, (5,)))
+        points = fsq.fetch_all(conn, "SELECT x, y FROM point;", row=Point)
+        self.assertEqual(points, [Point(1, 2), Point(3, 4)])
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()